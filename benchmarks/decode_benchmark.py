@@ -0,0 +1,67 @@
+"""
+********************************************************************************
+decode_benchmark.py -- Block Decoding Benchmark
+
+Compares the original decoding path (full `json.loads` into nested dicts, then
+field extraction with `.get` chains) against `utils.decode_utils.decode_block`,
+which keeps only the stored fields in a compact `BlockRecord`.
+
+Usage:
+    python3 -m benchmarks.decode_benchmark [--txs N] [--signatures N] [--rounds N]
+
+Developed by: Don Fox
+Date: 07/02/2024
+********************************************************************************
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchmarks.mock_lcd import make_block
+from utils.decode_utils import decode_block, JSON_BACKEND
+
+
+def decode_full(raw: bytes) -> tuple:
+    """The original path: full stdlib decode, then pick the fields out of the dict."""
+    block_data = json.loads(raw)
+    header = block_data.get("block", {}).get("header", {})
+    return (header.get("height"), block_data.get("block_id", {}).get("hash"), header.get("time"),
+            block_data.get("block", {}).get("data", {}).get("txs", []))
+
+
+def measure(label: str, decode, payloads: list[bytes], rounds: int) -> None:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for raw in payloads:
+            decode(raw)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    kept = [decode(raw) for raw in payloads]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    blocks = rounds * len(payloads)
+    print(f"{label:<28} {blocks / elapsed:>10.0f} blocks/sec   "
+          f"retained {retained / len(payloads) / 1024:>8.1f} KiB/block   peak {peak / 1024 / 1024:>7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--txs", type=int, default=200, help="Transactions per block")
+    parser.add_argument("--signatures", type=int, default=125, help="last_commit signatures per block")
+    parser.add_argument("--blocks", type=int, default=50, help="Distinct synthetic blocks")
+    parser.add_argument("--rounds", type=int, default=20, help="Decode passes over the blocks")
+    args = parser.parse_args()
+
+    payloads = [make_block(1_000_000 + i, args.txs, args.signatures) for i in range(args.blocks)]
+    print(f"{args.blocks} blocks, {sum(map(len, payloads)) / len(payloads) / 1024:.1f} KiB each, "
+          f"backend={JSON_BACKEND}")
+    measure("json.loads + dict fields", decode_full, payloads, args.rounds)
+    measure(f"decode_block ({JSON_BACKEND})", decode_block, payloads, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
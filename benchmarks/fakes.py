@@ -0,0 +1,256 @@
+"""
+********************************************************************************
+fakes.py -- In-Process Redis and PostgreSQL Stand-ins for Benchmarks
+
+Minimal fakes that implement just the Redis commands and psycopg2 connection
+surface the indexer uses, so throughput benchmarks can run without Redis or
+PostgreSQL servers. They are not general-purpose fakes; storage is in memory
+and an optional per-commit delay stands in for database latency.
+
+Developed by: Don Fox
+Date: 07/02/2024
+********************************************************************************
+"""
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+
+class FakeRedis:
+    """Thread-safe in-memory subset of redis.Redis (strings, bitmaps, sets, sorted sets, scripts)."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    # ---- generic ----------------------------------------------------------------------------------------------------
+
+    def ping(self):
+        return True
+
+    def exists(self, *keys):
+        with self._lock:
+            return sum(key in self._data for key in keys)
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            return str(value).encode() if value is not None else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+        return True
+
+    # ---- bitmaps ----------------------------------------------------------------------------------------------------
+
+    def _bitmap(self, key) -> bytearray:
+        return self._data.setdefault(key, bytearray())
+
+    def setbit(self, key, offset, value):
+        with self._lock:
+            bitmap = self._bitmap(key)
+            byte, bit = divmod(int(offset), 8)
+            if byte >= len(bitmap):
+                bitmap.extend(b"\x00" * (byte + 1 - len(bitmap)))
+            mask = 0x80 >> bit
+            previous = 1 if bitmap[byte] & mask else 0
+            bitmap[byte] = bitmap[byte] | mask if value else bitmap[byte] & ~mask
+            return previous
+
+    def getbit(self, key, offset):
+        with self._lock:
+            bitmap = self._data.get(key, bytearray())
+            byte, bit = divmod(int(offset), 8)
+            return 1 if byte < len(bitmap) and bitmap[byte] & (0x80 >> bit) else 0
+
+    def getrange(self, key, start, end):
+        with self._lock:
+            value = bytes(self._data.get(key, b""))
+            return value[start:] if end == -1 else value[start:end + 1]
+
+    def bitpos(self, key, bit, start=None, end=None, mode=None):
+        # Only BIT-mode ranges are used by the indexer
+        with self._lock:
+            end = len(self._data.get(key, b"")) * 8 - 1 if end is None else end
+            for offset in range(start or 0, end + 1):
+                if self.getbit(key, offset) == bit:
+                    return offset
+            return -1
+
+    # ---- sets -------------------------------------------------------------------------------------------------------
+
+    def sscan_iter(self, key, count=None):
+        with self._lock:
+            members = list(self._data.get(key, set()))
+        return iter(members)
+
+    # ---- sorted sets ------------------------------------------------------------------------------------------------
+
+    def zadd(self, key, mapping, lt=False, gt=False):
+        with self._lock:
+            zset = self._data.setdefault(key, {})
+            added = 0
+            for member, score in mapping.items():
+                member = member if isinstance(member, bytes) else str(member).encode()
+                current = zset.get(member)
+                if current is None:
+                    added += 1
+                elif (lt and score >= current) or (gt and score <= current):
+                    continue
+                zset[member] = float(score)
+            return added
+
+    def zrange(self, key, start, end, withscores=False):
+        with self._lock:
+            items = sorted(self._data.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+        items = items[start:] if end == -1 else items[start:end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+        low = float(min.replace("inf", "Infinity")) if isinstance(min, str) else float(min)
+        high = float(max.replace("inf", "Infinity")) if isinstance(max, str) else float(max)
+        members = [member for member, score in self.zrange(key, 0, -1, withscores=True) if low <= score <= high]
+        return members[start:start + num] if start is not None else members
+
+    def zrem(self, key, *members):
+        with self._lock:
+            zset = self._data.get(key, {})
+            return sum(zset.pop(member if isinstance(member, bytes) else str(member).encode(), None) is not None
+                       for member in members)
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._data.get(key, {}))
+
+    # ---- streams ----------------------------------------------------------------------------------------------------
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        with self._lock:
+            stream = self._data.setdefault(key, [])
+            entry_id = f"{len(stream) + 1}-0".encode()
+            stream.append((entry_id, fields))
+            if maxlen is not None and len(stream) > maxlen:
+                del stream[:len(stream) - maxlen]
+            return entry_id
+
+    def xlen(self, key):
+        with self._lock:
+            return len(self._data.get(key, []))
+
+    def xrange(self, key, min="-", max="+", count=None):
+        with self._lock:
+            entries = list(self._data.get(key, []))
+        return entries[:count] if count is not None else entries
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+    # ---- scripts ----------------------------------------------------------------------------------------------------
+
+    def register_script(self, script):
+        from utils.redis_utils import MARK_PROCESSED_SCRIPT
+
+        if script != MARK_PROCESSED_SCRIPT:
+            raise NotImplementedError("FakeRedis only implements the mark-processed script.")
+
+        def mark_processed(keys, args):
+            with self._lock:
+                added = 0
+                for first, last in zip(args[0::2], args[1::2]):
+                    for height in range(int(first), int(last) + 1):
+                        added += self.setbit(keys[0], height, 1) == 0
+                bounds = [int(value) for value in args]
+                if bounds:
+                    self.zadd(keys[1], {"min": min(bounds)}, lt=True)
+                    self.zadd(keys[1], {"max": max(bounds)}, gt=True)
+                return added
+
+        return mark_processed
+
+
+class _FakePipeline:
+    """Queues calls and runs them against the FakeRedis on `execute`."""
+
+    def __init__(self, redis_conn):
+        self._redis = redis_conn
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kwargs):
+            self._calls.append((getattr(self._redis, name), args, kwargs))
+            return self
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class FakeCursor:
+    """Records the rows the indexer writes; SELECTs return no rows."""
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = SimpleNamespace(encoding="UTF8")
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args):
+        return repr(tuple(args)).encode()
+
+    def execute(self, query, params=None):
+        text = query.decode() if isinstance(query, bytes) else query
+        if "INSERT INTO blocks" in text and "staging" not in text:
+            self.database.block_rows += 1
+        self.rowcount = 1
+
+    def copy_expert(self, sql, buffer):
+        rows = sum(1 for _ in buffer)
+        if "staging_blocks" in sql:
+            self.database.block_rows += rows
+        elif "staging_transactions" in sql:
+            self.database.tx_rows += rows
+        else:
+            self.database.message_rows += rows
+
+    def fetchall(self):
+        return []
+
+
+class FakeDatabase:
+    """Stand-in for the PostgreSQL pool; `commit_delay` seconds are slept per commit."""
+
+    def __init__(self, commit_delay: float = 0.0):
+        self.commit_delay = commit_delay
+        self.block_rows = 0
+        self.tx_rows = 0
+        self.message_rows = 0  # messages and address_txs rows
+
+    @contextmanager
+    def connection(self):
+        database = self
+        yield SimpleNamespace(
+            closed=0,
+            cursor=lambda: FakeCursor(database),
+            commit=lambda: time.sleep(database.commit_delay) if database.commit_delay else None,
+            rollback=lambda: None,
+            get_transaction_status=lambda: 0,
+        )
+
+    def install(self) -> None:
+        """Route every pooled-connection request in `utils.db_utils` to this fake; direct connections fail."""
+        import utils.db_utils
+        import utils.schema_utils
+        utils.db_utils.get_db_connection = self.connection
+        utils.schema_utils.connect_to_db = lambda: None  # Advisory-lock sessions for secondary index deferral
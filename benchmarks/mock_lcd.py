@@ -0,0 +1,214 @@
+"""
+********************************************************************************
+mock_lcd.py -- Mock Tendermint LCD Server
+
+Serves synthetic `/cosmos/base/tendermint/v1beta1/blocks/{height}` and
+`/blocks/latest` responses so the indexer can be benchmarked without touching
+live endpoints. The chain tip advances every `block_time` seconds, and every
+response can be delayed and/or failed to mimic a loaded or throttling node.
+Transactions are protobuf-encoded Cosmos SDK `TxRaw`s carrying one MsgSend
+between addresses from a fixed pool, padded to `tx_size` bytes.
+
+Usage:
+    python3 -m benchmarks.mock_lcd --port 1317 --txs 50 --latency 0.05 --error-rate 0.01
+
+Developed by: Don Fox
+Date: 07/02/2024
+********************************************************************************
+"""
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK_PATH = re.compile(r"^/cosmos/base/tendermint/v1beta1/blocks/(latest|\d+)$")
+GENESIS_TIME = 1_720_000_000  # Synthetic chain start (POSIX seconds)
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+_address_rng = random.Random("addresses")
+ADDRESSES = ["cosmos1" + "".join(_address_rng.choice(BECH32_CHARSET) for _ in range(38)) for _ in range(1000)]
+
+
+def _b64(rng: random.Random, size: int) -> str:
+    return base64.b64encode(rng.randbytes(size)).decode()
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    """Encode a length-delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def make_tx(rng: random.Random, size: int) -> str:
+    """Build a base64 `TxRaw` holding one MsgSend, padded with random auth info to about `size` bytes."""
+    msg_send = (_field(1, rng.choice(ADDRESSES).encode()) + _field(2, rng.choice(ADDRESSES).encode())
+                + _field(3, _field(1, b"uatom") + _field(2, str(rng.randrange(1, 10 ** 9)).encode())))
+    body = _field(1, _field(1, b"/cosmos.bank.v1beta1.MsgSend") + _field(2, msg_send))
+    auth_info = rng.randbytes(max(0, size - len(body) - 72))
+    return base64.b64encode(_field(1, body) + _field(2, auth_info) + _field(3, rng.randbytes(64))).decode()
+
+
+def block_hash(height: int) -> str:
+    """Deterministic synthetic block hash for a height."""
+    return _b64(random.Random(f"hash-{height}"), 32)
+
+
+def make_block(height: int, num_txs: int, num_signatures: int = 125, tx_size: int = 600,
+               block_time: float = 6.0) -> bytes:
+    """Build a deterministic synthetic LCD block response for `height`."""
+    rng = random.Random(height)
+    timestamp = GENESIS_TIME + height * block_time
+    seconds = int(timestamp)
+    nanos = int((timestamp - seconds) * 1e9)
+    rfc3339 = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{nanos:09d}Z"
+    block = {
+        "block_id": {"hash": block_hash(height), "part_set_header": {"total": 1, "hash": _b64(rng, 32)}},
+        "block": {
+            "header": {"chain_id": "mock-1", "height": str(height), "time": rfc3339,
+                       "last_block_id": {"hash": block_hash(height - 1)},
+                       "proposer_address": _b64(rng, 20)},
+            "data": {"txs": [make_tx(rng, tx_size) for _ in range(num_txs)]},
+            "evidence": {"evidence": []},
+            "last_commit": {"height": str(height - 1), "round": 0, "signatures": [{
+                "block_id_flag": "BLOCK_ID_FLAG_COMMIT",
+                "validator_address": _b64(rng, 20),
+                "timestamp": rfc3339,
+                "signature": _b64(rng, 64),
+            } for _ in range(num_signatures)]},
+        },
+    }
+    return json.dumps(block).encode("utf-8")
+
+
+class MockChain:
+    """
+    Synthetic chain state shared by the request handlers.
+
+    Args:
+        start_height (int): Tip height when the server starts.
+        block_time (float): Seconds between new blocks (0 freezes the tip).
+        txs (int): Transactions per block.
+        latency (float): Mean artificial response delay in seconds.
+        jitter (float): Uniform +/- jitter applied to the latency, in seconds.
+        error_rate (float): Fraction of requests answered with 429/503.
+    """
+
+    def __init__(self, start_height: int = 1_000_000, block_time: float = 6.0, txs: int = 50,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.start_height = start_height
+        self.block_time = block_time
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.render = lru_cache(maxsize=4096)(lambda height: make_block(height, txs, block_time=block_time or 6.0))
+
+    def tip(self) -> int:
+        if not self.block_time:
+            return self.start_height
+        return self.start_height + int((time.monotonic() - self.started) / self.block_time)
+
+    def draw(self) -> tuple:
+        """Return (delay, error_status) for the next request."""
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            status = None
+            if self._rng.random() < self.error_rate:
+                self.errors += 1
+                status = self._rng.choice((429, 503))
+        return delay, status
+
+
+def _make_handler(chain: MockChain):
+
+    class MockLCDHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like a real LCD behind a proxy
+
+        def _reply(self, status: int, body: bytes, headers: dict = None) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            match = BLOCK_PATH.match(self.path)
+            if not match:
+                self._reply(404, b'{"code":5,"message":"Not Implemented"}')
+                return
+
+            delay, error_status = chain.draw()
+            if delay:
+                time.sleep(delay)
+            if error_status:
+                self._reply(error_status, b'{"code":8,"message":"throttled"}', {"Retry-After": "0"})
+                return
+
+            tip = chain.tip()
+            height = tip if match.group(1) == "latest" else int(match.group(1))
+            if height > tip or height < 1:
+                self._reply(400, b'{"code":3,"message":"requested block height is bigger then the chain length"}')
+                return
+            self._reply(200, chain.render(height))
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockLCDHandler
+
+
+class _MockLCDServer(ThreadingHTTPServer):
+    request_queue_size = 1024  # The default backlog of 5 drops SYNs under concurrent clients
+    daemon_threads = True
+
+
+def start_mock_lcd(chain: MockChain, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Start the mock LCD server on a daemon thread; `server.server_address` gives the bound port."""
+    server = _MockLCDServer((host, port), _make_handler(chain))
+    threading.Thread(target=server.serve_forever, name="mock-lcd", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1317)
+    parser.add_argument("--start-height", type=int, default=1_000_000)
+    parser.add_argument("--block-time", type=float, default=6.0)
+    parser.add_argument("--txs", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    chain = MockChain(args.start_height, args.block_time, args.txs, args.latency, args.jitter, args.error_rate)
+    server = start_mock_lcd(chain, args.host, args.port)
+    print(f"Mock LCD serving on http://{args.host}:{server.server_address[1]} (tip {chain.tip()})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+********************************************************************************
+throughput_benchmark.py -- Indexer Throughput Benchmark
+
+Runs the indexer's backfill or follow path against the mock LCD server in
+`benchmarks/mock_lcd.py` and reports blocks/sec, p50/p99 latency per stage
+(fetch, DB and Redis operations, from the indexer's own histograms) and peak
+RSS. Results can be appended to a JSON lines file, tagged with the current git
+commit, to compare changes across commits.
+
+By default the run uses the Redis and PostgreSQL servers from config.py (so
+point DB_NAME at a scratch database); `--fake` swaps both for the in-process
+stand-ins in `benchmarks/fakes.py`.
+
+Usage:
+    python3 -m benchmarks.throughput_benchmark --scenario backfill --blocks 2000 --fake
+    python3 -m benchmarks.throughput_benchmark --scenario follow --blocks 50 --block-time 0.1 --fake
+
+Developed by: Don Fox
+Date: 07/02/2024
+********************************************************************************
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import time
+from collections import defaultdict
+
+from benchmarks.mock_lcd import MockChain, start_mock_lcd
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))] if ordered else 0.0
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _configure_environment(args, lcd_url: str) -> None:
+    """Point config.py at the mock LCD; must run before anything imports `config` or `utils`."""
+    os.environ["LCD_ENDPOINTS"] = lcd_url
+    os.environ["ARCHIVE_ENABLED"] = "false"
+    os.environ.setdefault("ENDPOINT_RATE_LIMIT", str(args.rate_limit))
+    os.environ.setdefault("ENDPOINT_BURST", str(max(1, int(args.rate_limit))))
+    os.environ.setdefault("FETCH_BACKOFF_BASE", "0.05")
+
+    import config
+    config.configure_logging()
+
+
+def _record_histograms() -> dict:
+    """Keep every raw observation made by the indexer's histograms, keyed by (metric, label)."""
+    from utils.metrics_utils import Histogram
+
+    samples = defaultdict(list)
+    observe = Histogram.observe
+
+    def recording_observe(self, value, **labels):
+        samples[(self.name, labels.get("operation") or labels.get("endpoint", ""))].append(value)
+        observe(self, value, **labels)
+
+    Histogram.observe = recording_observe
+    return samples
+
+
+def run(args) -> dict:
+    chain = MockChain(start_height=args.start_height,
+                      block_time=args.block_time if args.scenario == "follow" else 0,
+                      txs=args.txs, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    server = start_mock_lcd(chain)
+    _configure_environment(args, f"http://127.0.0.1:{server.server_address[1]}")
+
+    samples = _record_histograms()
+    from utils import backfill_missing_blocks, follow_chain, get_redis_connection
+
+    if args.fake:
+        from benchmarks.fakes import FakeRedis, FakeDatabase
+        redis_conn = FakeRedis()
+        FakeDatabase(commit_delay=args.db_latency).install()
+    else:
+        redis_conn = get_redis_connection()
+
+    start = time.monotonic()
+    if args.scenario == "backfill":
+        heights = list(range(args.start_height - args.blocks + 1, args.start_height + 1))
+        results = backfill_missing_blocks(heights, redis_conn, concurrency=args.concurrency, engine=args.engine)
+        indexed = len(results["succeeded"])
+    else:
+        indexed = follow_chain(redis_conn, max_blocks=args.blocks)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    peak_rss_kib = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "commit": _git_commit(),
+        "scenario": args.scenario,
+        "engine": args.engine,
+        "fake": args.fake,
+        "blocks": indexed,
+        "seconds": round(elapsed, 3),
+        "blocks_per_sec": round(indexed / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mib": round(peak_rss_kib / 1024, 1),
+        "mock_requests": chain.requests,
+        "mock_errors": chain.errors,
+        "stages": {
+            f"{name}[{label}]": {"count": len(values),
+                                 "p50_ms": round(_percentile(values, 50) * 1000, 2),
+                                 "p99_ms": round(_percentile(values, 99) * 1000, 2)}
+            for (name, label), values in sorted(samples.items())
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"commit {report['commit']}  scenario={report['scenario']}  engine={report['engine']}  "
+          f"fake={report['fake']}")
+    print(f"{report['blocks']} blocks in {report['seconds']}s = {report['blocks_per_sec']} blocks/sec, "
+          f"peak RSS {report['peak_rss_mib']} MiB, mock requests {report['mock_requests']} "
+          f"({report['mock_errors']} injected errors)")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<60} n={stats['count']:<7} p50={stats['p50_ms']:>8.2f}ms  p99={stats['p99_ms']:>8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("backfill", "follow"), default="backfill")
+    parser.add_argument("--engine", choices=("pipeline", "async"), default="pipeline")
+    parser.add_argument("--blocks", type=int, default=1000, help="Blocks to index")
+    parser.add_argument("--start-height", type=int, default=1_000_000, help="Chain tip at start")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--txs", type=int, default=50, help="Transactions per synthetic block")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock LCD mean latency (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Mock LCD latency jitter (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 429/503 responses")
+    parser.add_argument("--block-time", type=float, default=0.2, help="Follow scenario block time (seconds)")
+    parser.add_argument("--rate-limit", type=float, default=100000, help="Client rate limit (req/s)")
+    parser.add_argument("--fake", action="store_true", help="Use in-process Redis/PostgreSQL stand-ins")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="Fake per-commit delay (seconds)")
+    parser.add_argument("--json", help="Append the report to this JSON lines file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "a") as output:
+            output.write(json.dumps(report) + "\n")
+
+
+if __name__ == '__main__':
+    main()
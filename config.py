@@ -6,7 +6,8 @@ This script defines global settings for logging, database connection,
 Redis configuration, and API endpoints used by the blockchain extractor.
 
 Features:
-    - Configures logging for the entire application.
+    - Provides `configure_logging`, called by the entry points at startup, so
+      importing this module has no side effects.
     - Sets database and Redis connection details using environment variables or 
       defaults.
     - Defines URLs for fetching blockchain data from an API.
@@ -16,18 +17,26 @@ Date: 07/02/2024
 ********************************************************************************
 """
 import os
-import redis
 import logging
 
 BLOCK_FETCH_DELAY = 1  # Delay in seconds between block fetch attempts
 
-# Configure logging globally for the application
-logging.basicConfig(
-    filename='../logs/block_requests.log', 
-    filemode='a',
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
-    level=logging.INFO
-)
+# Logging Settings
+LOG_FILE = os.getenv("LOG_FILE", "../logs/block_requests.log")  # "-" logs to stderr
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+
+def configure_logging(log_file: str = LOG_FILE, level: str = LOG_LEVEL) -> None:
+    """Configure logging globally for the application; call once at startup."""
+    handler_options = {}  # basicConfig logs to stderr by default
+    if log_file != "-":
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        handler_options = {"filename": log_file, "filemode": 'a'}
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=getattr(logging, str(level).upper(), logging.INFO),
+        **handler_options
+    )
 
 # Database Configuration
 DB_CONFIG = {
@@ -39,6 +48,43 @@ DB_CONFIG = {
     
 }
 
+# Metrics Settings
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))  # 0 binds a free port (logged at startup)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"  # Exposes /debug/profile
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0.01))  # Seconds between stack samples
+
+# Database Connection Pool Settings
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+DB_POOL_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", 30))  # Idle seconds before re-checking a connection
+
+# Schema Settings
+SCHEMA_AUTO_MIGRATE = os.getenv("SCHEMA_AUTO_MIGRATE", "true").lower() == "true"  # Apply migrations at startup
+PARTITION_SIZE = int(os.getenv("PARTITION_SIZE", 1_000_000))  # Block heights per blocks/transactions partition
+DEFER_INDEXES_MIN_BLOCKS = int(os.getenv("DEFER_INDEXES_MIN_BLOCKS", 100_000))  # Rebuild indexes after larger backfills
+
+# Message Index Settings (decoded Cosmos SDK messages and the addresses they touch)
+MESSAGE_INDEX_ENABLED = os.getenv("MESSAGE_INDEX_ENABLED", "true").lower() == "true"
+
+# Changefeed Settings (Redis Stream of committed blocks)
+CHANGEFEED_ENABLED = os.getenv("CHANGEFEED_ENABLED", "true").lower() == "true"
+CHANGEFEED_STREAM = os.getenv("CHANGEFEED_STREAM", "blocks_changefeed")
+CHANGEFEED_MAXLEN = int(os.getenv("CHANGEFEED_MAXLEN", 100_000))  # Approximate cap on stream entries
+CHANGEFEED_INCLUDE_TXS = os.getenv("CHANGEFEED_INCLUDE_TXS", "true").lower() == "true"  # Include tx hashes
+CHANGEFEED_PENDING_GRACE = float(os.getenv("CHANGEFEED_PENDING_GRACE", 60))  # Seconds before an unpublished commit is re-published
+
+# Query API Settings
+QUERY_API_ENABLED = os.getenv("QUERY_API_ENABLED", "false").lower() == "true"  # Serve the query API from main.py
+QUERY_API_HOST = os.getenv("QUERY_API_HOST", "127.0.0.1")
+QUERY_API_PORT = int(os.getenv("QUERY_API_PORT", 8080))
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", 100))  # Default rows per page
+QUERY_MAX_PAGE_SIZE = int(os.getenv("QUERY_MAX_PAGE_SIZE", 1000))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 10_000))  # Cached block / tx-page entries
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 30))  # Seconds a cached entry stays valid
+QUERY_CACHE_MISS_TTL = float(os.getenv("QUERY_CACHE_MISS_TTL", 1))  # Seconds a "not indexed yet" answer is cached
+
 # Redis Configuration
 REDIS_CONFIG = {
     "host": os.getenv("REDIS_HOST", 'localhost'),
@@ -52,5 +98,75 @@ LATEST_BLOCK_URL = \
 BLOCK_CHAIN_URL_TEMPLATE = \
  "http://116.202.143.93:1317/cosmos/base/tendermint/v1beta1/blocks/{}"
 
+# Equivalent LCD endpoints used by the fetch client (comma-separated base URLs)
+LCD_ENDPOINTS = [url.strip().rstrip("/") for url in os.getenv(
+    "LCD_ENDPOINTS", "https://migaloo-api.polkachu.com,http://116.202.143.93:1317").split(",") if url.strip()]
+BLOCK_PATH_TEMPLATE = "/cosmos/base/tendermint/v1beta1/blocks/{}"
+
+# Fetch Client Settings
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 32))  # Keep-alive connections per endpoint
+ENDPOINT_RATE_LIMIT = float(os.getenv("ENDPOINT_RATE_LIMIT", 20))  # Requests per second per endpoint
+ENDPOINT_BURST = int(os.getenv("ENDPOINT_BURST", 40))  # Token bucket capacity per endpoint
+FETCH_MAX_RETRIES = int(os.getenv("FETCH_MAX_RETRIES", 3))
+FETCH_BACKOFF_BASE = float(os.getenv("FETCH_BACKOFF_BASE", 0.5))  # Seconds, doubled per attempt
+FETCH_BACKOFF_MAX = float(os.getenv("FETCH_BACKOFF_MAX", 30))  # Seconds
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))  # Hedge once the primary is slower than this
+
 # Application Settings
-NUM_BLOCKS_TO_FETCH = int(os.getenv("NUM_BLOCKS_TO_FETCH", 6))
\ No newline at end of file
+NUM_BLOCKS_TO_FETCH = int(os.getenv("NUM_BLOCKS_TO_FETCH", 6))
+FETCH_TIMEOUT = int(os.getenv("FETCH_TIMEOUT", 12))  # Seconds per block request
+
+# Raw Block Archive Settings
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "true").lower() == "true"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "../block_archive")
+ARCHIVE_SEGMENT_MAX_BYTES = int(os.getenv("ARCHIVE_SEGMENT_MAX_BYTES", 256 * 1024 * 1024))
+
+# Follow Mode Settings
+FOLLOW_MIN_POLL_INTERVAL = float(os.getenv("FOLLOW_MIN_POLL_INTERVAL", 0.5))  # Seconds
+FOLLOW_MAX_POLL_INTERVAL = float(os.getenv("FOLLOW_MAX_POLL_INTERVAL", 30))  # Seconds
+FOLLOW_MAX_CATCHUP = int(os.getenv("FOLLOW_MAX_CATCHUP", 500))  # Max heights fetched per follow iteration
+FOLLOW_RETRY_ATTEMPTS = int(os.getenv("FOLLOW_RETRY_ATTEMPTS", 3))  # Polls a failed height is retried on
+
+# Backfill Settings
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", 16))  # Max in-flight block requests
+BULK_LOAD_ENABLED = os.getenv("BULK_LOAD_ENABLED", "true").lower() == "true"  # COPY-based loading during backfill
+BULK_LOAD_MAX_BLOCKS = int(os.getenv("BULK_LOAD_MAX_BLOCKS", 500))  # Blocks per bulk load flush
+BULK_LOAD_WINDOW = float(os.getenv("BULK_LOAD_WINDOW", 5))  # Max seconds a block waits in the bulk load buffer
+BACKFILL_ENGINE = os.getenv("BACKFILL_ENGINE", "pipeline")  # "pipeline" (staged, bulk loaded) or "async"
+
+# Chain Verification Settings
+VERIFY_ENABLED = os.getenv("VERIFY_ENABLED", "true").lower() == "true"  # Verify new heights after each backfill
+VERIFY_CHUNK_SIZE = int(os.getenv("VERIFY_CHUNK_SIZE", 50_000))  # Heights per verification query
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", 4))  # Chunks verified in parallel
+
+# Parquet Export Settings (incremental columnar copies for analytics; needs pyarrow)
+EXPORT_ENABLED = os.getenv("EXPORT_ENABLED", "false").lower() == "true"  # Export new heights after each run
+EXPORT_DIR = os.getenv("EXPORT_DIR", "../block_export")
+EXPORT_BUCKET_SIZE = int(os.getenv("EXPORT_BUCKET_SIZE", 100_000))  # Block heights per bucket directory
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 50_000))  # Heights read and written per export step
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "zstd")
+EXPORT_COMPACT_MIN_FILES = int(os.getenv("EXPORT_COMPACT_MIN_FILES", 8))  # Part files before a bucket is merged
+
+# Sharded Backfill Settings (several indexer processes sharing one backfill through Redis)
+SHARDED_BACKFILL = os.getenv("SHARDED_BACKFILL", "false").lower() == "true"
+SHARD_RANGE_SIZE = int(os.getenv("SHARD_RANGE_SIZE", 10_000))  # Heights per leased range
+SHARD_CHUNK_SIZE = int(os.getenv("SHARD_CHUNK_SIZE", 1_000))  # Heights backfilled between checkpoints
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", 60))  # Seconds a lease survives without a heartbeat
+
+# Adaptive Control Settings (feedback-tuned fetch concurrency and bulk-load batch size)
+ADAPTIVE_CONTROL_ENABLED = os.getenv("ADAPTIVE_CONTROL_ENABLED", "true").lower() == "true"
+CONTROL_WINDOW = float(os.getenv("CONTROL_WINDOW", 1.0))  # Seconds between concurrency adjustments
+FETCH_CONCURRENCY_MIN = int(os.getenv("FETCH_CONCURRENCY_MIN", 2))
+FETCH_CONCURRENCY_MAX = int(os.getenv("FETCH_CONCURRENCY_MAX", 128))
+FETCH_THROTTLE_TOLERANCE = float(os.getenv("FETCH_THROTTLE_TOLERANCE", 0.02))  # Tolerated 429/5xx fraction
+BULK_LOAD_BATCH_MIN = int(os.getenv("BULK_LOAD_BATCH_MIN", 50))
+BULK_LOAD_BATCH_MAX = int(os.getenv("BULK_LOAD_BATCH_MAX", 5000))
+BULK_LOAD_TARGET_SECONDS = float(os.getenv("BULK_LOAD_TARGET_SECONDS", 1.0))  # Desired duration of one flush
+
+# Backfill Pipeline Settings
+PIPELINE_FETCH_WORKERS = int(os.getenv("PIPELINE_FETCH_WORKERS", BACKFILL_CONCURRENCY))
+PIPELINE_TRANSFORM_WORKERS = int(os.getenv("PIPELINE_TRANSFORM_WORKERS", os.cpu_count() or 1))
+PIPELINE_LOAD_WORKERS = int(os.getenv("PIPELINE_LOAD_WORKERS", 2))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 1000))  # Capacity of each inter-stage queue
+PIPELINE_REPORT_INTERVAL = float(os.getenv("PIPELINE_REPORT_INTERVAL", 10))  # Seconds between stage reports
\ No newline at end of file
@@ -2,74 +2,236 @@
 ********************************************************************************
 main.py -- RESTful_BLOCK_EXTRACTOR
 
-This script extracts blockchain blocks from an online API and stores 
-them in a database. It performs the following functionalities:
-    - Initially performs a comprehensive gap check, filling in missing blocks.
-    - Handles error cases and retry mechanisms during the process.
+This script extracts blockchain blocks from an online API and stores
+them in a database. Each subcommand does one job and imports only what that
+job needs, so scheduled and restarted runs start quickly:
+
+    python main.py backfill [--from H --to H]   fill gaps (or an explicit height range)
+    python main.py follow [--max-blocks N]      follow the chain tip
+    python main.py verify [--end H]             verify last_block_id links, refetch broken blocks
+    python main.py replay [--from H --to H]     re-index blocks from the local raw block archive
+    python main.py export [--end H]             export new heights to Parquet files
+    python main.py run                          one full cycle (the default without a subcommand):
+                                                gap fill, verify, export, then NUM_BLOCKS_TO_FETCH
+                                                latest blocks
 
-Configuration:
-    - local_block_repository: Path to the local directory for storing blocks 
-        (if enabled).
-    - latest_block_uri: URL for fetching the latest block.
+Features:
+    - Applies the versioned, height-partitioned database schema before writing.
+    - Optionally shares backfills with other indexer processes through Redis.
+    - Handles error cases and retry mechanisms during the process.
+    - Optionally serves the read-side query API (blocks, transactions) over HTTP.
+    - Serves Prometheus metrics (and an opt-in sampling profiler) over HTTP for
+      the long-running subcommands.
+    - Logging is configured at startup (--log-file / LOG_FILE, "-" for stderr).
 
 Developed by: Don Fox
 Date: 07/02/2024
 ********************************************************************************
 """
-from pycallgraph2 import PyCallGraph
-from pycallgraph2.output import GraphvizOutput
-
-import sys
-sys.stdout.reconfigure(line_buffering=True)
+import argparse
 import logging
+import sys
 import config
 
-from utils import detect_missing_blocks, request_missing_blocks,\
-                  get_redis_connection, extract_current_blocks
-from redis import Redis
 
-def detect_and_fetch_missing_blocks(redis_conn: Redis) -> None:
-    """Fix gaps detected in collected blockchain blocks."""
+def detect_and_fetch_missing_blocks(redis_conn) -> bool:
+    """Fix gaps detected in collected blockchain blocks; returns False if any height still failed."""
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from utils import detect_missing_blocks
+
     try:
         missing_blocks = detect_missing_blocks(redis_conn)
         if not missing_blocks:
             logging.info("No missing blocks detected.")
-            return
-        logging.info(f"Missing Blocks: {missing_blocks}")
-        request_missing_blocks(missing_blocks, redis_conn)
-        logging.info(f"Fetched missing blocks: {missing_blocks}")
+            return True
+        logging.info(f"Missing block ranges: {missing_blocks}")
+        return backfill_ranges(redis_conn, missing_blocks)
 
-    except Redis.ConnectionError as conn_err:
+    except RedisConnectionError as conn_err:
         logging.error(f"Redis connection error: {conn_err}")
     except KeyError as key_err:
         logging.error(f"Key error while processing missing blocks: {key_err}")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
+    return False
+
+
+def backfill_ranges(redis_conn, ranges: list[tuple[int, int]], replace: bool = False) -> bool:
+    """
+    Backfill inclusive height ranges, shared through Redis when SHARDED_BACKFILL is on.
+
+    With `replace` the heights are re-fetched from the API and overwritten in this process,
+    whether or not they are already indexed.
+    """
+    from utils import request_missing_blocks, run_sharded_backfill, backfill_missing_blocks, expand_ranges
+
+    if replace:
+        results = backfill_missing_blocks(expand_ranges(ranges), redis_conn, replace=True)
+        logging.info(f"Re-indexed block ranges: {ranges} ({len(results['failed'])} heights failed)")
+        return not results["failed"]
+    if config.SHARDED_BACKFILL:
+        return not run_sharded_backfill(redis_conn, ranges)["failed"]
+    results = request_missing_blocks(ranges, redis_conn)
+    logging.info(f"Fetched missing block ranges: {ranges} ({len(results['failed'])} heights failed)")
+    return not results["failed"]
 
 
-def main():
+def verify_and_repair(redis_conn, end: int = None, refetch: bool = True) -> bool:
+    """Verify the stored chain and refetch broken blocks; returns False if links are still broken."""
+    from utils import verify_chain, refetch_queued_blocks
+
+    totals = verify_chain(redis_conn, end=end)
+    if totals is None:
+        return False
+    if not refetch:
+        return not totals["mismatches"]
+    return not refetch_queued_blocks(redis_conn)["still_broken"]
+
+
+def export_new_heights(redis_conn=None, end: int = None, compact: bool = True) -> bool:
+    """Export heights above the Parquet high-water mark (only verified ones when verification is on)."""
+    from utils import export_incremental, compact_exports, get_verified_height
+
+    if end is None and config.VERIFY_ENABLED and redis_conn is not None:
+        end = get_verified_height(redis_conn)
+        if end is None:
+            logging.info("Chain not verified yet; nothing to export.")
+            return True
+    if export_incremental(end=end) is None:
+        return False
+    return not compact or compact_exports() >= 0
+
+
+# ---- subcommands ----------------------------------------------------------------------------------------------------
+
+def run_cycle(args, redis_conn) -> bool:
     """
-    Initialize Redis connection fixes gaps in collected blocks, then extracts 
-    the latest blockchain blocks.
+    Reconcile Redis with Postgres, fix gaps in collected blocks, verify and export,
+    then extract the latest blockchain blocks.
     """
+    from utils import reconcile_processed_heights, extract_current_blocks
+
+    reconcile_processed_heights(redis_conn)
+    ok = detect_and_fetch_missing_blocks(redis_conn)
+    if config.VERIFY_ENABLED:
+        ok = verify_and_repair(redis_conn) and ok
+    if config.EXPORT_ENABLED:
+        ok = export_new_heights(redis_conn) and ok
+    extract_current_blocks(redis_conn)
+    return ok
+
+
+def run_backfill(args, redis_conn) -> bool:
+    from utils import reconcile_processed_heights, get_unprocessed_heights, compress_heights
+
+    if args.start is None and args.end is None:
+        reconcile_processed_heights(redis_conn)
+        return detect_and_fetch_missing_blocks(redis_conn)
+
+    if args.start is None or args.end is None or args.start > args.end:
+        logging.error("backfill needs both --from and --to, with --from <= --to.")
+        return False
+    if args.force:
+        return backfill_ranges(redis_conn, [(args.start, args.end)], replace=True)
+    heights = get_unprocessed_heights(redis_conn, args.start, args.end)
+    if not heights:
+        logging.info(f"Heights {args.start}-{args.end} are already indexed.")
+        return True
+    return backfill_ranges(redis_conn, compress_heights(heights))
+
+
+def run_follow(args, redis_conn) -> bool:
+    from utils import follow_chain
+
+    follow_chain(redis_conn, max_blocks=args.max_blocks)
+    return True
+
+
+def run_verify(args, redis_conn) -> bool:
+    return verify_and_repair(redis_conn, end=args.end, refetch=not args.no_refetch)
+
+
+def run_replay(args, redis_conn) -> bool:
+    from utils import replay_archive
+
+    return not replay_archive(redis_conn, start=args.start, end=args.end)["failed"]
+
+
+def run_export(args, redis_conn) -> bool:
+    return export_new_heights(redis_conn, end=args.end, compact=not args.no_compact)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Index Cosmos blocks into PostgreSQL.")
+    parser.add_argument("--log-file", default=config.LOG_FILE, help='Log file, or "-" for stderr')
+    parser.add_argument("--log-level", default=config.LOG_LEVEL)
+    subcommands = parser.add_subparsers(dest="command")
+
+    # Each subcommand records what it needs: schema migrations, metrics/query servers
+    run = subcommands.add_parser("run", help="One full cycle: gap fill, verify, export, latest blocks")
+    run.set_defaults(handler=run_cycle, migrate=True, serve=True)
+
+    backfill = subcommands.add_parser("backfill", help="Fill gaps, or index an explicit height range")
+    backfill.add_argument("--from", dest="start", type=int, help="First height of the range")
+    backfill.add_argument("--to", dest="end", type=int, help="Last height of the range (inclusive)")
+    backfill.add_argument("--force", action="store_true", help="Re-fetch and overwrite heights that are already indexed")
+    backfill.set_defaults(handler=run_backfill, migrate=True, serve=True)
+
+    follow = subcommands.add_parser("follow", help="Follow the chain tip")
+    follow.add_argument("--max-blocks", type=int, help="Stop after indexing this many blocks")
+    follow.set_defaults(handler=run_follow, migrate=True, serve=True)
+
+    verify = subcommands.add_parser("verify", help="Verify stored last_block_id links")
+    verify.add_argument("--end", type=int, help="Last height to verify")
+    verify.add_argument("--no-refetch", action="store_true", help="Only report broken links")
+    verify.set_defaults(handler=run_verify, migrate=True, serve=False)
+
+    replay = subcommands.add_parser("replay", help="Re-index blocks from the raw block archive")
+    replay.add_argument("--from", dest="start", type=int, default=0, help="First height to replay")
+    replay.add_argument("--to", dest="end", type=int, help="Last height to replay (inclusive)")
+    replay.set_defaults(handler=run_replay, migrate=True, serve=False)
+
+    export = subcommands.add_parser("export", help="Export new heights to Parquet files")
+    export.add_argument("--end", type=int, help="Last height to export")
+    export.add_argument("--no-compact", action="store_true", help="Skip merging small part files")
+    export.set_defaults(handler=run_export, migrate=False, serve=False)
+
+    parser.set_defaults(handler=run_cycle, migrate=True, serve=True)  # No subcommand: the classic full cycle
+    return parser
+
+
+def main(argv: list[str] = None) -> int:
+    """Parse the command line, configure logging and connections, and run the requested subcommand."""
+    args = build_parser().parse_args(argv)
+    config.configure_logging(args.log_file, args.log_level)
+    sys.stdout.reconfigure(line_buffering=True)
+
     try:
+        if args.serve and config.METRICS_ENABLED:
+            from utils import start_metrics_server
+            start_metrics_server()
+        if args.migrate and config.SCHEMA_AUTO_MIGRATE:
+            from utils import ensure_schema
+            if ensure_schema() < 0:
+                logging.error("Database schema is not up to date; stopping.")
+                return 1
+        if args.serve and config.QUERY_API_ENABLED:
+            from utils import start_query_server
+            start_query_server()
+
+        from utils import get_redis_connection
         redis_conn = get_redis_connection()
-        detect_and_fetch_missing_blocks(redis_conn)
-        extract_current_blocks(redis_conn)
+        if args.migrate and config.CHANGEFEED_ENABLED:
+            from utils import republish_pending
+            republish_pending(redis_conn)  # Blocks a previous run committed but never published
+        return 0 if args.handler(args, redis_conn) else 1
     except Exception as e:
         logging.error(f"Error in main processing: {e}")
+        return 1
 
 
 if __name__ == '__main__':
-   
-    main()
-
-    # Generates graph of applications function calls.
-    # graphviz = GraphvizOutput()
-    # graphviz.output_file = 'call_graph.png'
-    #
-    # with PyCallGraph(output=graphviz):
-    #     main()
-
-
 
+    # Hot paths can be profiled in place with PROFILER_ENABLED=true and
+    # GET /debug/profile?seconds=N on the metrics endpoint.
+    sys.exit(main())
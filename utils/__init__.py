@@ -1,20 +1,181 @@
 # utils/__init__.py
+#
+# Every name below is imported from its module on first use (PEP 562), so `from utils import verify_chain` loads
+# verify_utils and its own dependencies only. block_utils and fetch_utils import the HTTP clients, the bulk loader and
+# the backfill pipeline inside the functions that use them, so e.g. `replay` never loads requests, aiohttp or
+# multiprocessing, and `follow` loads aiohttp only with the async backfill engine. Redis and psycopg2 are always loaded.
+import importlib
 
-# Expose functions from block_utils
-from .block_utils import fetch_block,\
-						 parse_and_store_block,\
-						 detect_missing_blocks,\
-						 request_missing_blocks,\
-						 process_block,\
-						 extract_current_blocks
+_EXPORTS = {
+    # Expose functions from block_utils
+    "block_utils": (
+        "parse_and_store_block",
+        "detect_missing_blocks",
+        "request_missing_blocks",
+        "backfill_missing_blocks",
+        "process_block",
+        "extract_block_fields",
+        "mark_block_processed",
+        "reconcile_processed_heights",
+        "extract_current_blocks",
+        "follow_chain",
+        "fetch_block_at_height",
+        "replay_archive",
+    ),
+    # Expose functions from db_utils
+    "db_utils": (
+        "connect_to_db",
+        "close_db_connection",
+        "get_db_pool",
+        "close_db_pool",
+        "get_db_connection",
+        "db_transaction",
+        "perform_db_query",
+    ),
+    # Expose the versioned schema from schema_utils
+    "schema_utils": (
+        "ensure_schema",
+        "ensure_partitions",
+        "build_secondary_indexes",
+        "drop_secondary_indexes",
+        "deferred_secondary_indexes",
+        "hold_secondary_indexes",
+    ),
+    # Expose the shared, lease-based backfill from shard_utils
+    "shard_utils": (
+        "BackfillWorker",
+        "plan_sharded_backfill",
+        "run_sharded_backfill",
+        "get_backfill_progress",
+        "split_ranges",
+    ),
+    # Expose the adaptive concurrency and batch-size controllers from control_utils
+    "control_utils": (
+        "AdaptiveConcurrencyLimit",
+        "AdaptiveBatchSize",
+        "get_bulk_batch_size",
+        "get_control_settings",
+    ),
+    # Expose the read-side query API from api_utils and its cache from cache_utils
+    "api_utils": (
+        "QueryAPI",
+        "create_query_app",
+        "run_query_server",
+        "start_query_server",
+    ),
+    "cache_utils": (
+        "QueryCache",
+        "get_query_cache",
+        "invalidate_blocks",
+    ),
+    # Expose the chain-integrity verifier from verify_utils
+    "verify_utils": (
+        "verify_chain",
+        "verify_range",
+        "get_verified_height",
+        "queue_refetch",
+        "get_refetch_queue",
+        "repair_block",
+        "refetch_queued_blocks",
+    ),
+    # Expose the Parquet export from export_utils
+    "export_utils": (
+        "export_incremental",
+        "compact_exports",
+        "get_export_state",
+        "export_available",
+    ),
+    # Expose the Redis Stream changefeed from stream_utils
+    "stream_utils": (
+        "ChangefeedPublisher",
+        "get_changefeed",
+        "republish_pending",
+        "create_consumer_group",
+        "read_changefeed",
+        "ack_changefeed",
+        "replay_changefeed",
+        "tail_changefeed",
+    ),
+    # Expose the fetch client from fetch_utils
+    "fetch_utils": (
+        "FetchClient",
+        "get_fetch_client",
+    ),
+    # Expose the raw block archive from archive_utils
+    "archive_utils": (
+        "BlockArchive",
+        "get_block_archive",
+    ),
+    # Expose the bulk loader from load_utils
+    "load_utils": (
+        "BulkBlockLoader",
+        "insert_messages",
+    ),
+    # Expose selective block decoding from decode_utils
+    "decode_utils": (
+        "BlockRecord",
+        "decode_block",
+        "decode_block_at",
+    ),
+    # Expose block transformation helpers from transform_utils
+    "transform_utils": (
+        "decode_tx",
+        "compute_tx_hash",
+        "transform_block",
+        "decode_messages",
+        "message_rows",
+    ),
+    # Expose Cosmos SDK message decoding from cosmos_utils
+    "cosmos_utils": (
+        "decode_tx_messages",
+        "message_addresses",
+    ),
+    # Expose the backfill pipeline from pipeline_utils
+    "pipeline_utils": (
+        "BlockPipeline",
+        "StageStats",
+    ),
+    # Expose the metrics registry and endpoint from metrics_utils
+    "metrics_utils": (
+        "Counter",
+        "Gauge",
+        "Histogram",
+        "render_metrics",
+        "sample_stacks",
+        "start_metrics_server",
+    ),
+    # Expose functions from redis_utils
+    "redis_utils": (
+        "get_redis_connection",
+        "store_missing_blocks",
+        "get_missing_blocks",
+        "clear_missing_blocks",
+        "mark_heights_processed",
+        "mark_ranges_processed",
+        "is_height_processed",
+        "get_processed_bounds",
+        "get_unprocessed_heights",
+        "migrate_processed_set",
+        "find_gap_ranges",
+        "expand_ranges",
+        "compress_heights",
+        "get_index_cursor",
+        "set_index_cursor",
+    ),
+}
 
-# Expose functions from db_utils
-from .db_utils import connect_to_db,\
-					  close_db_connection,\
-					  perform_db_query
+_MODULE_OF = {name: module for module, names in _EXPORTS.items() for name in names}
+__all__ = sorted(_MODULE_OF)
 
-# Expose functions from redis_utils
-from .redis_utils import get_redis_connection,\
-						 store_missing_blocks, \
-						 get_missing_blocks,\
-						 clear_missing_blocks
\ No newline at end of file
+
+def __getattr__(name):
+    module = _MODULE_OF.get(name)
+    if module is None:
+        raise AttributeError(f"module 'utils' has no attribute '{name}'")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value  # Later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | _MODULE_OF.keys())
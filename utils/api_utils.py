@@ -0,0 +1,373 @@
+########################################################################################################################
+# api_utils.py
+#
+# Read-side HTTP query API over the indexed blocks and transactions.
+#
+# Endpoints (JSON):
+#     GET /blocks?after=H&limit=N | ?before=H&limit=N    block listing, keyset-paginated by height
+#     GET /blocks/{height}                                one block and its transaction count
+#     GET /blocks/hash/{block_hash}                       one block by hash
+#     GET /blocks/{height}/txs?after=TX_HASH&limit=N      transactions of a block, keyset-paginated by tx hash
+#     GET /txs/{tx_hash}                                  one transaction
+#     GET /addresses/{address}/txs?before=H:TX&limit=N    transactions touching an address, newest first
+#     GET /messages?type=TYPE_URL&before=H:TX:I&limit=N   messages of one type, newest first
+#     GET /health
+#
+# Features:
+#     - aiohttp server, so slow clients and many concurrent readers do not block each other; queries run on the
+#       pooled `db_utils` connections in a bounded thread pool.
+#     - Keyset pagination everywhere: each page returns a `next` cursor and the query seeks straight to it on the
+#       (partitioned) primary key instead of counting past an OFFSET.
+#     - Address and message-type listings are index seeks on the `address_txs` primary key and the covering
+#       `messages_type_url_idx`, answered without visiting the tables.
+#     - Block and per-block transaction lookups are cached in `cache_utils.QueryCache` (LRU + TTL). The ingestion
+#       path invalidates it when blocks are committed in the same process; with CHANGEFEED_ENABLED the API also
+#       tails the changefeed and invalidates every published block, so a standalone API process sees commits made
+#       by other indexer processes. Invalidation is best-effort; QUERY_CACHE_TTL (and the much shorter
+#       QUERY_CACHE_MISS_TTL for "not indexed yet" answers) bounds staleness when an invalidation is missed.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from .db_utils import perform_db_query
+from .cache_utils import get_query_cache
+from .stream_utils import tail_changefeed
+from .schema_utils import hold_secondary_indexes
+from .metrics_utils import Histogram
+from config import QUERY_API_HOST, \
+                   QUERY_API_PORT, \
+                   QUERY_PAGE_SIZE, \
+                   QUERY_MAX_PAGE_SIZE, \
+                   DB_POOL_MAX_SIZE, \
+                   CHANGEFEED_ENABLED
+
+QUERY_SECONDS = Histogram("indexer_query_api_seconds", "Query API request duration.", ("route",))
+
+_NOT_FOUND = object()  # Cached marker for a height that is not indexed yet
+
+
+def _block_row(row) -> dict:
+    height, block_hash, timestamp, num_txs = row
+    return {
+        "height": height,
+        "hash": block_hash,
+        "time": timestamp.isoformat() if hasattr(timestamp, "isoformat") else timestamp,
+        "num_txs": num_txs,
+    }
+
+
+# ---- queries (blocking; run on the query executor) ------------------------------------------------------------------
+
+def query_block(height: int) -> dict:
+    """Return the block at `height`, or None if it is not indexed."""
+    rows = perform_db_query("""
+        SELECT b.block_height, b.block_hash, b.timestamp,
+               (SELECT COUNT(*) FROM transactions t WHERE t.block_id = b.block_height)
+        FROM blocks b WHERE b.block_height = %s
+    """, (height,))
+    if rows is None:
+        raise RuntimeError(f"Query for block {height} failed.")
+    return _block_row(rows[0]) if rows else None
+
+
+def query_block_height_by_hash(block_hash: str) -> int:
+    """Return the height of the block with `block_hash`, or None."""
+    rows = perform_db_query("SELECT block_height FROM blocks WHERE block_hash = %s", (block_hash,))
+    if rows is None:
+        raise RuntimeError("Query for block by hash failed.")
+    return rows[0][0] if rows else None
+
+
+def query_blocks(after: int = None, before: int = None, limit: int = QUERY_PAGE_SIZE) -> list[dict]:
+    """
+    List blocks in height order, starting after `after` (ascending) or before `before` (descending).
+
+    Returns:
+        list[dict]: Up to `limit` blocks.
+    """
+    if before is not None:
+        condition, order, params = "b.block_height < %s", "DESC", (before, limit)
+    else:
+        condition, order, params = "b.block_height > %s", "ASC", (-1 if after is None else after, limit)
+    rows = perform_db_query(f"""
+        SELECT b.block_height, b.block_hash, b.timestamp,
+               (SELECT COUNT(*) FROM transactions t WHERE t.block_id = b.block_height)
+        FROM blocks b WHERE {condition}
+        ORDER BY b.block_height {order} LIMIT %s
+    """, params)
+    if rows is None:
+        raise RuntimeError("Block listing query failed.")
+    return [_block_row(row) for row in rows]
+
+
+def query_block_transactions(height: int, after: str = None, limit: int = QUERY_PAGE_SIZE) -> list[str]:
+    """Return up to `limit` transaction hashes of the block at `height`, in hash order after `after`."""
+    rows = perform_db_query("""
+        SELECT tx_hash FROM transactions
+        WHERE block_id = %s AND tx_hash > %s
+        ORDER BY tx_hash LIMIT %s
+    """, (height, after or "", limit))
+    if rows is None:
+        raise RuntimeError(f"Transaction query for block {height} failed.")
+    return [tx_hash for (tx_hash,) in rows]
+
+
+def query_transaction(tx_hash: str) -> dict:
+    """Return the transaction with `tx_hash` and the height of its block, or None."""
+    rows = perform_db_query("SELECT tx_hash, block_id FROM transactions WHERE tx_hash = %s LIMIT 1",
+                            (tx_hash.upper(),))
+    if rows is None:
+        raise RuntimeError("Transaction query failed.")
+    return {"hash": rows[0][0], "height": rows[0][1]} if rows else None
+
+
+def query_address_transactions(address: str, before: tuple = None, limit: int = QUERY_PAGE_SIZE) -> list[dict]:
+    """
+    Return up to `limit` transactions touching `address`, newest first, starting below the
+    (height, tx_hash) cursor `before`.
+    """
+    before_height, before_tx = before or (2 ** 62, "")
+    rows = perform_db_query("""
+        SELECT block_id, tx_hash, array_agg(DISTINCT role)
+        FROM address_txs
+        WHERE address = %s AND (block_id, tx_hash) < (%s, %s)
+        GROUP BY block_id, tx_hash
+        ORDER BY block_id DESC, tx_hash DESC LIMIT %s
+    """, (address, before_height, before_tx, limit))
+    if rows is None:
+        raise RuntimeError("Address transaction query failed.")
+    return [{"height": height, "hash": tx_hash, "roles": sorted(roles)} for height, tx_hash, roles in rows]
+
+
+def query_messages(type_url: str, before: tuple = None, limit: int = QUERY_PAGE_SIZE) -> list[dict]:
+    """
+    Return up to `limit` messages of type `type_url`, newest first, starting below the
+    (height, tx_hash, msg_index) cursor `before`.
+    """
+    before_height, before_tx, before_index = before or (2 ** 62, "", 0)
+    rows = perform_db_query("""
+        SELECT block_id, tx_hash, msg_index, sender, recipient
+        FROM messages
+        WHERE type_url = %s AND (block_id, tx_hash, msg_index) < (%s, %s, %s)
+        ORDER BY block_id DESC, tx_hash DESC, msg_index DESC LIMIT %s
+    """, (type_url, before_height, before_tx, before_index, limit))
+    if rows is None:
+        raise RuntimeError("Message query failed.")
+    return [{"height": height, "tx_hash": tx_hash, "msg_index": msg_index, "sender": sender, "recipient": recipient}
+            for height, tx_hash, msg_index, sender, recipient in rows]
+
+
+# ---- HTTP layer -----------------------------------------------------------------------------------------------------
+
+@web.middleware
+async def _error_middleware(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Query API error on {request.path}: {e}")
+        return web.json_response({"error": "internal error"}, status=500)
+
+
+class QueryAPI:
+    """
+    aiohttp application serving the query endpoints.
+
+    Args:
+        workers (int): Threads running blocking database queries (defaults to the DB pool size).
+    """
+
+    def __init__(self, workers: int = DB_POOL_MAX_SIZE):
+        self.cache = get_query_cache()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="query-api")
+        self.app = web.Application(middlewares=[_error_middleware])
+        self.app.add_routes([
+            web.get("/health", self.health),
+            web.get("/blocks", self.list_blocks),
+            web.get(r"/blocks/{height:\d+}", self.get_block),
+            web.get(r"/blocks/{height:\d+}/txs", self.get_block_transactions),
+            web.get("/blocks/hash/{block_hash:.+}", self.get_block_by_hash),
+            web.get("/txs/{tx_hash}", self.get_transaction),
+            web.get("/addresses/{address}/txs", self.get_address_transactions),
+            web.get("/messages", self.list_messages),
+        ])
+        self._stop = threading.Event()
+        self.app.on_startup.append(self._start_invalidation)
+        self.app.on_startup.append(self._hold_indexes)
+        self.app.on_cleanup.append(self._shutdown)
+
+    def _invalidate_from_changefeed(self) -> None:
+        from .redis_utils import get_redis_connection
+        try:
+            redis_conn = get_redis_connection()
+        except Exception as e:
+            logging.warning(f"Query cache will not follow the changefeed (entries expire by TTL only): {e}")
+            return
+        tail_changefeed(redis_conn, lambda blocks: self.cache.invalidate_heights(b["height"] for b in blocks),
+                        self._stop)
+
+    async def _start_invalidation(self, app) -> None:
+        if CHANGEFEED_ENABLED:
+            threading.Thread(target=self._invalidate_from_changefeed, name="query-cache-invalidation",
+                             daemon=True).start()
+
+    async def _hold_indexes(self, app) -> None:
+        hold_secondary_indexes()  # Backfills in other processes must not drop the indexes queries seek
+
+    async def _shutdown(self, app) -> None:
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, route: str, function, *args):
+        with QUERY_SECONDS.time(route=route):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    @staticmethod
+    def _limit(request: web.Request) -> int:
+        try:
+            limit = int(request.query.get("limit", QUERY_PAGE_SIZE))
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit must be an integer")
+        return max(1, min(limit, QUERY_MAX_PAGE_SIZE))
+
+    @staticmethod
+    def _height_param(request: web.Request, name: str) -> int:
+        value = request.query.get(name)
+        if value is None:
+            return None
+        if not value.isdigit():
+            raise web.HTTPBadRequest(text=f"{name} must be a block height")
+        return int(value)
+
+    @staticmethod
+    def _keyset_param(request: web.Request, parts: int) -> tuple:
+        """Parse a "height:tx_hash[:msg_index]" `before` cursor."""
+        value = request.query.get("before")
+        if value is None:
+            return None
+        cursor = value.split(":")
+        if len(cursor) != parts or not cursor[0].isdigit() or (parts == 3 and not cursor[2].isdigit()):
+            raise web.HTTPBadRequest(text="malformed before cursor")
+        return (int(cursor[0]), cursor[1]) + tuple(int(part) for part in cursor[2:])
+
+    async def _cached_block(self, height: int) -> dict:
+        block = self.cache.get(("block", height))
+        if block is None:
+            generation = self.cache.generation(height)  # Taken first, so a commit during the query wins
+            block = await self._run("block", query_block, height) or _NOT_FOUND
+            self.cache.put(("block", height), block, generation=generation,
+                           ttl=self.cache.miss_ttl if block is _NOT_FOUND else None)
+        return None if block is _NOT_FOUND else block
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "cached_entries": len(self.cache)})
+
+    async def get_block(self, request: web.Request) -> web.Response:
+        block = await self._cached_block(int(request.match_info["height"]))
+        if block is None:
+            raise web.HTTPNotFound(text="block not indexed")
+        return web.json_response(block)
+
+    async def get_block_by_hash(self, request: web.Request) -> web.Response:
+        block_hash = request.match_info["block_hash"]
+        height = await self._run("block_by_hash", query_block_height_by_hash, block_hash)
+        block = await self._cached_block(height) if height is not None else None
+        if block is None or block["hash"] != block_hash:
+            raise web.HTTPNotFound(text="block not indexed")
+        return web.json_response(block)
+
+    async def list_blocks(self, request: web.Request) -> web.Response:
+        after = self._height_param(request, "after")
+        before = self._height_param(request, "before")
+        if after is not None and before is not None:
+            raise web.HTTPBadRequest(text="use either after or before, not both")
+        limit = self._limit(request)
+        blocks = await self._run("blocks", query_blocks, after, before, limit)
+        cursor = blocks[-1]["height"] if len(blocks) == limit else None
+        return web.json_response({
+            "blocks": blocks,
+            "next": ({"before": cursor} if before is not None else {"after": cursor}) if cursor is not None else None,
+        })
+
+    async def get_block_transactions(self, request: web.Request) -> web.Response:
+        height = int(request.match_info["height"])
+        after = request.query.get("after")
+        limit = self._limit(request)
+        if await self._cached_block(height) is None:
+            raise web.HTTPNotFound(text="block not indexed")
+
+        key = ("txs", height, after, limit)
+        txs = self.cache.get(key)
+        if txs is None:
+            generation = self.cache.generation(height)
+            txs = await self._run("block_txs", query_block_transactions, height, after, limit)
+            self.cache.put(key, txs, generation=generation)
+        return web.json_response({
+            "height": height,
+            "txs": txs,
+            "next": {"after": txs[-1]} if len(txs) == limit else None,
+        })
+
+    async def get_transaction(self, request: web.Request) -> web.Response:
+        tx = await self._run("tx", query_transaction, request.match_info["tx_hash"])
+        if tx is None:
+            raise web.HTTPNotFound(text="transaction not indexed")
+        return web.json_response(tx)
+
+    async def get_address_transactions(self, request: web.Request) -> web.Response:
+        address = request.match_info["address"]
+        limit = self._limit(request)
+        txs = await self._run("address_txs", query_address_transactions, address,
+                              self._keyset_param(request, 2), limit)
+        return web.json_response({
+            "address": address,
+            "txs": txs,
+            "next": {"before": f"{txs[-1]['height']}:{txs[-1]['hash']}"} if len(txs) == limit else None,
+        })
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        type_url = request.query.get("type")
+        if not type_url:
+            raise web.HTTPBadRequest(text="type is required, e.g. /cosmos.bank.v1beta1.MsgSend")
+        limit = self._limit(request)
+        messages = await self._run("messages", query_messages, type_url, self._keyset_param(request, 3), limit)
+        last = messages[-1] if len(messages) == limit else None
+        return web.json_response({
+            "type": type_url,
+            "messages": messages,
+            "next": {"before": f"{last['height']}:{last['tx_hash']}:{last['msg_index']}"} if last else None,
+        })
+
+
+def create_query_app() -> web.Application:
+    """Build the query API application."""
+    return QueryAPI().app
+
+
+def run_query_server(host: str = QUERY_API_HOST, port: int = QUERY_API_PORT) -> None:
+    """Serve the query API in the foreground until interrupted."""
+    logging.info(f"Serving the query API on http://{host}:{port}.")
+    web.run_app(create_query_app(), host=host, port=port, print=None)
+
+
+def start_query_server(host: str = QUERY_API_HOST, port: int = QUERY_API_PORT) -> threading.Thread:
+    """Serve the query API from a daemon thread with its own event loop, alongside the indexer."""
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(create_query_app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        logging.info(f"Serving the query API on http://{host}:{port}.")
+        loop.run_forever()
+
+    thread = threading.Thread(target=serve, name="query-api", daemon=True)
+    thread.start()
+    return thread
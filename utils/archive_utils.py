@@ -0,0 +1,196 @@
+########################################################################################################################
+# archive_utils.py
+#
+# Local, append-only archive of raw block JSON. Each block is zlib-compressed and appended to the current segment
+# file; a fixed-width index file, memory-mapped and addressed directly by block height, records where every block
+# lives. Any archived block can be read back with one index lookup and one segment read, so re-indexing or schema
+# changes can replay blocks from disk instead of the API.
+#
+# Layout of ARCHIVE_DIR:
+#     segment_000000.dat, segment_000001.dat, ...   compressed block records, appended in arrival order
+#     heights.idx                                   16-byte record per height: segment (u32), offset (u64), length (u32)
+#
+# Several indexer processes may share one archive: appends take an exclusive `flock` on the index file, and a record
+# that cannot be read back (corrupt or truncated segment) is reported as not archived, so callers refetch it.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from config import ARCHIVE_DIR, ARCHIVE_SEGMENT_MAX_BYTES, ARCHIVE_ENABLED
+
+INDEX_RECORD = struct.Struct("<IQI")  # segment id, byte offset, compressed length (0 = not archived)
+INDEX_FILE = "heights.idx"
+INDEX_GROWTH = 1 << 20  # Grow the index file by at least this many records at a time
+
+
+class BlockArchive:
+    """
+    Append-only, height-indexed archive of compressed raw blocks.
+
+    Args:
+        directory (str): Directory holding the segment and index files.
+        segment_max_bytes (int): Size at which a new segment file is started.
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIR, segment_max_bytes: int = ARCHIVE_SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        segments = sorted(name for name in os.listdir(directory) if name.startswith("segment_"))
+        self._segment_id = int(segments[-1][8:14]) if segments else 0
+        self._segment = open(self._segment_path(self._segment_id), "ab")
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        self._index_file = open(index_path, "a+b")
+        if os.path.getsize(index_path) == 0:
+            self._index_file.truncate(INDEX_RECORD.size * INDEX_GROWTH)
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self._readers = {}
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"segment_{segment_id:06d}.dat")
+
+    def close(self) -> None:
+        with self._lock:
+            self._index.flush()
+            self._index.close()
+            self._index_file.close()
+            self._segment.close()
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+    def _entry(self, height: int) -> tuple:
+        position = height * INDEX_RECORD.size
+        if height < 0 or position + INDEX_RECORD.size > len(self._index):
+            return None
+        segment_id, offset, length = INDEX_RECORD.unpack_from(self._index, position)
+        return (segment_id, offset, length) if length else None
+
+    def _grow_index(self, height: int) -> None:
+        """Map the index far enough to hold `height`; call with the file lock held."""
+        required = (height + 1) * INDEX_RECORD.size
+        if required <= len(self._index):
+            return
+        file_size = os.fstat(self._index_file.fileno()).st_size  # Another process may already have grown it
+        self._index.close()
+        if file_size < required:
+            self._index_file.truncate(max(required, file_size + INDEX_RECORD.size * INDEX_GROWTH))  # Sparse if possible
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+
+    def has(self, height: int) -> bool:
+        """Return True if the block at `height` is archived."""
+        with self._lock:
+            return self._entry(int(height)) is not None
+
+    def get_raw(self, height: int) -> bytes:
+        """Return the raw JSON bytes of an archived block, or None if it is not archived or cannot be read back."""
+        with self._lock:
+            entry = self._entry(int(height))
+            if entry is None:
+                return None
+            segment_id, offset, length = entry
+            try:
+                reader = self._readers.get(segment_id)
+                if reader is None:
+                    reader = self._readers[segment_id] = open(self._segment_path(segment_id), "rb")
+                reader.seek(offset)
+                compressed = reader.read(length)
+            except OSError as e:
+                logging.error(f"Failed to read archived block {height} from segment {segment_id}: {e}")
+                return None
+        if len(compressed) != length:
+            logging.error(f"Archived block {height} is truncated ({len(compressed)} of {length} bytes).")
+            return None
+        try:
+            return zlib.decompress(compressed)
+        except zlib.error as e:
+            logging.error(f"Archived block {height} is corrupt: {e}")
+            return None
+
+    def get(self, height: int) -> dict:
+        """Return an archived block decoded from JSON, or None if it is not archived."""
+        raw = self.get_raw(height)
+        return json.loads(raw) if raw is not None else None
+
+    def put_raw(self, height: int, raw: bytes, replace: bool = False) -> bool:
+        """
+        Append raw block JSON for `height`. Heights that are already archived are left untouched
+        unless `replace` is set, in which case the index is pointed at the new copy.
+
+        Returns:
+            bool: True if the block was written.
+        """
+        height = int(height)
+        compressed = zlib.compress(raw)
+        with self._lock:
+            fcntl.flock(self._index_file.fileno(), fcntl.LOCK_EX)  # Other processes may append to the same files
+            try:
+                self._grow_index(height)
+                if self._entry(height) is not None and not replace:
+                    return False
+                offset = os.fstat(self._segment.fileno()).st_size  # Not tell(): other writers move the end
+                if offset and offset + len(compressed) > self.segment_max_bytes:
+                    self._segment.close()
+                    self._segment_id += 1
+                    self._segment = open(self._segment_path(self._segment_id), "ab")
+                    offset = os.fstat(self._segment.fileno()).st_size
+
+                self._segment.write(compressed)
+                self._segment.flush()  # Data first, then the index entry that points at it
+                INDEX_RECORD.pack_into(self._index, height * INDEX_RECORD.size, self._segment_id, offset,
+                                       len(compressed))
+            finally:
+                fcntl.flock(self._index_file.fileno(), fcntl.LOCK_UN)
+        return True
+
+    def put(self, height: int, block_data: dict) -> bool:
+        """Archive a decoded block as compact JSON."""
+        return self.put_raw(height, json.dumps(block_data, separators=(",", ":")).encode("utf-8"))
+
+    def heights(self, start: int = 0, end: int = None):
+        """Yield archived heights in ascending order within the inclusive range [start, end]."""
+        chunk = 65536  # Index records copied out of the mmap per lock acquisition
+        height = max(0, start)
+        while end is None or height <= end:
+            with self._lock:
+                last = len(self._index) // INDEX_RECORD.size - 1
+                stop = min(height + chunk - 1, last if end is None else min(end, last))
+                if stop < height:
+                    return
+                records = self._index[height * INDEX_RECORD.size:(stop + 1) * INDEX_RECORD.size]
+            for position, (_, _, length) in enumerate(INDEX_RECORD.iter_unpack(records)):
+                if length:
+                    yield height + position
+            height = stop + 1
+
+
+_block_archive = None
+_block_archive_lock = threading.Lock()
+
+
+def get_block_archive() -> BlockArchive:
+    """Return the shared block archive, or None when ARCHIVE_ENABLED is off or the archive cannot be opened."""
+    global _block_archive
+    if not ARCHIVE_ENABLED:
+        return None
+    if _block_archive is None:
+        with _block_archive_lock:
+            if _block_archive is None:
+                try:
+                    _block_archive = BlockArchive()
+                    logging.info(f"Opened block archive at {ARCHIVE_DIR}.")
+                except OSError as e:
+                    logging.error(f"Failed to open block archive at {ARCHIVE_DIR}: {e}")
+                    return None
+    return _block_archive
@@ -7,219 +7,708 @@
 # block sequence.
 #
 # Features:
-#     - Fetch block data from the blockchain API.
+#     - Fetch block data from the blockchain API (through the pooled, rate-limited `fetch_utils` client).
 #     - Parse and store block data in the database.
 #     - Detect and handle missing blocks.
 #     - Use Redis to track processed and missing blocks.
+#     - Backfill missing blocks concurrently with asyncio and a shared keep-alive HTTP session.
+#     - Bulk load backfilled blocks with COPY through `load_utils.BulkBlockLoader`.
+#     - Run backfills through the staged fetch/transform/load pipeline in `pipeline_utils`.
+#     - Decode block responses selectively into compact `BlockRecord`s (`decode_utils`).
+#     - Store real SHA-256 transaction hashes rather than the raw base64 tx payload.
+#     - Keep raw blocks in a local archive (`archive_utils`), read through on fetch and replayable offline.
+#     - Follow the chain tip from a durable "last indexed height" cursor with an adaptive poll interval.
+#     - Publish every committed block to the Redis Stream changefeed (`stream_utils`).
+#     - Create height partitions before writing and defer secondary indexes during large backfills (`schema_utils`).
 #
 # Developed by: Don Fox
 # Date: 07/02/2024
 #######################################################################################################################
-import requests
+import asyncio
 import logging
 import time
+from datetime import datetime, timezone
 from config import BLOCK_FETCH_DELAY
 # from db_utils import perform_db_query
-from .db_utils import perform_db_query
+from psycopg2.extras import execute_values
+from .db_utils import perform_db_query, db_transaction
+from .schema_utils import ensure_partitions, deferred_secondary_indexes, hold_secondary_indexes
+from .cache_utils import invalidate_blocks
+from .stream_utils import get_changefeed, republish_pending
+from .archive_utils import get_block_archive
+from .transform_utils import compute_tx_hash, decode_messages, transform_block
+from .decode_utils import BlockRecord, decode_block, decode_block_at
+from .metrics_utils import BLOCKS_INDEXED, \
+                          TXS_INDEXED, \
+                          GAP_RANGES, \
+                          GAP_HEIGHTS, \
+                          CHAIN_TIP_HEIGHT, \
+                          INDEXED_HEIGHT, \
+                          TIP_LAG_BLOCKS
 
 from .redis_utils import redis, \
                         clear_missing_blocks, \
                         store_missing_blocks, \
                         get_redis_connection, \
-                        get_missing_blocks
+                        get_missing_blocks, \
+                        mark_heights_processed, \
+                        mark_ranges_processed, \
+                        is_height_processed, \
+                        get_processed_bounds, \
+                        migrate_processed_set, \
+                        find_gap_ranges, \
+                        expand_ranges, \
+                        compress_heights, \
+                        get_index_cursor, \
+                        set_index_cursor
 
 from config import DB_CONFIG, \
                    LATEST_BLOCK_URL, \
                    BLOCK_CHAIN_URL_TEMPLATE, \
-                   NUM_BLOCKS_TO_FETCH
+                   NUM_BLOCKS_TO_FETCH, \
+                   FETCH_TIMEOUT, \
+                   BACKFILL_CONCURRENCY, \
+                   BULK_LOAD_ENABLED, \
+                   BACKFILL_ENGINE, \
+                   ADAPTIVE_CONTROL_ENABLED, \
+                   FETCH_CONCURRENCY_MIN, \
+                   FETCH_CONCURRENCY_MAX, \
+                   DEFER_INDEXES_MIN_BLOCKS, \
+                   SHARDED_BACKFILL, \
+                   QUERY_API_ENABLED, \
+                   FOLLOW_MIN_POLL_INTERVAL, \
+                   FOLLOW_MAX_POLL_INTERVAL, \
+                   FOLLOW_MAX_CATCHUP, \
+                   FOLLOW_RETRY_ATTEMPTS
+
+
+def fetch_block_at_height(height: int, refresh: bool = False) -> BlockRecord:
+    """
+    Fetch the block at `height` as a compact `BlockRecord`, reading from the local block archive first.
+
+    Raw responses fetched from the API are written to the archive so later reads stay local, but only
+    once they decode to the requested block. An archived copy that does not is refetched and replaced.
+
+    Args:
+        height (int): The block height.
+        refresh (bool): Skip the archive and replace its copy with a fresh API response.
+    """
+    from .fetch_utils import get_fetch_client
+
+    archive = get_block_archive()
+    if archive is not None and not refresh:
+        raw = archive.get_raw(height)
+        record = decode_block_at(raw, height) if raw is not None else None
+        if record is not None:
+            return record
+        if raw is not None:
+            logging.warning(f"Archived copy of block {height} is unusable; refetching it.")
+
+    raw = get_fetch_client().get_block_raw(height)
+    record = decode_block_at(raw, height)
+    if record is not None and archive is not None:
+        archive.put_raw(height, raw, replace=True)
+    return record
+
+
+def parse_and_store_block(block_data, block_height: int, block_hash: str, timestamp: str,
+                          replace: bool = False) -> bool:
+    """
+    Parse block data and store the block, its transactions and its decoded messages in the database.
+
+    The block row, its transactions and its message index rows are written on one pooled connection
+    and committed together, so a block is never stored without its transactions.
+
+    With `replace` the block is re-indexed: the stored block row is overwritten and the block's
+    transactions, messages and address rows are deleted and re-inserted in the same transaction.
+
+    Returns:
+        bool: True if the block was committed, False otherwise.
+    """
+    from .load_utils import insert_messages
 
-def fetch_block(url: str) -> dict:
-    """Fetch block data from a URL as JSON."""
-    try:
-        response = requests.get(url, timeout=12)
-        response.raise_for_status()  # Raise an exception for 4xx/5xx responses
-        
-        block_data = response.json()
-        logging.info(f"Successfully fetched block data from {url}.")
-        return block_data
-
-    except requests.exceptions.Timeout:
-        logging.error(f"Request timed out while fetching block data from {url}.")
-    except requests.exceptions.ConnectionError:
-        logging.error(f"Connection error occurred while accessing {url}.")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred while fetching block data from {url}: {e}")
-    
-    return None
-
-def parse_and_store_block(block_data: dict, block_height: int, block_hash: str, timestamp: str) -> None:
-    """Parse block data and store relevant information in the database."""
     if not block_data:
         logging.error(f"No block data provided for block height {block_height}.")
-        return
+        return False
 
-    try:
-        # Insert block metadata
-        query_block = """
-            INSERT INTO blocks (block_height, block_hash, timestamp)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (block_height) DO NOTHING
-        """
-        perform_db_query(query_block, (block_height, block_hash, timestamp))
-        logging.info(f"Block {block_height} metadata stored in the database.")
-    except Exception as e:
-        logging.error(f"Failed to insert block {block_height} into the database: {e}")
-        return
+    on_conflict = """DO UPDATE
+        SET block_hash = EXCLUDED.block_hash,
+            timestamp = EXCLUDED.timestamp,
+            last_block_hash = EXCLUDED.last_block_hash""" if replace else "DO NOTHING"
+    query_block = f"""
+        INSERT INTO blocks (block_height, block_hash, timestamp, last_block_hash)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (block_height) {on_conflict}
+    """
+    query_tx = """
+        INSERT INTO transactions (tx_hash, block_id)
+        VALUES %s
+        ON CONFLICT (tx_hash, block_id) DO NOTHING
+    """
+    if isinstance(block_data, BlockRecord):
+        transactions = block_data.txs
+        last_block_hash = block_data.last_block_hash
+    else:
+        transactions = block_data.get("block", {}).get("data", {}).get("txs", [])
+        last_block_hash = block_data.get("block", {}).get("header", {}).get("last_block_id", {}).get("hash")
 
-    # Process transactions
-    transactions = block_data.get("block", {}).get("data", {}).get("txs", [])
-    if not transactions:
-        logging.info(f"No transactions found for block {block_height}.")
-        return
+    if not ensure_partitions(block_height):
+        return False
 
     try:
-        # Batch insert transactions
-        query_tx = """
-            INSERT INTO transactions (tx_hash, block_id)
-            VALUES %s
-            ON CONFLICT (tx_hash) DO NOTHING
-        """
-        transaction_values = [(tx_hash, block_height) for tx_hash in transactions]
-        perform_db_query(query_tx, transaction_values, batch=True)
-        logging.info(f"{len(transactions)} transactions for block {block_height} stored in the database.")
+        with db_transaction() as cursor:
+            if replace:
+                for table in ("transactions", "messages", "address_txs"):
+                    cursor.execute(f"DELETE FROM {table} WHERE block_id = %s", (block_height,))
+            cursor.execute(query_block, (block_height, block_hash, timestamp, last_block_hash))
+            if transactions:
+                # Batch insert transactions
+                tx_hashes = [compute_tx_hash(tx) for tx in transactions]
+                execute_values(cursor, query_tx, [(tx_hash, block_height) for tx_hash in tx_hashes])
+                insert_messages(cursor, block_height, decode_messages(transactions, tx_hashes))
     except Exception as e:
-        logging.error(f"Failed to insert transactions for block {block_height}: {e}")
+        logging.error(f"Failed to store block {block_height} and its transactions: {e}")
+        return False
+
+    invalidate_blocks((block_height,))
+    BLOCKS_INDEXED.inc()
+    TXS_INDEXED.inc(len(transactions))
+    logging.info(f"Block {block_height} metadata and {len(transactions)} transactions stored in the database.")
+    return True
 
 
 def detect_missing_blocks(redis_conn):
     """
     Detect gaps in the sequence of processed blocks stored in Redis.
 
+    Gaps are found by scanning the processed-heights bitmap, and the result replaces the missing
+    block ranges stored in Redis.
+
     Args:
         redis_conn (redis.Redis): The Redis connection object used to retrieve processed blocks.
 
     Returns:
-        list[int]: A list of missing block heights.
+        list[tuple[int, int]]: Inclusive (start, end) ranges of missing block heights.
     """
-    processed_blocks = redis_conn.smembers('processed_blocks')  # This set should not be cleared
+    migrate_processed_set(redis_conn)  # One-off conversion of the legacy processed_blocks set
 
-    if not processed_blocks:
+    if get_processed_bounds(redis_conn) is None:
         logging.info("No blocks found in Redis to check for gaps.")
         return []
 
-    processed_blocks = sorted(list(map(int, processed_blocks)))   # Variable name change?
-    print(f"In detect_missing_blocks: processed_blocks:{processed_blocks}")
+    missing_ranges = find_gap_ranges(redis_conn)
+    GAP_RANGES.set(len(missing_ranges))
+    GAP_HEIGHTS.set(sum(end - start + 1 for start, end in missing_ranges))
+
+    clear_missing_blocks(redis_conn)
+    if missing_ranges:
+        logging.info(f"Detected missing block ranges: {missing_ranges}")
+        store_missing_blocks(redis_conn, missing_ranges)  # Store detected missing blocks in Redis
 
-    missing_blocks = []
-    for i in range(1, len(processed_blocks)):
-        current_block = processed_blocks[i]
-        previous_block = processed_blocks[i - 1]
-        if current_block - previous_block > 1:
-            missing_blocks.extend(range(previous_block + 1, current_block))
+    return missing_ranges
 
-        if missing_blocks:
-            logging.info(f"Detected missing blocks: {missing_blocks}")
-            store_missing_blocks(redis_conn, missing_blocks)  # Store detected missing blocks in Redis
-        
-        return missing_blocks
 
+def request_missing_blocks(missing_ranges: list[tuple[int, int]], redis_conn: redis.Redis,
+                           concurrency: int = BACKFILL_CONCURRENCY) -> dict:
+    """
+    Request and process/store missing blocks from the blockchain API.
 
-def request_missing_blocks(missing_blocks: list[int], redis_conn: redis.Redis) -> None:
-    """Request and process/store missing blocks from the blockchain API."""
+    With a concurrency above 1 the blocks are fetched by the asyncio backfill engine
+    (see `backfill_missing_blocks`); otherwise they are fetched one at a time. Afterwards the
+    stored missing ranges are replaced by the heights that still failed.
 
-    if not missing_blocks:
+    Args:
+        missing_ranges (list[tuple[int, int]]): Inclusive (start, end) ranges of missing heights.
+        redis_conn (redis.Redis): The Redis connection object.
+        concurrency (int): Maximum number of in-flight block requests.
+
+    Returns:
+        dict: Per-height accounting, {"succeeded": list[int], "failed": list[int]}.
+    """
+    if not missing_ranges:
         logging.info("No missing blocks to process.")
-        return
+        return {"succeeded": [], "failed": []}
 
-    logging.info(f"Processing missing blocks: {missing_blocks}")
+    logging.info(f"Processing missing block ranges: {missing_ranges}")
 
     # Store missing blocks in Redis
-    store_missing_blocks(redis_conn, missing_blocks)
-    stored_missing_blocks = list(map(int, get_missing_blocks(redis_conn)))  # Ensure blocks are integers
+    store_missing_blocks(redis_conn, missing_ranges)
+    stored_missing_blocks = expand_ranges(get_missing_blocks(redis_conn))
 
-    for block in stored_missing_blocks:
-        try:
-            block_url = BLOCK_CHAIN_URL_TEMPLATE.format(block)
-            block_data = fetch_block(block_url)
+    if concurrency > 1:
+        results = backfill_missing_blocks(stored_missing_blocks, redis_conn, concurrency)
+    else:
+        results = {"succeeded": [], "failed": []}
+        for block in stored_missing_blocks:
+            try:
+                block_data = fetch_block_at_height(block)
+
+                if block_data and process_block(block_data, redis_conn):
+                    results["succeeded"].append(block)
+                    logging.info(f"Successfully processed block: {block}")
+                else:
+                    results["failed"].append(block)
+                    logging.error(f"Failed to fetch or process block: {block}")
+            except Exception as e:
+                results["failed"].append(block)
+                logging.error(f"Error processing block {block}: {e}")
+
+    clear_missing_blocks(redis_conn)
+    store_missing_blocks(redis_conn, compress_heights(results["failed"]))
+    return results
+
+
+async def _backfill_block(session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore,
+                          block: int, redis_conn: redis.Redis, loader: "BulkBlockLoader" = None,
+                          replace: bool = False) -> bool:
+    """
+    Fetch one missing block under the concurrency limit and hand it to `process_block`.
 
-            if block_data:
-                process_block(block_data, redis_conn)
-                logging.info(f"Successfully processed block: {block}")
-            else:
-                logging.error(f"Failed to fetch block from URL: {block_url}")
-        except Exception as e:
-            logging.error(f"Error processing block {block}: {e}")
+    When a bulk loader is given the block is buffered in it instead, and is only accounted for
+    once the loader commits it. With `replace` the archive is bypassed and the stored block is
+    overwritten.
+    """
+    from .fetch_utils import get_fetch_client
+
+    archive = get_block_archive()
+    raw = archive.get_raw(block) if archive is not None and not replace else None
+    block_data = decode_block_at(raw, block) if raw is not None else None
+    if raw is not None and block_data is None:
+        logging.warning(f"Archived copy of block {block} is unusable; refetching it.")
+
+    if block_data is None:
+        async with semaphore:
+            raw = await get_fetch_client().get_block_raw_async(session, block)
+        block_data = decode_block_at(raw, block)
+        if block_data is None:
+            logging.error(f"Failed to fetch block: {block}")
+            return False
+        if archive is not None:  # Only responses that decode to the requested block are archived
+            await asyncio.to_thread(archive.put_raw, block, raw, True)
+
+    if loader is None:
+        # process_block does blocking DB/Redis I/O, so keep it off the event loop
+        return await asyncio.to_thread(process_block, block_data, redis_conn, replace)
+
+    record = transform_block(block_data)
+    if record is None:
+        logging.error(f"Block {block} is missing height, hash or timestamp. Skipping.")
+        return False
+    if loader.add(*record):
+        await asyncio.to_thread(loader.flush)
+    return True
 
 
-def process_block(block_data: dict, redis_conn: redis.Redis) -> bool:
-    """Process and store block data, marking it as processed in Redis."""
+async def _backfill_missing_blocks(missing_blocks: list[int], redis_conn: redis.Redis,
+                                   concurrency: int, bulk_load: bool, replace: bool = False) -> dict:
+    """Run the backfill for all missing blocks with at most `concurrency` requests in flight."""
+    import aiohttp
+    from .load_utils import BulkBlockLoader
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+
+    committed = set()
+    loader = None
+    if bulk_load:
+        def on_commit(heights):
+            committed.update(heights)
+            mark_heights_processed(redis_conn, heights)  # One round-trip per flushed batch
+        loader = BulkBlockLoader(on_commit=on_commit, changefeed=get_changefeed(redis_conn))
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        outcomes = await asyncio.gather(
+            *(_backfill_block(session, semaphore, block, redis_conn, loader, replace) for block in missing_blocks),
+            return_exceptions=True
+        )
+
+    if loader is not None:
+        await asyncio.to_thread(loader.flush)
+
+    results = {"succeeded": [], "failed": []}
+    for block, outcome in zip(missing_blocks, outcomes):
+        if isinstance(outcome, Exception):
+            logging.error(f"Error processing block {block}: {outcome}")
+            results["failed"].append(block)
+        elif outcome and (loader is None or block in committed):
+            results["succeeded"].append(block)
+        else:
+            results["failed"].append(block)
+    return results
+
 
-    block_height = block_data.get("block", {}).get("header", {}).get("height")
+def _may_defer_indexes(redis_conn: redis.Redis) -> bool:
+    """
+    Return True if this process may drop the secondary indexes for its backfill.
 
-    if block_height is None:
-        logging.error("Block height is missing or invalid in block data. Skipping processing.")
+    The indexes are shared by every session, so they stay in place when the query API is served,
+    when backfills are sharded between workers, or while any worker holds a backfill lease. Readers
+    in other processes are covered by the lock checked in `deferred_secondary_indexes`.
+    """
+    if SHARDED_BACKFILL or QUERY_API_ENABLED:
+        return False
+    from .shard_utils import SHARD_LEASES_KEY  # shard_utils imports this module
+    try:
+        return not redis_conn.zcard(SHARD_LEASES_KEY)
+    except redis.RedisError as e:
+        logging.error(f"Failed to check backfill leases, keeping secondary indexes: {e}")
         return False
 
-    # Check if the block has already been processed
-    if redis_conn.sismember('processed_blocks', block_height):
-        logging.info(f"Block {block_height} has already been processed, skipping...")
+
+def backfill_missing_blocks(missing_blocks: list[int], redis_conn: redis.Redis,
+                            concurrency: int = BACKFILL_CONCURRENCY,
+                            bulk_load: bool = BULK_LOAD_ENABLED,
+                            engine: str = BACKFILL_ENGINE,
+                            replace: bool = False) -> dict:
+    """
+    Concurrently fetch and process missing blocks.
+
+    Args:
+        missing_blocks (list[int]): Block heights to backfill.
+        redis_conn (redis.Redis): The Redis connection used by `process_block`.
+        concurrency (int): Maximum number of in-flight block requests. With ADAPTIVE_CONTROL_ENABLED
+            the workers are sized from the fetch client's current adaptive limit plus headroom for it
+            to grow (at most FETCH_CONCURRENCY_MAX), and the limit decides how many requests are
+            actually in flight. Never more workers than heights are started.
+        bulk_load (bool): Load blocks through `BulkBlockLoader` (COPY) instead of one insert per block.
+            Bulk backfills of at least DEFER_INDEXES_MIN_BLOCKS heights also defer secondary indexes,
+            unless other sessions depend on them (see `_may_defer_indexes`).
+        engine (str): "pipeline" for the staged fetch/transform/load pipeline (always bulk loads),
+            or "async" for the asyncio engine.
+        replace (bool): Re-index heights that are already stored: each block is fetched from the API
+            (bypassing the archive) and overwritten through `process_block`. Implies the async engine
+            without bulk loading, whose COPY path never overwrites stored rows.
+
+    Returns:
+        dict: Per-height accounting, {"succeeded": list[int], "failed": list[int]}.
+    """
+    from .fetch_utils import get_fetch_client
+
+    if not missing_blocks:
+        logging.info("No missing blocks to backfill.")
+        return {"succeeded": [], "failed": []}
+
+    if ADAPTIVE_CONTROL_ENABLED:
+        limit = get_fetch_client().concurrency.limit
+        concurrency = min(FETCH_CONCURRENCY_MAX, max(concurrency, limit + max(FETCH_CONCURRENCY_MIN, limit // 2)))
+    concurrency = min(concurrency, len(missing_blocks))
+
+    if replace:
+        bulk_load, engine = False, "async"
+
+    start = time.monotonic()
+    # Large bulk backfills load without secondary indexes and rebuild them once at the end
+    defer_indexes = bulk_load and len(missing_blocks) >= DEFER_INDEXES_MIN_BLOCKS and _may_defer_indexes(redis_conn)
+    with deferred_secondary_indexes(defer_indexes):
+        if engine == "pipeline" and bulk_load:
+            from .pipeline_utils import BlockPipeline
+            pipeline = BlockPipeline(redis_conn, fetch_workers=concurrency)
+            results = pipeline.run(missing_blocks)
+            for stage in pipeline.stats():
+                logging.info(f"Pipeline {stage['stage']} totals: processed={stage['processed']} "
+                             f"failed={stage['failed']} ({stage['per_sec']:.1f}/sec)")
+        else:
+            results = asyncio.run(
+                _backfill_missing_blocks(missing_blocks, redis_conn, max(1, concurrency), bulk_load, replace)
+            )
+    elapsed = time.monotonic() - start
+
+    logging.info(
+        f"Backfill finished: {len(results['succeeded'])} succeeded, {len(results['failed'])} failed "
+        f"in {elapsed:.2f}s ({len(missing_blocks) / elapsed if elapsed else 0:.1f} blocks/sec)."
+    )
+    if results["failed"]:
+        logging.error(f"Blocks that failed to backfill: {results['failed']}")
+    return results
+
+
+def extract_block_fields(block_data) -> tuple:
+    """
+    Pull the fields the indexer stores out of a block.
+
+    Args:
+        block_data (BlockRecord | dict): A decoded block record or a full block response.
+
+    Returns:
+        tuple: (block_height, block_hash, timestamp, transactions), or None if height, hash or
+        timestamp is missing.
+    """
+    record = block_data if isinstance(block_data, BlockRecord) else BlockRecord.from_dict(block_data or {})
+    if record is None:
+        logging.error("Block is missing height, hash or timestamp. Skipping processing.")
+        return None
+    return record.height, record.block_hash, record.timestamp, record.txs
+
+
+def reconcile_processed_heights(redis_conn: redis.Redis) -> int:
+    """
+    Bring the Redis processed-heights bitmap in line with the Postgres `blocks` table.
+
+    A crash between the Postgres commit and the Redis update leaves blocks stored but unmarked.
+    Those heights can only sit in a Redis gap or above the highest marked height, so only those
+    ranges are queried. With an empty bitmap the whole table is collapsed into height ranges in SQL.
+
+    Returns:
+        int: The number of heights newly marked as processed.
+    """
+    migrate_processed_set(redis_conn)
+    bounds = get_processed_bounds(redis_conn)
+
+    if bounds is None:
+        rows = perform_db_query("""
+            SELECT MIN(block_height), MAX(block_height)
+            FROM (SELECT block_height, block_height - ROW_NUMBER() OVER (ORDER BY block_height) AS run
+                  FROM blocks) AS numbered
+            GROUP BY run
+            ORDER BY 1
+        """)
+        ranges = [(int(start), int(end)) for start, end in rows or []]
+    else:
+        gaps = find_gap_ranges(redis_conn)
+        rows = perform_db_query("""
+            SELECT block_height FROM blocks WHERE block_height > %s
+            UNION ALL
+            SELECT b.block_height
+            FROM blocks b
+            JOIN unnest(%s::bigint[], %s::bigint[]) AS gap(first_height, last_height)
+              ON b.block_height BETWEEN gap.first_height AND gap.last_height
+        """, (bounds[1], [start for start, _ in gaps], [end for _, end in gaps]))
+        ranges = compress_heights([row[0] for row in rows or []])
+
+    if rows is None:
+        logging.error("Could not read blocks from Postgres; skipping Redis reconciliation.")
+        return 0
+
+    added = mark_ranges_processed(redis_conn, ranges)
+    logging.info(f"Reconciled Redis with Postgres: {added} stored heights were not marked as processed.")
+    return added
+
+
+def mark_block_processed(redis_conn: redis.Redis, block_height: int) -> bool:
+    """Mark a stored block as processed in the Redis processed-heights bitmap (one atomic script call)."""
+    try:
+        mark_heights_processed(redis_conn, [block_height])
+    except redis.RedisError as e:
+        logging.error(f"Failed to mark block {block_height} as processed in Redis: {e}")
         return False
 
-    block_hash = block_data.get("block_id", {}).get("hash")
-    timestamp = block_data.get("block", {}).get("header", {}).get("time")
+    logging.info(f"Marked block {block_height} as processed in Redis.")
+    return True
+
+
+def process_block(block_data, redis_conn: redis.Redis, replace: bool = False) -> bool:
+    """
+    Process and store block data, marking it as processed in Redis.
+
+    With `replace` the processed check is skipped and the block is re-indexed, overwriting its
+    stored rows (see `parse_and_store_block`).
+    """
+
+    fields = extract_block_fields(block_data)
+    if fields is None:
+        return False
+    block_height, block_hash, timestamp, transactions = fields
 
-    if not block_hash or not timestamp:
-        logging.error(f"Block {block_height} is missing critical data (hash or timestamp). Skipping.")
+    # Check if the block has already been processed
+    if not replace and is_height_processed(redis_conn, block_height):
+        logging.info(f"Block {block_height} has already been processed, skipping...")
         return False
 
+    # Record the block as awaiting the changefeed before committing, so a crash cannot lose its entry
+    changefeed = get_changefeed(redis_conn)
+    if changefeed is not None:
+        changefeed.prepare([block_height])
+
     # Process the block: parse and store in the database
     try:
-        parse_and_store_block(block_data, block_height, block_hash, timestamp)
+        if not parse_and_store_block(block_data, block_height, block_hash, timestamp, replace=replace):
+            return False
     except Exception as e:
         logging.error(f"Failed to process and store block {block_height}: {e}")
         return False
 
+    if changefeed is not None:
+        changefeed.publish_block(block_height, block_hash, timestamp, [compute_tx_hash(tx) for tx in transactions])
+
     # Mark the block as processed in Redis
-    if redis_conn.sadd('processed_blocks', block_height):
-        logging.info(f"Marked block {block_height} as processed in Redis.")
-    else:
-        logging.error(f"Failed to add block {block_height} to Redis processed_blocks set.")
-        return False
+    return mark_block_processed(redis_conn, block_height)
 
-    # Remove the block from missing_blocks if it exists
-    if redis_conn.sismember('missing_blocks', block_height):
-        if redis_conn.srem('missing_blocks', block_height):
-            logging.info(f"Block {block_height} removed from missing_blocks.")
-        else:
-            logging.error(f"Failed to remove block {block_height} from missing_blocks.")
-    else:
-        logging.info(f"Block {block_height} was not found in missing_blocks, skipping removal.")
 
-    return True
+def _parse_block_time(timestamp: str) -> float:
+    """Convert an RFC 3339 block header time (nanosecond precision) to a POSIX timestamp."""
+    date_part, _, fraction = timestamp.rstrip("Z").partition(".")
+    seconds = datetime.strptime(date_part, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    return seconds + (float(f"0.{fraction}") if fraction else 0.0)
 
 
-def extract_current_blocks(redis_conn: redis.Redis) -> None:
-    """Extract and process the latest blocks from the blockchain API."""
-    blocks_cntr = 0
-    logging.info("Starting to extract blocks...")
+def _adapt_poll_interval(interval: float, block_time: float, new_blocks: int) -> float:
+    """
+    Move the poll interval towards the observed block time.
 
-    while blocks_cntr < NUM_BLOCKS_TO_FETCH:
-        try:
-            block_data = fetch_block(LATEST_BLOCK_URL)  # Fetch the latest block
+    The interval tracks an exponential moving average of the block time. Polls that find no new
+    block stretch it a little so idle polling backs off, always within the configured bounds.
+    """
+    if block_time:
+        interval = 0.8 * interval + 0.2 * block_time
+    if new_blocks == 0:
+        interval *= 1.25
+    return min(max(interval, FOLLOW_MIN_POLL_INTERVAL), FOLLOW_MAX_POLL_INTERVAL)
 
-            if not block_data:
+
+def follow_chain(redis_conn: redis.Redis, max_blocks: int = None) -> int:
+    """
+    Follow the chain tip, indexing every height after the last indexed height cursor.
+
+    Each iteration reads the latest block to learn the tip height, fetches every height from
+    cursor+1 up to the tip (at most FOLLOW_MAX_CATCHUP per iteration) in one concurrent batch, stores
+    the tip block itself, and advances the cursor to the end of the batch whether or not every height
+    in it succeeded. Heights that failed are retried with the batches of the following polls, up to
+    FOLLOW_RETRY_ATTEMPTS times; heights that still fail (or are awaiting a retry when follow mode
+    stops) are recorded as missing ranges. Follow mode never scans for gaps itself: those heights are
+    picked up by the next gap fill (`main.py backfill` or `main.py run`). The poll interval adapts to
+    the observed block time.
+
+    Args:
+        redis_conn (redis.Redis): The Redis connection object.
+        max_blocks (int, optional): Stop after this many new blocks have been indexed. Follows
+            forever when omitted.
+
+    Returns:
+        int: The number of blocks indexed.
+    """
+    from .fetch_utils import get_fetch_client
+
+    cursor = get_index_cursor(redis_conn)
+    if cursor is None:
+        bounds = get_processed_bounds(redis_conn)
+        cursor = bounds[1] if bounds else None
+
+    hold_secondary_indexes()  # Follow mode reads transactions by block_id (`republish_pending`)
+    interval = float(BLOCK_FETCH_DELAY)
+    last_tip_time = None
+    indexed = 0
+    retries = {}  # Failed height -> attempts so far, retried on the next polls
+    logging.info(f"Starting follow mode from cursor {cursor}...")
+
+    while max_blocks is None or indexed < max_blocks:
+        try:
+            republish_pending(redis_conn)  # Changefeed entries lost to a failed publish
+            tip_raw = get_fetch_client().get_latest_block_raw()
+            tip_data = decode_block(tip_raw) if tip_raw else None
+            tip_fields = extract_block_fields(tip_data) if tip_data else None
+            if tip_fields is None:
                 logging.error("Error: Failed to fetch the latest block. Retrying...")
+                time.sleep(interval)
                 continue
 
-            if process_block(block_data, redis_conn):
-                blocks_cntr += 1
-                logging.info(f"Processed block {blocks_cntr}/{NUM_BLOCKS_TO_FETCH}")
-            else:
-                logging.error("Block was not processed, skipping counter increment")
-
-            time.sleep(BLOCK_FETCH_DELAY)  # Use configurable delay
+            tip_height = tip_fields[0]
+            archive = get_block_archive()
+            if archive is not None:  # Archived only after it decoded to a complete block
+                archive.put_raw(tip_height, tip_raw)
+            if cursor is None:
+                cursor = tip_height - 1  # Nothing indexed yet: start at the current tip
+
+            CHAIN_TIP_HEIGHT.set(tip_height)
+            TIP_LAG_BLOCKS.set(tip_height - cursor)
+            new_blocks = max(0, tip_height - cursor)
+            block_time = None
+            if new_blocks or retries:
+                batch_end = cursor
+                if new_blocks:
+                    tip_time = _parse_block_time(tip_fields[2])
+                    if last_tip_time is not None:
+                        block_time = (tip_time - last_tip_time) / new_blocks
+                    last_tip_time = tip_time
+                    batch_end = min(tip_height - 1, cursor + FOLLOW_MAX_CATCHUP)
+
+                heights = sorted(retries) + list(range(cursor + 1, batch_end + 1))
+                results = backfill_missing_blocks(heights, redis_conn) if heights \
+                    else {"succeeded": [], "failed": []}
+
+                if new_blocks and batch_end == tip_height - 1:
+                    if process_block(tip_data, redis_conn) or is_height_processed(redis_conn, tip_height):
+                        results["succeeded"].append(tip_height)
+                    else:
+                        results["failed"].append(tip_height)
+                    batch_end = tip_height
+
+                for height in results["succeeded"]:
+                    retries.pop(height, None)
+                for height in results["failed"]:
+                    retries[height] = retries.get(height, 0) + 1
+                if results["failed"]:
+                    logging.error(f"Follow mode failed to index heights: {results['failed']}")
+                exhausted = sorted(height for height, attempts in retries.items()
+                                   if attempts >= FOLLOW_RETRY_ATTEMPTS)
+                if exhausted:
+                    logging.error(f"Giving up on heights {exhausted} after {FOLLOW_RETRY_ATTEMPTS} attempts; "
+                                  f"recorded as missing for the next gap fill.")
+                    store_missing_blocks(redis_conn, compress_heights(exhausted))
+                    for height in exhausted:
+                        del retries[height]
+
+                cursor = batch_end
+                set_index_cursor(redis_conn, cursor)
+                INDEXED_HEIGHT.set(cursor)
+                TIP_LAG_BLOCKS.set(tip_height - cursor)
+                indexed += len(results["succeeded"])
+                logging.info(f"Indexed up to height {cursor} ({indexed} blocks this run).")
+
+                if batch_end < tip_height:
+                    continue  # Still catching up, skip the sleep
+
+            interval = _adapt_poll_interval(interval, block_time, new_blocks)
+            time.sleep(interval)
         except Exception as e:
             logging.error(f"Unexpected error during block extraction: {e}")
             break
 
+    if retries:
+        logging.error(f"Follow mode stopped with heights awaiting a retry: {sorted(retries)}; "
+                      f"recorded as missing for the next gap fill.")
+        store_missing_blocks(redis_conn, compress_heights(retries))
+    return indexed
+
+
+def replay_archive(redis_conn: redis.Redis, start: int = 0, end: int = None) -> dict:
+    """
+    Re-index archived blocks without any network I/O.
+
+    Every archived height is stored through `process_block` with `replace`, so blocks that are already
+    indexed are overwritten (e.g. to fill in the message index for blocks stored before it existed).
+
+    Args:
+        redis_conn (redis.Redis): The Redis connection object.
+        start (int): First height to replay.
+        end (int, optional): Last height to replay (inclusive); the whole archive when omitted.
+
+    Returns:
+        dict: Per-height accounting, {"succeeded": list[int], "failed": list[int]}.
+    """
+    results = {"succeeded": [], "failed": []}
+    archive = get_block_archive()
+    if archive is None:
+        logging.error("Block archive is disabled or unavailable; nothing to replay.")
+        return results
+
+    for height in archive.heights(start, end):
+        try:
+            block_data = decode_block_at(archive.get_raw(height), height)
+            if block_data is not None and process_block(block_data, redis_conn, replace=True):
+                results["succeeded"].append(height)
+            else:
+                results["failed"].append(height)
+        except Exception as e:
+            logging.error(f"Error replaying block {height}: {e}")
+            results["failed"].append(height)
+
+    logging.info(f"Replayed {len(results['succeeded'])} archived blocks, {len(results['failed'])} failed.")
+    return results
+
+
+def extract_current_blocks(redis_conn: redis.Redis) -> None:
+    """Extract and process the latest NUM_BLOCKS_TO_FETCH blocks by following the chain tip."""
+    logging.info("Starting to extract blocks...")
+    blocks_cntr = follow_chain(redis_conn, max_blocks=NUM_BLOCKS_TO_FETCH)
     logging.info(f"Completed fetching {blocks_cntr}/{NUM_BLOCKS_TO_FETCH} blocks. Exiting extraction.")
@@ -0,0 +1,128 @@
+########################################################################################################################
+# cache_utils.py
+#
+# Bounded in-memory cache for the read-side query API. Entries are evicted least-recently-used once the cache is
+# full and expire after a fixed time to live ("not indexed yet" answers after a much shorter one). The ingestion
+# path calls `invalidate_blocks` whenever blocks are committed in the same process; a standalone query API process
+# learns about commits from the changefeed instead (see `api_utils`). Either way, the TTL bounds staleness if an
+# invalidation is missed.
+#
+# Every invalidation also bumps a per-height generation. A reader takes the generation before querying the database
+# and passes it to `put`, which drops the value if the height was invalidated in the meantime, so a result read
+# just before a commit is never cached after that commit's invalidation.
+#
+# Keys are tuples whose second element is the block height, e.g. ("block", 123) or ("txs", 123, None, 100), so
+# every entry derived from one block can be dropped together.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from .metrics_utils import Counter
+from config import QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_MISS_TTL
+
+GENERATION_SLOTS = 4096  # Heights share generation counters modulo this; a collision only skips a cache write
+
+CACHE_LOOKUPS = Counter("indexer_query_cache_lookups_total", "Query API cache lookups.", ("result",))
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache with a per-entry time to live.
+
+    Args:
+        max_entries (int): Entries kept before the least recently used is evicted.
+        ttl (float): Seconds an entry stays valid.
+        miss_ttl (float): Seconds a negative ("not indexed yet") entry stays valid.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL,
+                 miss_ttl: float = QUERY_CACHE_MISS_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._by_height = defaultdict(set)  # height -> keys derived from that block
+        self._generations = [0] * GENERATION_SLOTS  # Bumped on every invalidation of a height
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, default=None):
+        """Return the cached value for `key`, or `default` if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                CACHE_LOOKUPS.inc(result="miss")
+                return default
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                CACHE_LOOKUPS.inc(result="expired")
+                return default
+            self._entries.move_to_end(key)
+        CACHE_LOOKUPS.inc(result="hit")
+        return entry[1]
+
+    def generation(self, height: int) -> int:
+        """Return the invalidation generation of `height`; take it before querying and pass it to `put`."""
+        return self._generations[int(height) % GENERATION_SLOTS]
+
+    def put(self, key: tuple, value, ttl: float = None, generation: int = None) -> None:
+        """
+        Cache `value` under `key`, evicting the least recently used entries if the cache is full.
+
+        Args:
+            ttl (float, optional): Seconds the entry stays valid (defaults to the cache's `ttl`).
+            generation (int, optional): The `generation` of the key's height taken before the value was
+                read; the value is dropped if the height has been invalidated since.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and self._generations[int(key[1]) % GENERATION_SLOTS] != generation:
+                return
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            self._by_height[key[1]].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: tuple) -> None:
+        self._entries.pop(key, None)
+        keys = self._by_height.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_height[key[1]]
+
+    def invalidate_heights(self, heights) -> int:
+        """Drop every entry derived from the given block heights; returns the number dropped."""
+        dropped = 0
+        with self._lock:
+            for height in heights:
+                self._generations[int(height) % GENERATION_SLOTS] += 1
+                for key in self._by_height.pop(int(height), ()):
+                    if self._entries.pop(key, None) is not None:
+                        dropped += 1
+        return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_height.clear()
+
+
+_query_cache = QueryCache()
+
+
+def get_query_cache() -> QueryCache:
+    """Return the process-wide query cache."""
+    return _query_cache
+
+
+def invalidate_blocks(heights) -> None:
+    """Called by the ingestion path after blocks are committed, so cached reads of them are refreshed."""
+    _query_cache.invalidate_heights(heights)  # Even when empty: a read in flight may be about to cache a miss
@@ -0,0 +1,253 @@
+########################################################################################################################
+# control_utils.py
+#
+# Feedback controllers that tune the indexer's throughput knobs at runtime instead of fixed constants.
+#
+# Features:
+#     - `AdaptiveConcurrencyLimit`: caps in-flight API requests. Once per control window it backs off
+#       multiplicatively when the throttle rate (429/503) or error rate (other 5xx, timeouts) is above tolerance,
+#       scales down by the latency gradient (long-term / recent latency) when queueing delay builds up, and
+#       otherwise grows additively, but only while the limit is actually being used.
+#     - `AdaptiveBatchSize`: sizes bulk-load flushes so one COPY flush takes about BULK_LOAD_TARGET_SECONDS,
+#       stepping towards the size the last commit times imply and halving after a failed flush.
+#     - Both stay within configured bounds, publish their current values as gauges, and are reported together by
+#       `get_control_settings` (also served at `GET /debug/settings` on the metrics endpoint).
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import asyncio
+import logging
+import math
+import threading
+import time
+from .metrics_utils import Gauge
+from config import ADAPTIVE_CONTROL_ENABLED, \
+                   CONTROL_WINDOW, \
+                   FETCH_CONCURRENCY_MIN, \
+                   FETCH_CONCURRENCY_MAX, \
+                   FETCH_THROTTLE_TOLERANCE, \
+                   BACKFILL_CONCURRENCY, \
+                   BULK_LOAD_MAX_BLOCKS, \
+                   BULK_LOAD_BATCH_MIN, \
+                   BULK_LOAD_BATCH_MAX, \
+                   BULK_LOAD_TARGET_SECONDS
+
+FETCH_CONCURRENCY_LIMIT = Gauge("indexer_fetch_concurrency_limit", "Current in-flight API request limit.")
+FETCH_IN_FLIGHT = Gauge("indexer_fetch_in_flight", "API requests currently in flight.")
+BULK_LOAD_BATCH_SIZE = Gauge("indexer_bulk_load_batch_size", "Current blocks per bulk-load flush.")
+
+MIN_WINDOW_SAMPLES = 10  # Requests needed before a window's rates and latency are trusted
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    A concurrency limit for API requests tuned from observed latency and throttling.
+
+    Callers `acquire` a slot before a request and `release` it with the request's latency and
+    outcome ("success", "throttled" or "error").
+
+    Args:
+        initial (int): Starting limit.
+        minimum (int): Lowest limit the controller may choose.
+        maximum (int): Highest limit the controller may choose.
+        window (float): Seconds between adjustments.
+        throttle_tolerance (float): Fraction of throttled or failed requests tolerated per window.
+        adaptive (bool): When False the limit stays at `initial`.
+    """
+
+    def __init__(self, initial: int = BACKFILL_CONCURRENCY, minimum: int = FETCH_CONCURRENCY_MIN,
+                 maximum: int = FETCH_CONCURRENCY_MAX, window: float = CONTROL_WINDOW,
+                 throttle_tolerance: float = FETCH_THROTTLE_TOLERANCE, adaptive: bool = ADAPTIVE_CONTROL_ENABLED):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.window = window
+        self.throttle_tolerance = throttle_tolerance
+        self.adaptive = adaptive
+        self._limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.in_flight = 0
+        self.long_latency = None  # Slow EWMA of per-window median latency: the no-queueing baseline
+        self._condition = threading.Condition()
+        self._reset_window(time.monotonic())
+        FETCH_CONCURRENCY_LIMIT.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _reset_window(self, now: float) -> None:
+        self._window_start = now
+        self._latencies = []
+        self._throttled = 0
+        self._errors = 0
+        self._saturated = False
+
+    def acquire(self) -> None:
+        """Block until a request slot is free."""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._saturated = True
+                self._condition.wait()
+            self._take_slot()
+
+    async def acquire_async(self) -> None:
+        """Wait on the event loop until a request slot is free."""
+        delay = 0.001
+        while True:
+            with self._condition:
+                if self.in_flight < self.limit:
+                    self._take_slot()
+                    return
+                self._saturated = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def _take_slot(self) -> None:
+        self.in_flight += 1
+        if self.in_flight >= self.limit:
+            self._saturated = True
+        FETCH_IN_FLIGHT.set(self.in_flight)
+
+    def release(self, latency: float, outcome: str = "success") -> None:
+        """Return a slot and record how the request went."""
+        with self._condition:
+            self.in_flight -= 1
+            FETCH_IN_FLIGHT.set(self.in_flight)
+            if outcome == "success":
+                self._latencies.append(latency)
+            elif outcome == "throttled":
+                self._throttled += 1
+            else:
+                self._errors += 1
+
+            now = time.monotonic()
+            if self.adaptive and now - self._window_start >= self.window:
+                self._adjust(now)
+            self._condition.notify_all()
+
+    def _adjust(self, now: float) -> None:
+        samples = len(self._latencies) + self._throttled + self._errors
+        if samples < MIN_WINDOW_SAMPLES:
+            return  # Keep accumulating; too few requests to judge this window
+
+        previous = self._limit
+        failure_rate = (self._throttled + self._errors) / samples
+        if failure_rate > self.throttle_tolerance:
+            self._limit *= 0.7 if self._throttled else 0.85
+            reason = f"{self._throttled} throttled / {self._errors} failed of {samples}"
+        elif self._latencies:
+            recent = sorted(self._latencies)[len(self._latencies) // 2]
+            if self.long_latency is None:
+                self.long_latency = recent
+            gradient = max(0.5, min(1.0, 1.1 * self.long_latency / recent)) if recent else 1.0
+            if gradient < 1.0:
+                self._limit *= gradient
+                reason = f"latency {recent * 1000:.0f}ms vs baseline {self.long_latency * 1000:.0f}ms"
+            elif self._saturated:
+                self._limit += max(1.0, math.sqrt(self._limit))
+                reason = "limit reached with steady latency"
+            else:
+                reason = None
+            self.long_latency = 0.95 * self.long_latency + 0.05 * recent
+        else:
+            reason = None
+
+        self._limit = min(float(self.maximum), max(float(self.minimum), self._limit))
+        if int(previous) != self.limit:
+            FETCH_CONCURRENCY_LIMIT.set(self.limit)
+            logging.info(f"Fetch concurrency limit {int(previous)} -> {self.limit} ({reason}).")
+        self._reset_window(now)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "baseline_latency": self.long_latency,
+            "adaptive": self.adaptive,
+        }
+
+
+class AdaptiveBatchSize:
+    """
+    A bulk-load batch size tuned so that one flush takes about `target_seconds`.
+
+    Args:
+        initial (int): Starting blocks per flush.
+        minimum (int): Smallest batch size.
+        maximum (int): Largest batch size.
+        target_seconds (float): Desired duration of one COPY flush.
+        adaptive (bool): When False the batch size stays at `initial`.
+    """
+
+    def __init__(self, initial: int = BULK_LOAD_MAX_BLOCKS, minimum: int = BULK_LOAD_BATCH_MIN,
+                 maximum: int = BULK_LOAD_BATCH_MAX, target_seconds: float = BULK_LOAD_TARGET_SECONDS,
+                 adaptive: bool = ADAPTIVE_CONTROL_ENABLED):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.target_seconds = target_seconds
+        self.adaptive = adaptive
+        self._value = min(self.maximum, max(self.minimum, initial))
+        self.last_commit_seconds = None
+        self._lock = threading.Lock()
+        BULK_LOAD_BATCH_SIZE.set(self._value)
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def record(self, elapsed: float, blocks: int, success: bool = True) -> None:
+        """Fold one flush of `blocks` blocks that took `elapsed` seconds into the batch size."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            previous = self._value
+            if not success:
+                target = previous // 2
+            else:
+                self.last_commit_seconds = elapsed
+                if blocks < previous // 2 or elapsed <= 0:
+                    return  # A partial (time-window) flush says little about the right size
+                ideal = blocks * self.target_seconds / elapsed
+                # Move halfway towards the size the commit time implies, at most doubling per step
+                target = int(previous + (min(ideal, 2 * previous) - previous) / 2)
+            self._value = min(self.maximum, max(self.minimum, target))
+            if self._value != previous:
+                BULK_LOAD_BATCH_SIZE.set(self._value)
+                logging.info(f"Bulk load batch size {previous} -> {self._value} "
+                             f"(last flush {blocks} blocks in {elapsed:.2f}s).")
+
+    def snapshot(self) -> dict:
+        return {
+            "batch_size": self._value,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "target_seconds": self.target_seconds,
+            "last_commit_seconds": self.last_commit_seconds,
+            "adaptive": self.adaptive,
+        }
+
+
+_bulk_batch_size = None
+_bulk_batch_size_lock = threading.Lock()
+
+
+def get_bulk_batch_size() -> AdaptiveBatchSize:
+    """Return the process-wide bulk-load batch size controller shared by every `BulkBlockLoader`."""
+    global _bulk_batch_size
+    if _bulk_batch_size is None:
+        with _bulk_batch_size_lock:
+            if _bulk_batch_size is None:
+                _bulk_batch_size = AdaptiveBatchSize()
+    return _bulk_batch_size
+
+
+def get_control_settings() -> dict:
+    """Return the current fetch concurrency and bulk-load batch size settings."""
+    from .fetch_utils import get_fetch_client
+
+    return {
+        "fetch_concurrency": get_fetch_client().concurrency.snapshot(),
+        "bulk_load": get_bulk_batch_size().snapshot(),
+    }
@@ -0,0 +1,149 @@
+########################################################################################################################
+# cosmos_utils.py
+#
+# Minimal Cosmos SDK transaction decoding for the message index. A transaction in `data.txs` is a protobuf `TxRaw`
+# whose `body_bytes` hold a `TxBody`, whose `messages` are `google.protobuf.Any` values (type URL + encoded
+# message). Only the wire format is parsed, so no generated protobuf classes or chain-specific packages are needed.
+#
+# Features:
+#     - Extracts every message's type URL (e.g. `/cosmos.bank.v1beta1.MsgSend`).
+#     - Extracts the addresses a message touches with their role: the fields of common message types are mapped to
+#       "sender" / "recipient"; any other bech32 address found in a message is recorded as "involved".
+#     - Never raises on malformed or non-SDK transactions; they simply yield no messages.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import re
+
+# bech32 human-readable part, separator and data part (checksum not verified)
+ADDRESS_PATTERN = re.compile(r"^[a-z][a-z0-9]{0,82}1[qpzry9x8gf2tvdw0s3jn54khce6mua7l]{38,}$")
+
+# Message field number -> role, or -> (role, field number inside each repeated sub-message)
+MESSAGE_ROLES = {
+    "/cosmos.bank.v1beta1.MsgSend": {1: "sender", 2: "recipient"},
+    "/cosmos.bank.v1beta1.MsgMultiSend": {1: ("sender", 1), 2: ("recipient", 1)},
+    "/cosmos.staking.v1beta1.MsgDelegate": {1: "sender", 2: "recipient"},
+    "/cosmos.staking.v1beta1.MsgUndelegate": {1: "sender", 2: "recipient"},
+    "/cosmos.staking.v1beta1.MsgBeginRedelegate": {1: "sender", 2: "involved", 3: "recipient"},
+    "/cosmos.staking.v1beta1.MsgCreateValidator": {4: "sender", 5: "recipient"},
+    "/cosmos.distribution.v1beta1.MsgWithdrawDelegatorReward": {1: "sender", 2: "involved"},
+    "/cosmos.distribution.v1beta1.MsgWithdrawValidatorCommission": {1: "sender"},
+    "/cosmos.distribution.v1beta1.MsgSetWithdrawAddress": {1: "sender", 2: "recipient"},
+    "/cosmos.gov.v1beta1.MsgVote": {2: "sender"},
+    "/cosmos.gov.v1.MsgVote": {2: "sender"},
+    "/cosmos.gov.v1beta1.MsgDeposit": {2: "sender"},
+    "/cosmos.gov.v1beta1.MsgSubmitProposal": {3: "sender"},
+    "/cosmos.authz.v1beta1.MsgGrant": {1: "sender", 2: "recipient"},
+    "/cosmos.authz.v1beta1.MsgExec": {1: "sender"},
+    "/cosmos.feegrant.v1beta1.MsgGrantAllowance": {1: "sender", 2: "recipient"},
+    "/ibc.applications.transfer.v1.MsgTransfer": {4: "sender", 5: "recipient"},
+    "/cosmwasm.wasm.v1.MsgExecuteContract": {1: "sender", 2: "recipient"},
+    "/cosmwasm.wasm.v1.MsgInstantiateContract": {1: "sender", 2: "involved"},
+    "/cosmwasm.wasm.v1.MsgStoreCode": {1: "sender"},
+}
+
+
+def _varint(data: bytes, position: int) -> tuple:
+    result = shift = 0
+    while True:
+        if position >= len(data) or shift > 63:
+            raise ValueError("truncated varint")
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _fields(data: bytes):
+    """Yield (field number, wire type, value) for each field of an encoded protobuf message."""
+    position, end = 0, len(data)
+    while position < end:
+        key, position = _varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 2:
+            length, position = _varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value, position = data[position:position + 8], position + 8
+        elif wire_type == 5:
+            value, position = data[position:position + 4], position + 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+        if position > end:
+            raise ValueError("truncated field")
+        yield number, wire_type, value
+
+
+def _as_address(value) -> str:
+    """Return `value` as a string if it is a bech32-looking address, else None."""
+    if not 39 <= len(value) <= 128:
+        return None
+    try:
+        text = value.decode("ascii")
+    except UnicodeDecodeError:
+        return None
+    return text if ADDRESS_PATTERN.match(text) else None
+
+
+def message_addresses(type_url: str, value: bytes) -> list[tuple[str, str]]:
+    """
+    Return the (address, role) pairs of one encoded message, in field order and without duplicates.
+
+    Raises:
+        ValueError: If the message is not valid protobuf.
+    """
+    roles = MESSAGE_ROLES.get(type_url, {})
+    addresses = []
+    for number, wire_type, field in _fields(value):
+        if wire_type != 2:
+            continue
+        role = roles.get(number, "involved")
+        if isinstance(role, tuple):
+            role, inner_number = role
+            addresses.extend((address, role) for inner, inner_type, inner_value in _fields(field)
+                             if inner == inner_number and inner_type == 2
+                             for address in (_as_address(inner_value),) if address)
+            continue
+        address = _as_address(field)
+        if address:
+            addresses.append((address, role))
+    return list(dict.fromkeys(addresses))
+
+
+def decode_tx_messages(tx_bytes: bytes) -> list[tuple[str, list[tuple[str, str]]]]:
+    """
+    Decode the messages of a Cosmos SDK `TxRaw`.
+
+    Args:
+        tx_bytes (bytes): The decoded bytes of one entry of a block's `data.txs`.
+
+    Returns:
+        list[tuple[str, list[tuple[str, str]]]]: (type URL, [(address, role), ...]) per message, in
+        message order; empty if the transaction cannot be decoded.
+    """
+    try:
+        body = next((value for number, wire_type, value in _fields(tx_bytes) if number == 1 and wire_type == 2), None)
+        if body is None:
+            return []
+        messages = []
+        for number, wire_type, any_value in _fields(body):
+            if number != 1 or wire_type != 2:
+                continue
+            type_url, value = "", b""
+            for any_number, any_type, field in _fields(any_value):
+                if any_number == 1 and any_type == 2:
+                    type_url = field.decode("utf-8")
+                elif any_number == 2 and any_type == 2:
+                    value = field
+            if not type_url.startswith("/"):
+                return []  # Not an Any: these bytes are not an SDK transaction
+            messages.append((type_url, message_addresses(type_url, value)))
+        return messages
+    except (ValueError, UnicodeDecodeError):
+        return []
@@ -1,15 +1,32 @@
 ########################################################################################################################
 # db_utils.py
 #
-# Provides utility functions for interacting with a PostgreSQL database, including connecting, closing, 
+# Provides utility functions for interacting with a PostgreSQL database, including connecting, closing,
 # and executing queries.
 #
+# Connections are handed out from a shared, thread-safe pool. `db_transaction` wraps a pooled connection in a
+# single unit of work so several statements can be committed (or rolled back) together.
+#
 # Developed by: Don Fox
 # Date: 07/02/2024
 #######################################################################################################################
 import psycopg2
+import psycopg2.pool
 import logging
-from config import DB_CONFIG
+import threading
+import time
+from contextlib import contextmanager
+from .metrics_utils import DB_OPERATION_SECONDS
+from config import DB_CONFIG, \
+                   DB_POOL_MIN_SIZE, \
+                   DB_POOL_MAX_SIZE, \
+                   DB_POOL_HEALTH_CHECK_INTERVAL
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)  # Block instead of raising when the pool is exhausted
+_last_used = {}  # id(connection) -> time.monotonic() of its last return to the pool
+
 
 def connect_to_db():
     """
@@ -52,6 +69,111 @@ def close_db_connection(connection):
             logging.error(f"Error closing the database connection: {e}")
 
 
+def get_db_pool():
+    """
+    Return the shared connection pool, creating it on first use.
+
+    Returns:
+        psycopg2.pool.ThreadedConnectionPool: Pool sized by DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE.
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, **DB_CONFIG)
+                logging.info(f"Created PostgreSQL connection pool (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}).")
+    return _db_pool
+
+
+def close_db_pool():
+    """Close every connection in the shared pool."""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+            _last_used.clear()
+            logging.info("Closed PostgreSQL connection pool.")
+
+
+def _is_connection_healthy(connection) -> bool:
+    """
+    Check that a pooled connection is still usable.
+
+    A cheap `closed` check is always done; a `SELECT 1` round-trip is only made when the connection
+    has been idle for longer than DB_POOL_HEALTH_CHECK_INTERVAL seconds.
+    """
+    if connection.closed:
+        return False
+
+    idle_for = time.monotonic() - _last_used.get(id(connection), 0)
+    if idle_for < DB_POOL_HEALTH_CHECK_INTERVAL:
+        return True
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error as e:
+        logging.error(f"Discarding unhealthy pooled database connection: {e}")
+        return False
+
+
+@contextmanager
+def get_db_connection():
+    """
+    Borrow a healthy connection from the pool for the duration of a `with` block.
+
+    Any transaction left open by the caller is rolled back before the connection is returned.
+
+    Yields:
+        psycopg2.extensions.connection: A pooled connection.
+    """
+    pool = get_db_pool()
+    with _db_pool_slots:
+        connection = pool.getconn()
+        if not _is_connection_healthy(connection):
+            _last_used.pop(id(connection), None)
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+
+        try:
+            yield connection
+        finally:
+            discard = bool(connection.closed)
+            if not discard and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    discard = True
+            _last_used[id(connection)] = time.monotonic()
+            if discard:
+                _last_used.pop(id(connection), None)
+            pool.putconn(connection, close=discard)
+
+
+@contextmanager
+def db_transaction():
+    """
+    Run a unit of work on one pooled connection and commit it once.
+
+    Everything executed on the yielded cursor is committed together when the `with` block exits
+    normally, or rolled back if it raises.
+
+    Yields:
+        psycopg2.extensions.cursor: A cursor bound to the pooled connection.
+    """
+    with get_db_connection() as connection, DB_OPERATION_SECONDS.time(operation="transaction"):
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
 def perform_db_query(query, params=None):
     """
     Execute a SQL query on the database.
@@ -66,22 +188,18 @@ def perform_db_query(query, params=None):
             - For `INSERT`, `UPDATE`, or `DELETE` queries, returns the number of affected rows (int).
             - None if the query fails.
     """
-    connection = connect_to_db()
-    if not connection:
-        return None
-
     try:
-        with connection.cursor() as cursor:
-            cursor.execute(query, params)
-            if query.strip().lower().startswith("select"):
-                result = cursor.fetchall()  # Fetch all rows for SELECT queries
-            else:
-                connection.commit()  # Commit the transaction for non-SELECT queries
-                result = cursor.rowcount  # Return the number of rows affected
-            # print(f"Query executed successfully: {query}")
-            return result
+        operation = query.strip().split(None, 1)[0].lower() if query.strip() else "query"
+        with get_db_connection() as connection, DB_OPERATION_SECONDS.time(operation=operation):
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                if query.strip().lower().startswith("select"):
+                    result = cursor.fetchall()  # Fetch all rows for SELECT queries
+                else:
+                    connection.commit()  # Commit the transaction for non-SELECT queries
+                    result = cursor.rowcount  # Return the number of rows affected
+                # print(f"Query executed successfully: {query}")
+                return result
     except psycopg2.Error as e:
         logging.error(f"Error executing query: {e}")
         return None
-    finally:
-        close_db_connection(connection)
\ No newline at end of file
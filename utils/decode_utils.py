@@ -0,0 +1,91 @@
+########################################################################################################################
+# decode_utils.py
+#
+# Selective decoding of block responses. Only the fields the indexer stores (`block_id.hash`, `header.height`,
+# `header.time`, `header.last_block_id.hash`, `data.txs`) are kept, in a compact `__slots__` record, and the rest of the response (evidence,
+# last_commit signatures, ...) is dropped as soon as it is parsed. Parsing uses `orjson` when it is installed and
+# falls back to the standard library `json` module otherwise.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import json
+import logging
+
+try:
+    import orjson
+    _loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:  # pragma: no cover - depends on the environment
+    _loads = json.loads
+    JSON_BACKEND = "json"
+
+
+class BlockRecord:
+    """The subset of a block response the indexer stores."""
+
+    __slots__ = ("height", "block_hash", "timestamp", "txs", "last_block_hash")
+
+    def __init__(self, height: int, block_hash: str, timestamp: str, txs: list[str], last_block_hash: str = None):
+        self.height = height
+        self.block_hash = block_hash
+        self.timestamp = timestamp
+        self.txs = txs
+        self.last_block_hash = last_block_hash  # header.last_block_id.hash: the hash of block height - 1
+
+    def __repr__(self):
+        return f"BlockRecord(height={self.height}, block_hash={self.block_hash!r}, txs={len(self.txs)})"
+
+    @classmethod
+    def from_dict(cls, block_data: dict):
+        """Build a record from an already-decoded block response, or return None if fields are missing."""
+        block = block_data.get("block") or {}
+        header = block.get("header") or {}
+        height = header.get("height")
+        block_hash = (block_data.get("block_id") or {}).get("hash")
+        timestamp = header.get("time")
+        if height is None or not block_hash or not timestamp:
+            return None
+        return cls(int(height), block_hash, timestamp, (block.get("data") or {}).get("txs") or [],
+                   (header.get("last_block_id") or {}).get("hash") or None)
+
+
+def loads(raw: bytes):
+    """Parse JSON bytes with the fastest available backend."""
+    return _loads(raw)
+
+
+def decode_block(raw: bytes) -> BlockRecord:
+    """
+    Decode a raw block response into a `BlockRecord`.
+
+    Returns:
+        BlockRecord: The decoded record, or None if the payload is not valid JSON or lacks the
+        height, hash or timestamp.
+    """
+    try:
+        return BlockRecord.from_dict(_loads(raw))
+    except ValueError as e:  # orjson.JSONDecodeError and json.JSONDecodeError are both ValueErrors
+        logging.error(f"Failed to decode block response: {e}")
+        return None
+    except (AttributeError, TypeError) as e:  # Valid JSON, but not a block object
+        logging.error(f"Block response has an unexpected shape: {e}")
+        return None
+
+
+def decode_block_at(raw: bytes, height: int) -> BlockRecord:
+    """
+    Decode a raw response fetched for `height`, accepting it only if it holds that block.
+
+    Callers archive a response only after it passes this check, so a bad response is never
+    served back from the archive.
+
+    Returns:
+        BlockRecord: The decoded record, or None if the payload is not a usable block or is a
+        different height.
+    """
+    record = decode_block(raw) if raw else None
+    if record is not None and record.height != height:
+        logging.error(f"Response for block {height} holds block {record.height}.")
+        return None
+    return record
@@ -0,0 +1,276 @@
+########################################################################################################################
+# export_utils.py
+#
+# Incremental columnar export of the indexed blocks and transactions to height-partitioned Parquet files, so
+# analytics jobs scan compressed files instead of running full-table SELECTs against the ingestion database.
+#
+# Layout of EXPORT_DIR:
+#     blocks/bucket=00012/part-000001200000-000001249999.parquet      heights 1,200,000 - 1,249,999
+#     transactions/bucket=00012/part-...parquet                         same heights, matched by block_id
+#     _export_state.json                                                high-water mark of the export
+#
+# Features:
+#     - Exports from a stored high-water mark, one height chunk at a time; a chunk is read with a single
+#       `COPY ... TO STDOUT` and parsed straight into Arrow columns, never into per-row Python objects.
+#     - Only a contiguous run of stored heights is exported, so a gap is never skipped over: the high-water mark
+#       stops before it and the export resumes there once the gap is filled.
+#     - Files are written under a temporary name and renamed into place before the high-water mark moves, so a
+#       crash leaves either the old or the new state.
+#     - `compact_exports` merges the small files incremental runs leave behind into one file per bucket.
+#     - `pyarrow` is optional: without it the export is reported as unavailable and nothing else is affected.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import io
+import json
+import logging
+import os
+import time
+from .db_utils import get_db_connection
+from .metrics_utils import Counter, Gauge, DB_OPERATION_SECONDS
+from config import EXPORT_DIR, \
+                   EXPORT_BUCKET_SIZE, \
+                   EXPORT_CHUNK_SIZE, \
+                   EXPORT_COMPRESSION, \
+                   EXPORT_COMPACT_MIN_FILES
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # Export is optional; everything else works without pyarrow
+    pa = None
+
+EXPORT_STATE_FILE = "_export_state.json"
+
+EXPORT_HIGH_WATER_MARK = Gauge("indexer_export_high_water_mark", "Highest block height exported to Parquet.")
+EXPORTED_ROWS = Counter("indexer_exported_rows_total", "Rows written to Parquet exports.", ("table",))
+
+# Column queries for each exported table; timestamps travel as epoch microseconds so the CSV parser never has to
+# deal with time zone offsets.
+EXPORT_QUERIES = {
+    "blocks": """
+        SELECT block_height, block_hash, (EXTRACT(EPOCH FROM timestamp) * 1000000)::BIGINT, last_block_hash
+        FROM blocks WHERE block_height BETWEEN {low} AND {high} ORDER BY block_height
+    """,
+    "transactions": """
+        SELECT tx_hash, block_id
+        FROM transactions WHERE block_id BETWEEN {low} AND {high} ORDER BY block_id, tx_hash
+    """,
+}
+
+
+def _schemas() -> dict:
+    return {
+        "blocks": pa.schema([
+            ("block_height", pa.int64()),
+            ("block_hash", pa.string()),
+            ("timestamp", pa.int64()),  # Cast to timestamp[us, UTC] after parsing
+            ("last_block_hash", pa.string()),
+        ]),
+        "transactions": pa.schema([
+            ("tx_hash", pa.string()),
+            ("block_id", pa.int64()),
+        ]),
+    }
+
+
+def export_available() -> bool:
+    """Return True if pyarrow is installed."""
+    return pa is not None
+
+
+def _state_path(directory: str) -> str:
+    return os.path.join(directory, EXPORT_STATE_FILE)
+
+
+def get_export_state(directory: str = EXPORT_DIR) -> dict:
+    """Return the export state: {"high_water_mark": int or None, "updated_at": float or None}."""
+    try:
+        with open(_state_path(directory)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {"high_water_mark": None, "updated_at": None}
+
+
+def _save_export_state(directory: str, state: dict) -> None:
+    temporary = _state_path(directory) + ".tmp"
+    with open(temporary, "w") as state_file:
+        json.dump(state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(temporary, _state_path(directory))
+
+
+def _bucket_dir(directory: str, table: str, bucket: int) -> str:
+    return os.path.join(directory, table, f"bucket={bucket:05d}")
+
+
+def _part_name(low: int, high: int) -> str:
+    return f"part-{low:012d}-{high:012d}.parquet"
+
+
+def _part_range(name: str) -> tuple:
+    _, low, high = name[:-len(".parquet")].split("-")
+    return int(low), int(high)
+
+
+def _read_table(cursor, table: str, low: int, high: int):
+    """Read the rows of heights `low` to `high` with one COPY and parse them into an Arrow table."""
+    buffer = io.BytesIO()
+    with DB_OPERATION_SECONDS.time(operation="export_copy"):
+        cursor.copy_expert(f"COPY ({EXPORT_QUERIES[table].format(low=int(low), high=int(high))}) "
+                           f"TO STDOUT WITH (FORMAT csv)", buffer)
+    schema = _schemas()[table]
+    buffer.seek(0)
+    arrow_table = pa_csv.read_csv(
+        buffer,
+        read_options=pa_csv.ReadOptions(column_names=schema.names),
+        convert_options=pa_csv.ConvertOptions(column_types=schema, strings_can_be_null=True,
+                                              quoted_strings_can_be_null=False),
+    )
+    if table == "blocks":
+        timestamps = arrow_table.column("timestamp").cast(pa.timestamp("us", tz="UTC"))
+        arrow_table = arrow_table.set_column(arrow_table.schema.get_field_index("timestamp"), "timestamp", timestamps)
+    return arrow_table
+
+
+def _contiguous_end(heights, low: int) -> int:
+    """Return the last height of the run starting at `low` with no gaps, or low - 1 if `low` itself is missing."""
+    if len(heights) == 0:
+        return low - 1
+    expected = pa.array(range(low, low + len(heights)), type=pa.int64())
+    breaks = pc.indices_nonzero(pc.not_equal(heights, expected))
+    return low + (breaks[0].as_py() if len(breaks) else len(heights)) - 1
+
+
+def _write_part(directory: str, table: str, bucket: int, arrow_table, low: int, high: int) -> str:
+    bucket_dir = _bucket_dir(directory, table, bucket)
+    os.makedirs(bucket_dir, exist_ok=True)
+    path = os.path.join(bucket_dir, _part_name(low, high))
+    pq.write_table(arrow_table, path + ".tmp", compression=EXPORT_COMPRESSION)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def export_incremental(end: int = None, directory: str = EXPORT_DIR, chunk_size: int = EXPORT_CHUNK_SIZE,
+                       bucket_size: int = EXPORT_BUCKET_SIZE) -> dict:
+    """
+    Export the blocks and transactions stored above the high-water mark.
+
+    Args:
+        end (int, optional): Last height to export, e.g. the chain-verification watermark (defaults to the highest
+            stored height).
+        directory (str): Export root directory.
+        chunk_size (int): Heights read and written per step; chunks never cross a bucket boundary.
+        bucket_size (int): Heights per bucket directory.
+
+    Returns:
+        dict: {"from": int, "to": int (new high-water mark), "blocks": int, "transactions": int, "files": int},
+        or None if pyarrow is missing or the export failed.
+    """
+    if not export_available():
+        logging.error("Parquet export requires pyarrow; install it to enable EXPORT_ENABLED.")
+        return None
+    os.makedirs(directory, exist_ok=True)
+    state = get_export_state(directory)
+    start_time = time.monotonic()
+    totals = {"from": None, "to": state["high_water_mark"], "blocks": 0, "transactions": 0, "files": 0}
+
+    try:
+        with get_db_connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(block_height), MAX(block_height) FROM blocks")
+            lowest, highest = cursor.fetchone()
+            connection.rollback()
+            if highest is None:
+                logging.info("No stored blocks to export.")
+                return totals
+            end = highest if end is None else min(end, highest)
+            low = lowest if state["high_water_mark"] is None else state["high_water_mark"] + 1
+            totals["from"] = low
+
+            while low <= end:
+                bucket = low // bucket_size
+                high = min(end, low + chunk_size - 1, (bucket + 1) * bucket_size - 1)
+                blocks = _read_table(cursor, "blocks", low, high)
+                contiguous_end = _contiguous_end(blocks.column("block_height"), low)
+                gap = contiguous_end < high
+                if contiguous_end < low:
+                    logging.info(f"Export stopped at missing block {low}.")
+                    break
+                if gap:
+                    blocks = blocks.slice(0, contiguous_end - low + 1)
+                    high = contiguous_end
+                transactions = _read_table(cursor, "transactions", low, high)
+                connection.rollback()  # End the read transaction between chunks
+
+                _write_part(directory, "blocks", bucket, blocks, low, high)
+                _write_part(directory, "transactions", bucket, transactions, low, high)
+                state = {"high_water_mark": high, "updated_at": time.time()}
+                _save_export_state(directory, state)
+
+                EXPORTED_ROWS.inc(blocks.num_rows, table="blocks")
+                EXPORTED_ROWS.inc(transactions.num_rows, table="transactions")
+                EXPORT_HIGH_WATER_MARK.set(high)
+                totals.update(to=high, blocks=totals["blocks"] + blocks.num_rows,
+                              transactions=totals["transactions"] + transactions.num_rows, files=totals["files"] + 2)
+                if gap:
+                    logging.info(f"Export stopped at missing block {high + 1}.")
+                    break
+                low = high + 1
+    except Exception as e:
+        logging.error(f"Parquet export failed: {e}")
+        return None
+
+    if totals["files"]:
+        logging.info(f"Exported heights {totals['from']}-{totals['to']} ({totals['blocks']} blocks, "
+                     f"{totals['transactions']} transactions) in {time.monotonic() - start_time:.2f}s.")
+    return totals
+
+
+def compact_exports(directory: str = EXPORT_DIR, min_files: int = EXPORT_COMPACT_MIN_FILES) -> int:
+    """
+    Merge the part files of every bucket holding at least `min_files` of them into a single file.
+
+    Part files whose heights are covered by a larger part (left behind if a compaction was interrupted
+    after writing its output) are removed first, so readers never see a height twice.
+
+    Returns:
+        int: The number of buckets compacted, or -1 if pyarrow is missing or compaction failed.
+    """
+    if not export_available():
+        logging.error("Parquet compaction requires pyarrow.")
+        return -1
+    compacted = 0
+    try:
+        for table in EXPORT_QUERIES:
+            table_dir = os.path.join(directory, table)
+            if not os.path.isdir(table_dir):
+                continue
+            for bucket_name in sorted(os.listdir(table_dir)):
+                bucket_dir = os.path.join(table_dir, bucket_name)
+                parts = sorted((name for name in os.listdir(bucket_dir) if name.endswith(".parquet")),
+                               key=_part_range)
+                ranges = {name: _part_range(name) for name in parts}
+                for name in list(parts):
+                    low, high = ranges[name]
+                    if any(other != name and ranges[other][0] <= low and high <= ranges[other][1]
+                           for other in parts):
+                        os.remove(os.path.join(bucket_dir, name))
+                        parts.remove(name)
+                if len(parts) < max(2, min_files):
+                    continue
+
+                merged = pa.concat_tables([pq.read_table(os.path.join(bucket_dir, name)) for name in parts])
+                _write_part(directory, table, int(bucket_name.split("=")[1]), merged,
+                            ranges[parts[0]][0], ranges[parts[-1]][1])
+                for name in parts:
+                    os.remove(os.path.join(bucket_dir, name))
+                compacted += 1
+                logging.info(f"Compacted {len(parts)} {table} files in {bucket_name} ({merged.num_rows} rows).")
+    except Exception as e:
+        logging.error(f"Parquet compaction failed: {e}")
+        return -1
+    return compacted
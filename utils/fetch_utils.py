@@ -0,0 +1,398 @@
+########################################################################################################################
+# fetch_utils.py
+#
+# HTTP fetch layer for the blockchain API. A single client keeps a pooled keep-alive session and a list of
+# equivalent LCD endpoints, each with its own token-bucket rate limiter and health score. Requests go to the
+# healthiest endpoint, are retried with jittered exponential backoff (honouring Retry-After on 429/503), and can be
+# hedged to a second endpoint once the primary is slower than its recent latency percentile.
+#
+# Features:
+#     - Pooled persistent `requests.Session` for synchronous fetches.
+#     - Per-endpoint token-bucket rate limiting.
+#     - Jittered retries that read Retry-After; client errors (e.g. a height above the tip) fail at once.
+#     - Endpoint health scoring and optional hedged requests (sync and asyncio).
+#     - An adaptive in-flight request limit shared by every caller (`control_utils.AdaptiveConcurrencyLimit`).
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from .decode_utils import loads
+from .metrics_utils import FETCH_LATENCY
+from .control_utils import AdaptiveConcurrencyLimit
+
+from config import LCD_ENDPOINTS, \
+                   BLOCK_PATH_TEMPLATE, \
+                   HTTP_POOL_SIZE, \
+                   ENDPOINT_RATE_LIMIT, \
+                   ENDPOINT_BURST, \
+                   FETCH_TIMEOUT, \
+                   FETCH_MAX_RETRIES, \
+                   FETCH_BACKOFF_BASE, \
+                   FETCH_BACKOFF_MAX, \
+                   HEDGE_ENABLED, \
+                   HEDGE_PERCENTILE
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}  # Upstream asking us to slow down, rather than failing
+MIN_HEDGE_SAMPLES = 20  # Latency samples needed before an endpoint's percentile is trusted
+
+
+class RetryableFetchError(Exception):
+    """A fetch failed in a way that is worth retrying, optionally after a server-specified delay."""
+
+    def __init__(self, message: str, retry_after: float = None, status: int = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class PermanentFetchError(Exception):
+    """A fetch was answered with a client error (4xx other than 429) that no retry or other endpoint will fix."""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_retry_after(value: str) -> float:
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (0-based) retry attempt."""
+    return random.uniform(0, min(FETCH_BACKOFF_MAX, FETCH_BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter.
+
+    `reserve` takes a token immediately and returns how long the caller must wait before using it,
+    which lets both threads (`acquire`) and coroutines (`await asyncio.sleep(...)`) share one bucket.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return the number of seconds to wait before it is valid."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        """Block until a token is available."""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class Endpoint:
+    """An LCD endpoint with its own rate limiter, latency history and health score."""
+
+    def __init__(self, base_url: str, rate: float = ENDPOINT_RATE_LIMIT, burst: int = ENDPOINT_BURST):
+        self.base_url = base_url
+        self.bucket = TokenBucket(rate, burst)
+        self.latencies = deque(maxlen=200)
+        self.ewma_latency = 1.0
+        self.failure_rate = 0.0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def score(self) -> float:
+        """Lower is better: smoothed latency inflated by the recent failure rate."""
+        if time.monotonic() < self.cooldown_until:
+            return float("inf")
+        return self.ewma_latency * (1 + 10 * self.failure_rate)
+
+    def record(self, success: bool, latency: float, retry_after: float = None) -> None:
+        """Fold the outcome of one request into the endpoint's health."""
+        FETCH_LATENCY.observe(latency, endpoint=self.base_url, outcome="success" if success else "failure")
+        with self._lock:
+            self.latencies.append(latency)
+            self.ewma_latency = 0.8 * self.ewma_latency + 0.2 * latency
+            self.failure_rate = 0.9 * self.failure_rate + (0.0 if success else 0.1)
+            if retry_after:
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + retry_after)
+
+    def latency_percentile(self, percentile: float) -> float:
+        """Return the given latency percentile, or None until enough samples have been seen."""
+        with self._lock:
+            if len(self.latencies) < MIN_HEDGE_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class FetchClient:
+    """
+    Fetch blocks from a set of equivalent LCD endpoints.
+
+    Args:
+        endpoints (list[str]): Base URLs of equivalent LCD endpoints.
+        hedge (bool): Send a second request to the next-best endpoint when the primary is slower
+            than its HEDGE_PERCENTILE latency.
+    """
+
+    def __init__(self, endpoints: list[str] = LCD_ENDPOINTS, hedge: bool = HEDGE_ENABLED):
+        if not endpoints:
+            raise ValueError("FetchClient needs at least one LCD endpoint.")
+        self.endpoints = [Endpoint(url) for url in endpoints]
+        self.hedge = hedge
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="fetch-hedge")
+        self.concurrency = AdaptiveConcurrencyLimit()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def ranked_endpoints(self) -> list[Endpoint]:
+        """Endpoints ordered from healthiest to least healthy."""
+        return sorted(self.endpoints, key=Endpoint.score)
+
+    def _hedge_delay(self, primary: Endpoint, ranked: list[Endpoint]) -> float:
+        if not self.hedge or len(ranked) < 2:
+            return None
+        return primary.latency_percentile(HEDGE_PERCENTILE)
+
+    @staticmethod
+    def _check_status(endpoint: Endpoint, status: int, headers, latency: float) -> None:
+        """Record a failed status and raise; another attempt or endpoint may still serve the path unless it is a 4xx."""
+        if status in RETRYABLE_STATUS_CODES:
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            if retry_after is not None:
+                retry_after = min(retry_after, FETCH_BACKOFF_MAX)  # A hostile or broken header cannot stall us
+            endpoint.record(False, latency, retry_after)
+            raise RetryableFetchError(f"HTTP {status} from {endpoint.base_url}", retry_after, status)
+        if 400 <= status < 500:
+            endpoint.record(True, latency)  # The endpoint answered; the request itself is at fault
+            raise PermanentFetchError(f"HTTP {status} from {endpoint.base_url}", status)
+        if status >= 400:
+            endpoint.record(False, latency)
+            raise RetryableFetchError(f"HTTP {status} from {endpoint.base_url}", status=status)
+
+    @staticmethod
+    def _outcome(error: RetryableFetchError) -> str:
+        """Classify a failed request for the concurrency controller."""
+        return "throttled" if error.status in THROTTLE_STATUS_CODES else "error"
+
+    # ---- synchronous path -------------------------------------------------------------------------------------------
+
+    def _request_once(self, endpoint: Endpoint, path: str) -> bytes:
+        endpoint.bucket.acquire()
+        self.concurrency.acquire()
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            try:
+                response = self.session.get(endpoint.url(path), timeout=FETCH_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                endpoint.record(False, time.monotonic() - start)
+                raise RetryableFetchError(f"{type(e).__name__} from {endpoint.base_url}: {e}")
+            latency = time.monotonic() - start
+            self._check_status(endpoint, response.status_code, response.headers, latency)
+            endpoint.record(True, latency)
+            outcome = "success"
+            return response.content
+        except RetryableFetchError as e:
+            outcome = self._outcome(e)
+            raise
+        except PermanentFetchError:
+            outcome = "success"  # A prompt answer: neither throttling nor an endpoint failure
+            raise
+        finally:
+            self.concurrency.release(time.monotonic() - start, outcome)
+
+    def _request_hedged(self, path: str) -> bytes:
+        ranked = self.ranked_endpoints()
+        primary = ranked[0]
+        delay = self._hedge_delay(primary, ranked)
+        if delay is None:
+            return self._request_once(primary, path)
+
+        futures = [self._executor.submit(self._request_once, primary, path)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            logging.info(f"Hedging request for {path} to {ranked[1].base_url} after {delay:.2f}s.")
+            futures.append(self._executor.submit(self._request_once, ranked[1], path))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except RetryableFetchError as e:
+                    error = e
+        raise error
+
+    def get_raw(self, path: str) -> bytes:
+        """
+        Fetch a path from the healthiest endpoint, retrying with jittered backoff.
+
+        Returns:
+            bytes: The raw response body, or None once all retries have failed or on a client error (4xx).
+        """
+        for attempt in range(FETCH_MAX_RETRIES + 1):
+            try:
+                return self._request_hedged(path)
+            except PermanentFetchError as e:
+                logging.warning(f"Fetch of {path} failed: {e}")
+                break
+            except RetryableFetchError as e:
+                if attempt == FETCH_MAX_RETRIES:
+                    logging.error(f"Giving up on {path} after {attempt + 1} attempts: {e}")
+                    break
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt)
+                logging.error(f"Fetch of {path} failed ({e}), retrying in {delay:.2f}s.")
+                time.sleep(delay)
+        return None
+
+    def get(self, path: str) -> dict:
+        """Fetch a path and decode it fully as JSON; None if the fetch or decode fails."""
+        raw = self.get_raw(path)
+        if raw is None:
+            return None
+        try:
+            return loads(raw)
+        except ValueError as e:
+            logging.error(f"Invalid JSON returned for {path}: {e}")
+            return None
+
+    def get_block_raw(self, height: int) -> bytes:
+        """Fetch the raw response body of the block at the given height."""
+        return self.get_raw(BLOCK_PATH_TEMPLATE.format(height))
+
+    def get_latest_block_raw(self) -> bytes:
+        """Fetch the raw response body of the latest block."""
+        return self.get_raw(BLOCK_PATH_TEMPLATE.format("latest"))
+
+    # ---- asyncio path -----------------------------------------------------------------------------------------------
+
+    async def _request_once_async(self, session: "aiohttp.ClientSession", endpoint: Endpoint, path: str) -> bytes:
+        import aiohttp  # Only the asyncio engine needs it; the caller's session has already loaded it
+
+        delay = endpoint.bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        await self.concurrency.acquire_async()
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            try:
+                async with session.get(endpoint.url(path)) as response:
+                    latency = time.monotonic() - start
+                    self._check_status(endpoint, response.status, response.headers, latency)
+                    raw = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                endpoint.record(False, time.monotonic() - start)
+                raise RetryableFetchError(f"{type(e).__name__} from {endpoint.base_url}: {e}")
+            endpoint.record(True, latency)
+            outcome = "success"
+            return raw
+        except RetryableFetchError as e:
+            outcome = self._outcome(e)
+            raise
+        except PermanentFetchError:
+            outcome = "success"  # A prompt answer: neither throttling nor an endpoint failure
+            raise
+        finally:
+            self.concurrency.release(time.monotonic() - start, outcome)
+
+    async def _request_hedged_async(self, session: "aiohttp.ClientSession", path: str) -> bytes:
+        ranked = self.ranked_endpoints()
+        primary = ranked[0]
+        delay = self._hedge_delay(primary, ranked)
+        if delay is None:
+            return await self._request_once_async(session, primary, path)
+
+        tasks = [asyncio.ensure_future(self._request_once_async(session, primary, path))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(self._request_once_async(session, ranked[1], path)))
+
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        return task.result()
+                    except RetryableFetchError as e:
+                        error = e
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_raw_async(self, session: "aiohttp.ClientSession", path: str) -> bytes:
+        """Asyncio counterpart of `get_raw`, using the caller's aiohttp session."""
+        for attempt in range(FETCH_MAX_RETRIES + 1):
+            try:
+                return await self._request_hedged_async(session, path)
+            except PermanentFetchError as e:
+                logging.warning(f"Fetch of {path} failed: {e}")
+                break
+            except RetryableFetchError as e:
+                if attempt == FETCH_MAX_RETRIES:
+                    logging.error(f"Giving up on {path} after {attempt + 1} attempts: {e}")
+                    break
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt)
+                logging.error(f"Fetch of {path} failed ({e}), retrying in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+        return None
+
+    async def get_block_raw_async(self, session: "aiohttp.ClientSession", height: int) -> bytes:
+        """Fetch the raw response body of the block at the given height on an aiohttp session."""
+        return await self.get_raw_async(session, BLOCK_PATH_TEMPLATE.format(height))
+
+
+_fetch_client = None
+_fetch_client_lock = threading.Lock()
+
+
+def get_fetch_client() -> FetchClient:
+    """Return the shared fetch client, creating it on first use."""
+    global _fetch_client
+    if _fetch_client is None:
+        with _fetch_client_lock:
+            if _fetch_client is None:
+                _fetch_client = FetchClient()
+    return _fetch_client
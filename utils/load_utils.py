@@ -0,0 +1,210 @@
+########################################################################################################################
+# load_utils.py
+#
+# Bulk loading of blocks and transactions for backfills. Rows for many blocks are buffered in memory and written
+# with `COPY FROM STDIN` into temporary staging tables, then merged into `blocks` and `transactions` (and the
+# `messages` / `address_txs` message index) with the same `ON CONFLICT DO NOTHING` rule used for single-block
+# inserts. One flush is one transaction and a handful of statements, no matter how many rows it carries.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import io
+import logging
+import threading
+import time
+from psycopg2.extras import execute_values
+from .db_utils import db_transaction
+from .schema_utils import ensure_partitions
+from .metrics_utils import DB_OPERATION_SECONDS, BLOCKS_INDEXED, TXS_INDEXED
+from .control_utils import get_bulk_batch_size
+from .cache_utils import invalidate_blocks
+from .stream_utils import encode_entry
+from .transform_utils import message_rows
+from config import BULK_LOAD_WINDOW
+
+# Staging table, target table and columns of every table a flush loads, in load order
+LOAD_TABLES = (
+    ("staging_blocks", "blocks", "block_height, block_hash, timestamp, last_block_hash", "block_height"),
+    ("staging_transactions", "transactions", "tx_hash, block_id", "tx_hash, block_id"),
+    ("staging_messages", "messages", "block_id, tx_hash, msg_index, type_url, sender, recipient",
+     "tx_hash, block_id, msg_index"),
+    ("staging_address_txs", "address_txs", "address, block_id, tx_hash, msg_index, role",
+     "address, block_id, tx_hash, msg_index, role"),
+)
+
+
+def _copy_escape(value) -> str:
+    """Render a value for PostgreSQL's COPY text format."""
+    if value is None:
+        return "\\N"
+    if type(value) is int:
+        return str(value)  # Heights and indexes, the most common values, never need escaping
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_buffer(rows: list[tuple]) -> io.StringIO:
+    """Build an in-memory COPY text stream from a list of row tuples."""
+    buffer = io.StringIO()
+    buffer.writelines("\t".join(_copy_escape(value) for value in row) + "\n" for row in rows)
+    buffer.seek(0)
+    return buffer
+
+
+def insert_messages(cursor, block_height: int, messages: list[tuple]) -> None:
+    """Insert one block's decoded messages (from `decode_messages`) into the message index tables."""
+    rows, address_rows = message_rows(block_height, messages)
+    if rows:
+        execute_values(cursor, """
+            INSERT INTO messages (block_id, tx_hash, msg_index, type_url, sender, recipient) VALUES %s
+            ON CONFLICT (tx_hash, block_id, msg_index) DO NOTHING
+        """, rows)
+    if address_rows:
+        execute_values(cursor, """
+            INSERT INTO address_txs (address, block_id, tx_hash, msg_index, role) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, address_rows)
+
+
+class BulkBlockLoader:
+    """
+    Buffer block and transaction rows and load them into PostgreSQL with COPY.
+
+    A flush is due once `max_blocks` blocks are buffered or the oldest buffered block is
+    `max_window` seconds old. Without an explicit `max_blocks` the batch size follows the shared
+    adaptive controller, which sizes flushes from observed commit times. `add` only buffers, the
+    caller decides when to `flush`, and using the loader as a context manager flushes whatever is
+    left on exit.
+
+    Args:
+        max_blocks (int, optional): Fixed number of blocks per flush.
+        max_window (float): Maximum age in seconds of a buffered block before a flush is due.
+        on_commit (callable, optional): Called with the list of committed block heights after each
+            successful flush. An exception it raises propagates out of `flush` after the database
+            commit, so callers must treat those heights as stored but not yet marked.
+        changefeed (ChangefeedPublisher, optional): Publishes every committed block, one pipelined
+            batch per flush.
+    """
+
+    def __init__(self, max_blocks: int = None, max_window: float = BULK_LOAD_WINDOW, on_commit=None,
+                 changefeed=None):
+        self._max_blocks = max_blocks
+        self.changefeed = changefeed
+        self._batch_size = get_bulk_batch_size()
+        self.max_window = max_window
+        self.on_commit = on_commit
+        self._lock = threading.Lock()
+        self._block_rows = []
+        self._tx_rows = []
+        self._message_rows = []
+        self._address_rows = []
+        self._window_start = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def __len__(self):
+        return len(self._block_rows)
+
+    @property
+    def max_blocks(self) -> int:
+        return self._max_blocks if self._max_blocks is not None else self._batch_size.value
+
+    def add(self, block_height: int, block_hash: str, timestamp: str, transactions: list[str],
+            last_block_hash: str = None, message_rows: tuple = None) -> bool:
+        """
+        Buffer one block, its transactions and its message index rows (from `transform_utils.message_rows`).
+
+        Returns:
+            bool: True if a flush is now due.
+        """
+        rows, address_rows = message_rows or ((), ())
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = time.monotonic()
+            self._block_rows.append((block_height, block_hash, timestamp, last_block_hash))
+            self._tx_rows.extend((tx_hash, block_height) for tx_hash in transactions)
+            self._message_rows.extend(rows)
+            self._address_rows.extend(address_rows)
+        return self.should_flush()
+
+    def should_flush(self) -> bool:
+        """Return True if the buffer is full or its time window has elapsed."""
+        if not self._block_rows:
+            return False
+        return (len(self._block_rows) >= self.max_blocks
+                or time.monotonic() - self._window_start >= self.max_window)
+
+    def flush(self) -> list[int]:
+        """
+        COPY the buffered rows into staging tables and merge them into `blocks`, `transactions`,
+        `messages` and `address_txs`.
+
+        Returns:
+            list[int]: Heights of the blocks committed by this flush (empty if nothing was buffered
+            or the load failed).
+        """
+        with self._lock:
+            block_rows, self._block_rows = self._block_rows, []
+            tx_rows, self._tx_rows = self._tx_rows, []
+            msg_rows, self._message_rows = self._message_rows, []
+            address_rows, self._address_rows = self._address_rows, []
+            self._window_start = None
+
+        if not block_rows:
+            return []
+
+        start = time.monotonic()
+        heights = [row[0] for row in block_rows]
+        if not ensure_partitions(min(heights), max(heights)):
+            logging.error(f"Bulk load of {len(block_rows)} blocks skipped: partitions unavailable.")
+            return []
+        if self.changefeed is not None:
+            self.changefeed.prepare(heights)  # Before the commit, so a crash cannot lose the entries
+        try:
+            with db_transaction() as cursor:
+                for (staging, table, columns, conflict), rows in zip(
+                        LOAD_TABLES, (block_rows, tx_rows, msg_rows, address_rows)):
+                    if not rows:
+                        continue
+                    cursor.execute(f"""
+                        CREATE TEMP TABLE IF NOT EXISTS {staging}
+                            (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+                    """)
+                    cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN", _copy_buffer(rows))
+                    cursor.execute(f"""
+                        INSERT INTO {table} ({columns})
+                        SELECT {columns} FROM {staging}
+                        ON CONFLICT ({conflict}) DO NOTHING
+                    """)
+        except Exception as e:
+            logging.error(f"Bulk load of {len(block_rows)} blocks failed: {e}")
+            self._batch_size.record(time.monotonic() - start, len(block_rows), success=False)
+            return []
+
+        elapsed = time.monotonic() - start
+        self._batch_size.record(elapsed, len(block_rows))
+        DB_OPERATION_SECONDS.observe(elapsed, operation="bulk_load")
+        BLOCKS_INDEXED.inc(len(block_rows))
+        TXS_INDEXED.inc(len(tx_rows))
+        total_rows = len(block_rows) + len(tx_rows) + len(msg_rows) + len(address_rows)
+        logging.info(
+            f"Bulk loaded {len(block_rows)} blocks, {len(tx_rows)} transactions and {len(msg_rows)} messages "
+            f"in {elapsed:.2f}s "
+            f"({total_rows / elapsed if elapsed else 0:.0f} rows/sec)."
+        )
+
+        invalidate_blocks(heights)
+        if self.changefeed is not None:
+            tx_hashes = {}
+            for tx_hash, block_height in tx_rows:
+                tx_hashes.setdefault(block_height, []).append(tx_hash)
+            self.changefeed.publish([encode_entry(block_height, block_hash, timestamp, tx_hashes.get(block_height, []))
+                                     for block_height, block_hash, timestamp, _ in block_rows])
+        if self.on_commit:
+            self.on_commit(heights)
+        return heights
@@ -0,0 +1,233 @@
+########################################################################################################################
+# metrics_utils.py
+#
+# In-process metrics and a local HTTP endpoint that serves them in the Prometheus text exposition format.
+#
+# Features:
+#     - Thread-safe counters, gauges and histograms with labels.
+#     - The indexer's standard metrics: fetch latency per endpoint, DB and Redis operation timings, indexed blocks
+#       and transactions (for blocks/sec and txs/sec via `rate()`), gap count, and chain tip / indexed height lag.
+#     - `GET /metrics` for scraping, `GET /debug/settings` for the adaptive controllers' current settings, and an
+#       opt-in sampling profiler at `GET /debug/profile?seconds=N` that returns collapsed stacks (flame-graph input)
+#       for the whole process.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from config import METRICS_HOST, METRICS_PORT, PROFILER_ENABLED, PROFILER_INTERVAL
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(label_names, label_values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    """Base class: a named metric family with a fixed set of label names."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing value."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with a running sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of a `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.label_names, key, {"le": bound})
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# ---- indexer metrics ------------------------------------------------------------------------------------------------
+
+FETCH_LATENCY = Histogram("indexer_fetch_latency_seconds", "Block API request latency.", ("endpoint", "outcome"))
+DB_OPERATION_SECONDS = Histogram("indexer_db_operation_seconds", "PostgreSQL operation duration.", ("operation",))
+REDIS_OPERATION_SECONDS = Histogram("indexer_redis_operation_seconds", "Redis operation duration.", ("operation",))
+BLOCKS_INDEXED = Counter("indexer_blocks_indexed_total", "Blocks committed to PostgreSQL.")
+TXS_INDEXED = Counter("indexer_txs_indexed_total", "Transactions committed to PostgreSQL.")
+GAP_RANGES = Gauge("indexer_gap_ranges", "Ranges of missing heights found by the last gap check.")
+GAP_HEIGHTS = Gauge("indexer_gap_heights", "Missing heights found by the last gap check.")
+CHAIN_TIP_HEIGHT = Gauge("indexer_chain_tip_height", "Latest chain height seen upstream.")
+INDEXED_HEIGHT = Gauge("indexer_indexed_height", "Follow-mode cursor (last indexed height).")
+TIP_LAG_BLOCKS = Gauge("indexer_tip_lag_blocks", "Chain tip height minus the indexed height.")
+
+
+# ---- sampling profiler ----------------------------------------------------------------------------------------------
+
+def sample_stacks(seconds: float, interval: float = PROFILER_INTERVAL) -> str:
+    """
+    Sample every thread's stack for `seconds` and return collapsed stacks.
+
+    Each output line is `frame;frame;...;frame count`, the input format of flamegraph tools.
+    """
+    own_thread = threading.get_ident()
+    stacks = StackCounter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = ";".join(f"{entry.name} ({entry.filename}:{entry.lineno})"
+                             for entry in traceback.extract_stack(frame))
+            stacks[stack] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# ---- HTTP endpoint --------------------------------------------------------------------------------------------------
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status: int, body: str, content_type: str = "text/plain; charset=utf-8") -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self._reply(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/debug/settings":
+            from .control_utils import get_control_settings
+            self._reply(200, json.dumps(get_control_settings(), indent=2) + "\n", "application/json")
+        elif url.path == "/debug/profile" and PROFILER_ENABLED:
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", ["10"])[0])
+            except ValueError:
+                seconds = None
+            if seconds is None or not 0 < seconds < float("inf"):
+                self._reply(400, "seconds must be a positive number\n")
+                return
+            self._reply(200, sample_stacks(min(seconds, 300.0)))
+        else:
+            self._reply(404, "Not found\n")
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics endpoint: {format % args}")
+
+
+_metrics_server = None
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> ThreadingHTTPServer:
+    """
+    Serve `/metrics` (and `/debug/profile` when PROFILER_ENABLED) from a daemon thread.
+
+    Port 0 binds a free port, which is logged. Failing to bind (e.g. another indexer process already
+    serves the port) is logged as a warning and the indexer runs on without the endpoint.
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if it could not be started.
+    """
+    global _metrics_server
+    if _metrics_server is None:
+        try:
+            _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            logging.warning(f"Metrics endpoint disabled: cannot bind {host}:{port}: {e}")
+            return None
+        _metrics_server.daemon_threads = True
+        threading.Thread(target=_metrics_server.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{_metrics_server.server_address[1]}/metrics "
+                     f"(profiler {'on' if PROFILER_ENABLED else 'off'}).")
+    return _metrics_server
@@ -0,0 +1,282 @@
+########################################################################################################################
+# pipeline_utils.py
+#
+# Staged fetch -> transform -> load pipeline for backfills. Each stage runs its own workers and hands work to the
+# next through a bounded queue, so a slow stage applies backpressure upstream instead of buffering without limit:
+#
+#     heights --> [fetch threads] --> fetched --> [transform threads -> process pool] --> transformed --> [loaders]
+#
+# Fetch workers pass raw response bytes from the shared fetch client (and block archive), transform workers decode
+# the JSON and base64 txs and hash them in a process pool (archiving API responses only once they decode to the
+# requested height), and loader workers batch rows into `BulkBlockLoader` COPY flushes. Every stage keeps its own
+# counters, and the pipeline logs queue depth and throughput per stage while it runs. The transform process pool is
+# shared by every pipeline run in the process, so follow mode's small per-poll backfills do not start new processes.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .fetch_utils import get_fetch_client
+from .archive_utils import get_block_archive
+from .load_utils import BulkBlockLoader
+from .stream_utils import get_changefeed
+from .transform_utils import transform_block
+from .redis_utils import redis, mark_heights_processed
+from config import PIPELINE_FETCH_WORKERS, \
+                   PIPELINE_TRANSFORM_WORKERS, \
+                   PIPELINE_LOAD_WORKERS, \
+                   PIPELINE_QUEUE_SIZE, \
+                   PIPELINE_REPORT_INTERVAL
+
+_STOP = object()  # Queue sentinel telling a worker to exit
+
+_transform_pool = None
+_transform_pool_lock = threading.Lock()
+
+
+def get_transform_pool(workers: int = PIPELINE_TRANSFORM_WORKERS) -> ProcessPoolExecutor:
+    """Return the process-wide transform pool, created with `workers` processes on first use."""
+    global _transform_pool
+    with _transform_pool_lock:
+        if _transform_pool is None:
+            _transform_pool = ProcessPoolExecutor(max_workers=max(1, workers))
+        return _transform_pool
+
+
+def _discard_transform_pool(pool: ProcessPoolExecutor) -> None:
+    """Forget a broken pool so the next `get_transform_pool` starts a fresh one."""
+    global _transform_pool
+    with _transform_pool_lock:
+        if _transform_pool is pool:
+            _transform_pool = None
+    pool.shutdown(wait=False)
+
+
+class StageStats:
+    """Counters for one pipeline stage and the queue that feeds it."""
+
+    def __init__(self, name: str, inbox: queue.Queue):
+        self.name = name
+        self.inbox = inbox
+        self.processed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, success: bool = True, count: int = 1) -> None:
+        with self._lock:
+            if success:
+                self.processed += count
+            else:
+                self.failed += count
+
+    def snapshot(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "stage": self.name,
+            "queue_depth": self.inbox.qsize(),
+            "processed": self.processed,
+            "failed": self.failed,
+            "per_sec": self.processed / elapsed if elapsed else 0.0,
+        }
+
+
+class BlockPipeline:
+    """
+    Fetch, transform and load a set of block heights with bounded queues between stages.
+
+    Args:
+        redis_conn (redis.Redis): Connection used to mark committed heights as processed.
+        fetch_workers (int): Threads fetching blocks.
+        transform_workers (int): Processes decoding and hashing transactions.
+        load_workers (int): Threads batching rows into COPY flushes.
+        queue_size (int): Capacity of each inter-stage queue.
+    """
+
+    def __init__(self, redis_conn: redis.Redis,
+                 fetch_workers: int = PIPELINE_FETCH_WORKERS,
+                 transform_workers: int = PIPELINE_TRANSFORM_WORKERS,
+                 load_workers: int = PIPELINE_LOAD_WORKERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.redis_conn = redis_conn
+        self.fetch_workers = max(1, fetch_workers)
+        self.transform_workers = max(1, transform_workers)
+        self.load_workers = max(1, load_workers)
+
+        self.heights = queue.Queue(maxsize=queue_size)
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.transformed = queue.Queue(maxsize=queue_size)
+
+        self.fetch_stats = StageStats("fetch", self.heights)
+        self.transform_stats = StageStats("transform", self.fetched)
+        self.load_stats = StageStats("load", self.transformed)
+
+        self._committed = set()
+        self._committed_lock = threading.Lock()
+        self._done = threading.Event()
+
+    def stats(self) -> list[dict]:
+        """Return a queue-depth / throughput snapshot for every stage."""
+        return [stage.snapshot() for stage in (self.fetch_stats, self.transform_stats, self.load_stats)]
+
+    # ---- stages -----------------------------------------------------------------------------------------------------
+
+    def _fetch_worker(self) -> None:
+        client = get_fetch_client()
+        archive = get_block_archive()
+        while True:
+            height = self.heights.get()
+            if height is _STOP:
+                return
+            try:
+                raw = archive.get_raw(height) if archive is not None else None
+                archived = raw is not None
+                if raw is None:
+                    raw = client.get_block_raw(height)
+            except Exception as e:
+                logging.error(f"Error fetching block {height}: {e}")
+                raw = None
+
+            if raw:
+                self.fetch_stats.record()
+                self.fetched.put((height, raw, archived))  # Raw bytes: JSON decoding happens in the process pool
+            else:
+                logging.error(f"Failed to fetch block: {height}")
+                self.fetch_stats.record(success=False)
+
+    @staticmethod
+    def _transform(pool: ProcessPoolExecutor, height: int, raw: bytes) -> tuple:
+        """Transform `raw` in the pool, or return None unless it is a usable block at `height`."""
+        try:
+            record = pool.submit(transform_block, raw).result()
+        except BrokenProcessPool as e:
+            logging.error(f"Transform pool failed on block {height}: {e}")
+            _discard_transform_pool(pool)
+            return None
+        except Exception as e:
+            logging.error(f"Error transforming block {height}: {e}")
+            return None
+        if record is not None and record[0] != height:
+            logging.error(f"Response for block {height} holds block {record[0]}.")
+            return None
+        return record
+
+    def _transform_worker(self, pool: ProcessPoolExecutor) -> None:
+        archive = get_block_archive()
+        while True:
+            item = self.fetched.get()
+            if item is _STOP:
+                return
+            height, raw, archived = item
+            try:
+                record = self._transform(pool, height, raw)
+                if record is None and archived:
+                    logging.warning(f"Archived copy of block {height} is unusable; refetching it.")
+                    raw = get_fetch_client().get_block_raw(height)
+                    record = self._transform(pool, height, raw) if raw else None
+                    archived = False
+                if record is not None and archive is not None and not archived:
+                    archive.put_raw(height, raw, replace=True)  # Only responses that decoded to `height` are archived
+            except Exception as e:
+                logging.error(f"Error transforming block {height}: {e}")
+                record = None
+
+            if record is None:
+                self.transform_stats.record(success=False)
+                continue
+            self.transform_stats.record()
+            self.transformed.put(record)
+
+    def _on_commit(self, heights: list[int]) -> None:
+        mark_heights_processed(self.redis_conn, heights)
+        with self._committed_lock:
+            self._committed.update(heights)
+        self.load_stats.record(count=len(heights))
+
+    def _flush(self, loader: BulkBlockLoader) -> None:
+        """Flush `loader`, counting its blocks as failed if the flush or its commit callback raises."""
+        pending = len(loader)
+        try:
+            loader.flush()
+        except Exception as e:
+            # The rows may already be committed; their heights stay unmarked and are reported as failed
+            logging.error(f"Error flushing {pending} blocks: {e}")
+            self.load_stats.record(success=False, count=pending)
+
+    def _load_worker(self) -> None:
+        loader = BulkBlockLoader(on_commit=self._on_commit, changefeed=get_changefeed(self.redis_conn))
+        while True:
+            try:
+                record = self.transformed.get(timeout=loader.max_window)
+            except queue.Empty:
+                if loader.should_flush():
+                    self._flush(loader)
+                continue
+            if record is _STOP:
+                self._flush(loader)
+                return
+            try:
+                flush_due = loader.add(*record)
+            except Exception as e:
+                logging.error(f"Error buffering block {record[0]}: {e}")
+                self.load_stats.record(success=False)
+                continue
+            if flush_due:
+                self._flush(loader)
+
+    def _report(self) -> None:
+        while not self._done.wait(PIPELINE_REPORT_INTERVAL):
+            for stage in self.stats():
+                logging.info(
+                    f"Pipeline {stage['stage']}: queue={stage['queue_depth']} processed={stage['processed']} "
+                    f"failed={stage['failed']} ({stage['per_sec']:.1f}/sec)"
+                )
+
+    # ---- driver -----------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _start(count: int, target, *args) -> list[threading.Thread]:
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self, heights: list[int]) -> dict:
+        """
+        Push `heights` through the pipeline and wait for every stage to drain.
+
+        Returns:
+            dict: Per-height accounting, {"succeeded": list[int], "failed": list[int]}.
+        """
+        reporter = threading.Thread(target=self._report, daemon=True)
+        reporter.start()
+
+        pool = get_transform_pool(self.transform_workers)
+        fetchers = self._start(self.fetch_workers, self._fetch_worker)
+        transformers = self._start(self.transform_workers, self._transform_worker, pool)
+        loaders = self._start(self.load_workers, self._load_worker)
+
+        for height in heights:
+            self.heights.put(int(height))  # Blocks while the fetch stage is saturated
+
+        # Drain stage by stage: each stage is told to stop only once everything upstream has finished
+        for stage_threads, inbox in ((fetchers, self.heights),
+                                     (transformers, self.fetched),
+                                     (loaders, self.transformed)):
+            for _ in stage_threads:
+                inbox.put(_STOP)
+            for thread in stage_threads:
+                thread.join()
+
+        self._done.set()
+        reporter.join()
+
+        results = {"succeeded": [], "failed": []}
+        for height in heights:
+            results["succeeded" if int(height) in self._committed else "failed"].append(int(height))
+        return results
@@ -5,6 +5,12 @@
 # Provides functions to interact with Redis for saving and retrieving information about missing blocks 
 # or gaps in the block sequence. Includes utility functions to store, retrieve, and clear missing blocks.
 #
+# Processed heights are kept in a Redis bitmap indexed by height and missing heights are kept as ranges, so
+# gap detection costs time proportional to the number of gaps rather than the number of processed blocks.
+# Marking heights as processed is a Lua script call per batch, so it is atomic and costs one round-trip; whole
+# bytes of the bitmap are written with one SETRANGE and large batches are split into bounded calls, so marking
+# millions of heights never stalls the server.
+#
 # Developed by: Don Fox
 # Date: 07/02/2024
 #######################################################################################################################
@@ -15,6 +21,7 @@ import logging
 from redis import Redis
 from redis.exceptions import RedisError, ConnectionError, TimeoutError, AuthenticationError
 from config import REDIS_CONFIG
+from .metrics_utils import REDIS_OPERATION_SECONDS
 import time
 from tenacity import retry, stop_after_attempt, wait_exponential
 
@@ -45,41 +52,235 @@ def get_redis_connection() -> Redis:
         raise redis_err
 
 
-def store_missing_blocks(redis_conn: Redis, missing_blocks: list[int]) -> None:
-    """Store a list of missing block numbers in Redis."""
-    if not missing_blocks:
+PROCESSED_HEIGHTS_KEY = 'processed_heights'       # Bitmap, bit N set once block N is stored
+PROCESSED_BOUNDS_KEY = 'processed_height_bounds'  # Sorted set holding the 'min' and 'max' processed heights
+MISSING_RANGES_KEY = 'missing_block_ranges'       # Sorted set of "start:end" ranges scored by start
+LEGACY_PROCESSED_KEY = 'processed_blocks'         # Pre-bitmap set of processed heights
+INDEX_CURSOR_KEY = 'last_indexed_height'          # Follow-mode cursor: every height up to it has been handled
+
+
+MARK_MAX_SPAN = 8 * 1024 * 1024  # Heights marked per script call (at most 1 MiB of bitmap written)
+MARK_MAX_RANGES = 1000           # Ranges per script call (each costs at most 14 SETBITs for its partial bytes)
+
+# Marks inclusive height ranges (ARGV = start1, end1, start2, end2, ...) as processed and widens the bounds,
+# atomically and in one round-trip. Whole bytes of a range are set with one SETRANGE of 0xFF bytes (counting
+# the bits already set with BITCOUNT first); only the partial bytes at either end are set bit by bit.
+# Returns the number of heights that were not already marked.
+MARK_PROCESSED_SCRIPT = """
+local lowest, highest
+local added = 0
+local function set_bits(first, last)
+    for height = first, last do
+        if redis.call('SETBIT', KEYS[1], height, 1) == 0 then
+            added = added + 1
+        end
+    end
+end
+for i = 1, #ARGV, 2 do
+    local first, last = tonumber(ARGV[i]), tonumber(ARGV[i + 1])
+    local first_byte, last_byte = math.floor((first + 7) / 8), math.floor((last + 1) / 8) - 1
+    if first_byte > last_byte then
+        set_bits(first, last)
+    else
+        set_bits(first, first_byte * 8 - 1)
+        set_bits((last_byte + 1) * 8, last)
+        local already = redis.call('BITCOUNT', KEYS[1], first_byte, last_byte)
+        redis.call('SETRANGE', KEYS[1], first_byte, string.rep('\\255', last_byte - first_byte + 1))
+        added = added + (last_byte - first_byte + 1) * 8 - already
+    end
+    if not lowest or first < lowest then lowest = first end
+    if not highest or last > highest then highest = last end
+end
+if lowest then
+    redis.call('ZADD', KEYS[2], 'LT', lowest, 'min')
+    redis.call('ZADD', KEYS[2], 'GT', highest, 'max')
+end
+return added
+"""
+
+
+def _mark_batches(ranges: list[tuple[int, int]]):
+    """Split ranges into script-call batches of at most MARK_MAX_RANGES ranges and MARK_MAX_SPAN heights."""
+    batch, span = [], 0
+    for start, end in ranges:
+        start, end = int(start), int(end)
+        while start <= end:
+            if len(batch) == MARK_MAX_RANGES or span == MARK_MAX_SPAN:
+                yield batch
+                batch, span = [], 0
+            piece_end = min(end, start + MARK_MAX_SPAN - span - 1)
+            batch.append((start, piece_end))
+            span += piece_end - start + 1
+            start = piece_end + 1
+    if batch:
+        yield batch
+
+
+def mark_ranges_processed(redis_conn: Redis, ranges: list[tuple[int, int]]) -> int:
+    """
+    Mark inclusive (start, end) height ranges as processed with server-side script calls.
+
+    A typical batch takes one call; very large or fragmented batches (e.g. a cold reconcile) are split
+    into bounded calls so no single call blocks Redis for long. Each call is atomic on its own.
+
+    Returns:
+        int: The number of heights that were newly marked.
+    """
+    if not ranges:
+        return 0
+    script = redis_conn.register_script(MARK_PROCESSED_SCRIPT)
+    added = 0
+    for batch in _mark_batches(ranges):
+        argv = [bound for start, end in batch for bound in (start, end)]
+        with REDIS_OPERATION_SECONDS.time(operation="mark_processed"):
+            added += script(keys=[PROCESSED_HEIGHTS_KEY, PROCESSED_BOUNDS_KEY], args=argv)
+    return added
+
+
+def mark_heights_processed(redis_conn: Redis, heights: list[int]) -> int:
+    """Mark a batch of block heights as processed in one atomic round-trip; returns the number newly marked."""
+    if not heights:
+        return 0
+    return mark_ranges_processed(redis_conn, compress_heights(heights))
+
+
+def is_height_processed(redis_conn: Redis, height: int) -> bool:
+    """Return True if the block at `height` has been marked as processed."""
+    with REDIS_OPERATION_SECONDS.time(operation="is_processed"):
+        return bool(redis_conn.getbit(PROCESSED_HEIGHTS_KEY, int(height)))
+
+
+def get_unprocessed_heights(redis_conn: Redis, start: int, end: int) -> list[int]:
+    """
+    Return the heights from `start` to `end` (inclusive) that are not marked as processed.
+
+    The covering bytes of the bitmap are read with one GETRANGE and decoded locally.
+    """
+    with REDIS_OPERATION_SECONDS.time(operation="unprocessed_heights"):
+        chunk = redis_conn.getrange(PROCESSED_HEIGHTS_KEY, start // 8, end // 8)
+    base = (start // 8) * 8
+    return [height for height in range(start, end + 1)
+            if (height - base) // 8 >= len(chunk) or not chunk[(height - base) // 8] & (0x80 >> (height % 8))]
+
+
+def get_processed_bounds(redis_conn: Redis) -> tuple:
+    """Return the (lowest, highest) processed heights, or None if nothing has been processed."""
+    bounds = dict(redis_conn.zrange(PROCESSED_BOUNDS_KEY, 0, -1, withscores=True))
+    if b'min' not in bounds or b'max' not in bounds:
+        return None
+    return int(bounds[b'min']), int(bounds[b'max'])
+
+
+def migrate_processed_set(redis_conn: Redis, batch_size: int = 10000) -> int:
+    """
+    Move heights from the legacy `processed_blocks` set into the processed-heights bitmap.
+
+    The set is scanned incrementally (SSCAN) and deleted once copied.
+
+    Returns:
+        int: The number of heights migrated.
+    """
+    if not redis_conn.exists(LEGACY_PROCESSED_KEY):
+        return 0
+
+    migrated = 0
+    batch = []
+    for member in redis_conn.sscan_iter(LEGACY_PROCESSED_KEY, count=batch_size):
+        batch.append(int(member))
+        if len(batch) >= batch_size:
+            mark_heights_processed(redis_conn, batch)
+            migrated += len(batch)
+            batch = []
+    mark_heights_processed(redis_conn, batch)
+    migrated += len(batch)
+
+    redis_conn.delete(LEGACY_PROCESSED_KEY)
+    logging.info(f"Migrated {migrated} heights from '{LEGACY_PROCESSED_KEY}' to the '{PROCESSED_HEIGHTS_KEY}' bitmap.")
+    return migrated
+
+
+def find_gap_ranges(redis_conn: Redis) -> list[tuple[int, int]]:
+    """
+    Find the unprocessed height ranges between the lowest and highest processed heights.
+
+    Uses BITPOS on the processed-heights bitmap (Redis 7+ BIT mode), so the work is two server-side
+    scans per gap rather than a transfer of every processed height.
+
+    Returns:
+        list[tuple[int, int]]: Inclusive (start, end) ranges of missing heights, in ascending order.
+    """
+    bounds = get_processed_bounds(redis_conn)
+    if bounds is None:
+        return []
+
+    lowest, highest = bounds
+    ranges = []
+    position = lowest
+    with REDIS_OPERATION_SECONDS.time(operation="find_gaps"):
+        while position <= highest:
+            gap_start = redis_conn.bitpos(PROCESSED_HEIGHTS_KEY, 0, position, highest, mode="BIT")
+            if gap_start == -1:
+                break
+            # `highest` is always set, so a set bit is guaranteed after the gap
+            gap_end = redis_conn.bitpos(PROCESSED_HEIGHTS_KEY, 1, gap_start, highest, mode="BIT") - 1
+            ranges.append((gap_start, gap_end))
+            position = gap_end + 1
+    return ranges
+
+
+def expand_ranges(ranges: list[tuple[int, int]]) -> list[int]:
+    """Expand inclusive (start, end) height ranges into a list of heights."""
+    return [height for start, end in ranges for height in range(start, end + 1)]
+
+
+def get_index_cursor(redis_conn: Redis) -> int:
+    """Return the follow-mode cursor (last indexed height), or None if it has never been set."""
+    cursor = redis_conn.get(INDEX_CURSOR_KEY)
+    return int(cursor) if cursor is not None else None
+
+
+def set_index_cursor(redis_conn: Redis, height: int) -> None:
+    """Persist the follow-mode cursor."""
+    redis_conn.set(INDEX_CURSOR_KEY, int(height))
+
+
+def compress_heights(heights: list[int]) -> list[tuple[int, int]]:
+    """Collapse block heights into sorted, inclusive (start, end) ranges."""
+    ranges = []
+    for height in sorted(set(map(int, heights))):
+        if ranges and height == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], height)
+        else:
+            ranges.append((height, height))
+    return ranges
+
+
+def store_missing_blocks(redis_conn: Redis, missing_ranges: list[tuple[int, int]]) -> None:
+    """Store inclusive (start, end) ranges of missing block heights in Redis."""
+    if not missing_ranges:
         logging.info("No missing blocks to store.")
         return
     try:
-        with redis_conn.pipeline() as pipe:  # Batch Redis operations
-            for block in missing_blocks:
-                pipe.sadd('missing_blocks', block)
-            pipe.execute()
-        logging.info(f"Stored {len(missing_blocks)} missing blocks in Redis: {missing_blocks}")
+        redis_conn.zadd(MISSING_RANGES_KEY, {f"{start}:{end}": start for start, end in missing_ranges})
+        logging.info(f"Stored {len(missing_ranges)} missing block ranges in Redis: {missing_ranges}")
     except RedisError as e:
-        logging.error(f"Failed to store missing blocks in Redis: {missing_blocks}. Error: {e}")
+        logging.error(f"Failed to store missing block ranges in Redis: {missing_ranges}. Error: {e}")
 
 
-def get_missing_blocks(redis_conn: Redis) -> list[int]:
-    """Retrieves list of missing blocks (decoded from bytes to integers) from Redis ."""
+def get_missing_blocks(redis_conn: Redis) -> list[tuple[int, int]]:
+    """Retrieves the missing block ranges from Redis as inclusive (start, end) tuples, in ascending order."""
     try:
-        missing_blocks = redis_conn.smembers('missing_blocks')
-        return [int(block.decode('utf-8')) for block in missing_blocks]
+        members = redis_conn.zrange(MISSING_RANGES_KEY, 0, -1)
+        return [tuple(map(int, member.decode('utf-8').split(':'))) for member in members]
     except RedisError as e:
         logging.error(f"Failed to retrieve missing blocks from Redis: {e}")
         return []
 
 
 def clear_missing_blocks(redis_conn: Redis) -> None:
-    """Clears the set of missing blocks from Redis."""
+    """Clears the missing block ranges from Redis."""
     try:
-        redis_conn.delete('missing_blocks')
+        redis_conn.delete(MISSING_RANGES_KEY)
         logging.info("Successfully cleared missing blocks from Redis.")
     except RedisError as e:
         logging.error(f"Failed to clear missing blocks from Redis: {e}")
-
-
-
-
-
-        
@@ -0,0 +1,454 @@
+########################################################################################################################
+# schema_utils.py
+#
+# Versioned PostgreSQL schema for the indexer, applied at startup by `ensure_schema`.
+#
+# Features:
+#     - Numbered migrations recorded in `schema_migrations`, applied in order under an advisory lock so several
+#       indexer processes can start at once.
+#     - `blocks` and `transactions` are range-partitioned by block height (`block_height` / `block_id`), one
+#       partition per PARTITION_SIZE heights, so inserts and range scans touch a bounded amount of index.
+#     - Partitions are created on demand by `ensure_partitions` before rows are written.
+#     - BRIN index on `blocks.timestamp`, B-tree indexes on `blocks.block_hash` and `transactions.block_id`.
+#     - `messages` (one row per decoded Cosmos SDK message) and `address_txs` (one row per address a message
+#       touches) are partitioned the same way. Address lookups seek the `address_txs` primary key and message-type
+#       lookups seek a covering index, so neither needs to visit the heap.
+#     - Secondary indexes can be dropped for a large bulk backfill and rebuilt once it has finished
+#       (`deferred_secondary_indexes`). Rebuilds run partition by partition with CREATE INDEX CONCURRENTLY, so
+#       writers and readers are never blocked while an index is built. Long-running readers in any process (the
+#       query API, follow mode) hold a shared advisory lock (`hold_secondary_indexes`) that keeps them in place.
+#     - Tables created by the old hand-run `schema.sql` are migrated into the partitioned layout, with the legacy
+#       base64 tx payloads replaced by their SHA-256 transaction hashes.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from .db_utils import db_transaction, get_db_connection, connect_to_db, close_db_connection
+from config import PARTITION_SIZE
+
+SCHEMA_LOCK_ID = 727_001  # pg_advisory_xact_lock key serialising migrations and partition DDL
+INDEX_BUILD_LOCK_ID = 727_002  # pg_try_advisory_lock key letting one process at a time rebuild indexes
+INDEX_READERS_LOCK_ID = 727_003  # Held shared by processes relying on the secondary indexes, exclusive while deferred
+INDEX_READERS_RECHECK = 30  # Seconds between checks that the connection holding the shared lock is still alive
+PARTITIONED_TABLES = {"blocks": "block_height", "transactions": "block_id", "messages": "block_id",
+                      "address_txs": "block_id"}
+
+# Secondary indexes are everything except the primary keys: name -> (table, index definition). They are created on
+# the partitioned parents and cascade to every partition. They are the ones worth deferring during a bulk backfill.
+SECONDARY_INDEXES = {
+    "blocks_timestamp_brin": ("blocks", "USING brin (timestamp)"),
+    "blocks_block_hash_idx": ("blocks", "(block_hash)"),
+    "transactions_block_id_idx": ("transactions", "(block_id)"),
+    "messages_type_url_idx": ("messages", "(type_url, block_id, tx_hash, msg_index) INCLUDE (sender, recipient)"),
+}
+
+_partitions = None  # Partition numbers known to exist, loaded on first use
+_partitions_lock = threading.Lock()
+
+
+def _create_index_sql(name: str) -> str:
+    """Return the CREATE INDEX statement of a secondary index on its partitioned parent."""
+    table, definition = SECONDARY_INDEXES[name]
+    return f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}"
+
+
+def _existing_partitions(cursor) -> set[int]:
+    """Read the partition numbers of `blocks` from the catalog."""
+    cursor.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'blocks'
+    """)
+    return {int(name.rsplit("_p", 1)[1]) for (name,) in cursor.fetchall() if name.rsplit("_p", 1)[-1].isdigit()}
+
+
+def _create_partitions(cursor, numbers, tables=PARTITIONED_TABLES) -> None:
+    """Create the partitions of every partitioned table (or of `tables`) for the given partition numbers."""
+    for number in sorted(numbers):
+        lower, upper = number * PARTITION_SIZE, (number + 1) * PARTITION_SIZE
+        for table in tables:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table}_p{number:05d} PARTITION OF {table} "
+                f"FOR VALUES FROM ({lower}) TO ({upper})"
+            )
+        logging.info(f"Created partitions for heights {lower}-{upper - 1}.")
+
+
+def ensure_partitions(first_height: int, last_height: int = None) -> bool:
+    """
+    Make sure partitions exist for every height from `first_height` to `last_height`.
+
+    Known partitions are cached, so the common case (partitions already exist) costs no round-trip.
+
+    Returns:
+        bool: True if the partitions exist, False if creating them failed.
+    """
+    global _partitions
+    last_height = first_height if last_height is None else last_height
+    needed = set(range(first_height // PARTITION_SIZE, last_height // PARTITION_SIZE + 1))
+    if _partitions is not None and needed <= _partitions:
+        return True
+
+    with _partitions_lock:
+        try:
+            with db_transaction() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+                existing = _existing_partitions(cursor)
+                _create_partitions(cursor, needed - existing)
+            _partitions = existing | needed
+            return True
+        except Exception as e:
+            logging.error(f"Failed to create partitions for heights {first_height}-{last_height}: {e}")
+            _partitions = None
+            return False
+
+
+def _legacy_tables(cursor) -> list[str]:
+    """Return the indexer tables that exist as plain (unpartitioned) tables."""
+    cursor.execute("""
+        SELECT relname FROM pg_class
+        WHERE relname IN ('blocks', 'transactions') AND relkind = 'r'
+          AND relnamespace = 'public'::regnamespace
+    """)
+    return [name for (name,) in cursor.fetchall()]
+
+
+def _migration_1_partitioned_tables(cursor) -> None:
+    """Create the partitioned `blocks` and `transactions` tables, moving any unpartitioned data across."""
+    legacy = _legacy_tables(cursor)
+    for table in legacy:
+        # Index names share the table namespace, so free up e.g. `blocks_pkey` for the new table
+        cursor.execute("""
+            SELECT idx.relname FROM pg_index
+            JOIN pg_class idx ON idx.oid = pg_index.indexrelid
+            WHERE pg_index.indrelid = %s::regclass
+        """, (table,))
+        for (index_name,) in cursor.fetchall():
+            cursor.execute(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_legacy"')
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blocks (
+            block_height BIGINT NOT NULL,
+            block_hash TEXT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (block_height)
+        ) PARTITION BY RANGE (block_height)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            tx_hash TEXT NOT NULL,
+            block_id BIGINT NOT NULL,
+            PRIMARY KEY (tx_hash, block_id)
+        ) PARTITION BY RANGE (block_id)
+    """)
+
+    if "blocks" in legacy:
+        cursor.execute("SELECT MIN(block_height::bigint), MAX(block_height::bigint) FROM blocks_legacy")
+        low, high = cursor.fetchone()
+        if low is not None:
+            _create_partitions(cursor, range(low // PARTITION_SIZE, high // PARTITION_SIZE + 1),
+                               tables=("blocks", "transactions"))
+            cursor.execute("""
+                INSERT INTO blocks (block_height, block_hash, timestamp)
+                SELECT block_height::bigint, block_hash::text, timestamp::timestamptz FROM blocks_legacy
+            """)
+            logging.info(f"Moved {cursor.rowcount} blocks into the partitioned blocks table.")
+    if "transactions" in legacy:
+        cursor.execute("SELECT MIN(block_id::bigint), MAX(block_id::bigint) FROM transactions_legacy")
+        low, high = cursor.fetchone()
+        if low is not None:
+            existing = _existing_partitions(cursor)
+            _create_partitions(cursor, set(range(low // PARTITION_SIZE, high // PARTITION_SIZE + 1)) - existing,
+                               tables=("blocks", "transactions"))
+            # The legacy schema stored the base64 tx payload as `tx_hash`; store its real hash instead
+            cursor.execute("""
+                INSERT INTO transactions (tx_hash, block_id)
+                SELECT CASE WHEN tx_hash::text ~ '^[0-9A-F]{64}$' THEN tx_hash::text
+                            ELSE upper(encode(sha256(decode(tx_hash::text, 'base64')), 'hex')) END,
+                       block_id::bigint
+                FROM transactions_legacy
+                ON CONFLICT DO NOTHING
+            """)
+            logging.info(f"Moved {cursor.rowcount} transactions into the partitioned transactions table.")
+    for table in legacy:
+        cursor.execute(f"DROP TABLE {table}_legacy CASCADE")
+
+    # Built after any data copy so the indexes are created in one pass
+    for name in ("blocks_timestamp_brin", "blocks_block_hash_idx", "transactions_block_id_idx"):
+        cursor.execute(_create_index_sql(name))
+
+
+def _migration_2_last_block_hash(cursor) -> None:
+    """Store each block's header `last_block_id.hash` so the chain linkage can be verified."""
+    cursor.execute("ALTER TABLE blocks ADD COLUMN IF NOT EXISTS last_block_hash TEXT")
+
+
+def _migration_3_message_index(cursor) -> None:
+    """
+    Create the decoded message index: `messages` and `address_txs`, partitioned like `transactions`.
+
+    Blocks indexed before this migration have no message rows; replaying them from the raw block
+    archive (`main.py replay`) fills them in.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            block_id BIGINT NOT NULL,
+            tx_hash TEXT NOT NULL,
+            msg_index INTEGER NOT NULL,
+            type_url TEXT NOT NULL,
+            sender TEXT,
+            recipient TEXT,
+            PRIMARY KEY (tx_hash, block_id, msg_index)
+        ) PARTITION BY RANGE (block_id)
+    """)
+    # The primary key doubles as the covering index for "transactions touching an address", newest first
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS address_txs (
+            address TEXT NOT NULL,
+            block_id BIGINT NOT NULL,
+            tx_hash TEXT NOT NULL,
+            msg_index INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            PRIMARY KEY (address, block_id, tx_hash, msg_index, role)
+        ) PARTITION BY RANGE (block_id)
+    """)
+    _create_partitions(cursor, _existing_partitions(cursor), tables=("messages", "address_txs"))
+    cursor.execute(_create_index_sql("messages_type_url_idx"))
+
+
+# (version, description, callable(cursor)); append new migrations, never edit applied ones
+MIGRATIONS = [
+    (1, "Partitioned blocks and transactions tables", _migration_1_partitioned_tables),
+    (2, "blocks.last_block_hash for chain verification", _migration_2_last_block_hash),
+    (3, "messages and address_txs tables for the message index", _migration_3_message_index),
+]
+
+
+def ensure_schema() -> int:
+    """
+    Apply any pending schema migrations and rebuild missing secondary indexes.
+
+    Each migration runs in its own transaction together with its `schema_migrations` row. Secondary
+    indexes can only be missing if a bulk backfill was interrupted before rebuilding them; when none
+    is missing the check costs a single catalog query.
+
+    Returns:
+        int: The schema version after migrating, or -1 if a migration failed.
+    """
+    version = 0
+    try:
+        with db_transaction() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+
+        for migration_version, description, migrate in MIGRATIONS:
+            with db_transaction() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+                cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (migration_version,))
+                if not cursor.fetchall():
+                    start = time.monotonic()
+                    migrate(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (migration_version, description)
+                    )
+                    logging.info(f"Applied schema migration {migration_version} ({description}) "
+                                 f"in {time.monotonic() - start:.2f}s.")
+            version = migration_version
+    except Exception as e:
+        logging.error(f"Schema migration {version + 1} failed: {e}")
+        return -1
+
+    build_secondary_indexes()
+    return version
+
+
+def drop_secondary_indexes() -> bool:
+    """Drop the secondary indexes (from the parents and every partition) ahead of a bulk load."""
+    try:
+        with db_transaction() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = '5s'")  # Never queue every other session behind the drop
+            for name in SECONDARY_INDEXES:
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        logging.info(f"Dropped secondary indexes {', '.join(SECONDARY_INDEXES)}.")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to drop secondary indexes: {e}")
+        return False
+
+
+@contextmanager
+def _autocommit_cursor():
+    """Yield a cursor on a pooled connection in autocommit mode, for DDL that cannot run inside a transaction."""
+    with get_db_connection() as connection:
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+        finally:
+            if not connection.closed:
+                connection.autocommit = False
+
+
+def _build_index_concurrently(cursor, name: str) -> None:
+    """
+    Build one secondary index partition by partition without blocking writes.
+
+    CREATE INDEX CONCURRENTLY is not supported on a partitioned table, so the parent index is created
+    `ON ONLY` the parent (invalid until complete), each partition's index is built CONCURRENTLY and
+    attached, and the parent index becomes valid once every partition is attached. An interrupted
+    build resumes with the partitions that are not attached yet.
+    """
+    table, definition = SECONDARY_INDEXES[name]
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    cursor.execute("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_inherits attached
+              JOIN pg_index ON pg_index.indexrelid = attached.inhrelid
+              WHERE attached.inhparent = %s::regclass AND pg_index.indrelid = child.oid
+          )
+        ORDER BY child.relname
+    """, (table, name))
+    for (partition,) in cursor.fetchall():
+        partition_index = f"{name}_{partition.rsplit('_', 1)[1]}"
+        # A CONCURRENTLY build that was interrupted leaves an invalid index behind; it must be rebuilt
+        cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (partition_index,))
+        if any(invalid for (invalid,) in cursor.fetchall()):
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {partition_index}")
+        cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} {definition}")
+        cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def build_secondary_indexes() -> bool:
+    """
+    Create any missing (or half-built) secondary indexes; valid indexes are left alone.
+
+    Indexes are built CONCURRENTLY per partition outside any transaction, so writers and the query API
+    keep running. Only one process builds at a time; the others skip the rebuild.
+    """
+    try:
+        start = time.monotonic()
+        with _autocommit_cursor() as cursor:
+            cursor.execute("""
+                SELECT idx.relname FROM pg_index
+                JOIN pg_class idx ON idx.oid = pg_index.indexrelid
+                WHERE idx.relname = ANY(%s) AND pg_index.indisvalid
+                  AND idx.relnamespace = 'public'::regnamespace
+            """, (list(SECONDARY_INDEXES),))
+            missing = set(SECONDARY_INDEXES) - {name for (name,) in cursor.fetchall()}
+            if not missing:
+                return True
+
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (INDEX_BUILD_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                logging.info("Another process is building secondary indexes; skipping.")
+                return True
+            try:
+                for name in sorted(missing):
+                    _build_index_concurrently(cursor, name)
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (INDEX_BUILD_LOCK_ID,))
+        logging.info(f"Built secondary indexes {', '.join(sorted(missing))} "
+                     f"in {time.monotonic() - start:.2f}s.")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to build secondary indexes: {e}")
+        return False
+
+
+_index_reader_thread = None
+_index_reader_lock = threading.Lock()
+
+
+def _hold_index_readers_lock() -> None:
+    """Hold INDEX_READERS_LOCK_ID shared on a dedicated connection, re-taking it whenever the connection drops."""
+    while True:
+        connection = connect_to_db()
+        try:
+            if connection is not None:
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_lock_shared(%s)", (INDEX_READERS_LOCK_ID,))
+                    if not cursor.fetchone()[0]:
+                        logging.warning("A backfill has the secondary indexes dropped; queries may be slow "
+                                        "until it rebuilds them.")
+                        cursor.execute("SELECT pg_advisory_lock_shared(%s)", (INDEX_READERS_LOCK_ID,))
+                    while True:
+                        time.sleep(INDEX_READERS_RECHECK)
+                        cursor.execute("SELECT 1")  # A lost connection has released the lock
+        except Exception as e:
+            logging.warning(f"Lost the secondary index reader lock, taking it again: {e}")
+        finally:
+            close_db_connection(connection)
+        time.sleep(5)
+
+
+def hold_secondary_indexes() -> None:
+    """
+    Keep every process's large backfills from dropping the secondary indexes while this process runs.
+
+    A daemon thread holds INDEX_READERS_LOCK_ID shared on its own connection for the life of the process;
+    `deferred_secondary_indexes` only drops the indexes when it can take that lock exclusively. If a
+    backfill already has them dropped, the lock is taken as soon as the indexes are rebuilt.
+    """
+    global _index_reader_thread
+    with _index_reader_lock:
+        if _index_reader_thread is None:
+            _index_reader_thread = threading.Thread(target=_hold_index_readers_lock, name="index-readers-lock",
+                                                    daemon=True)
+            _index_reader_thread.start()
+
+
+@contextmanager
+def deferred_secondary_indexes(enabled: bool = True):
+    """
+    Drop the secondary indexes for the duration of a `with` block and rebuild them afterwards.
+
+    Building an index once over loaded data is far cheaper than maintaining it row by row during a
+    large bulk backfill. The indexes are rebuilt even if the block raises. Dropping them affects every
+    session using the tables, so INDEX_READERS_LOCK_ID is held exclusively for the whole block: while
+    any process holds it shared (`hold_secondary_indexes`), the block runs with the indexes in place.
+
+    Args:
+        enabled (bool): When False the block runs with the indexes in place.
+    """
+    connection = connect_to_db() if enabled else None
+    try:
+        locked = False
+        if connection is not None:
+            try:
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_lock(%s)", (INDEX_READERS_LOCK_ID,))
+                    locked = cursor.fetchone()[0]
+                if not locked:
+                    logging.info("Other processes rely on the secondary indexes; keeping them for this backfill.")
+            except Exception as e:
+                logging.error(f"Failed to take the secondary index lock, keeping the indexes: {e}")
+        if not locked:
+            yield
+            return
+
+        drop_secondary_indexes()
+        try:
+            yield
+        finally:
+            build_secondary_indexes()
+    finally:
+        close_db_connection(connection)  # Ends the session, releasing the lock
@@ -0,0 +1,317 @@
+########################################################################################################################
+# shard_utils.py
+#
+# Distributed backfill: several indexer processes, on any number of nodes, share one backfill through Redis.
+#
+# Features:
+#     - Missing height ranges are split into fixed-size shard ranges and queued in a Redis sorted set.
+#     - Workers claim a range with a lease that expires unless renewed by a heartbeat thread.
+#     - Progress is checkpointed after every chunk, so a range held by a dead worker is re-queued from its
+#       checkpoint the next time any worker claims work.
+#     - Every claim, heartbeat and release is a single Lua script, so lease ownership changes atomically.
+#     - Heights already marked in the processed-heights bitmap are skipped, so a re-queued range only fetches the
+#       heights its previous owner did not commit.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from .block_utils import backfill_missing_blocks
+from .metrics_utils import Counter, REDIS_OPERATION_SECONDS
+from .redis_utils import redis, get_unprocessed_heights
+from config import SHARD_RANGE_SIZE, \
+                   SHARD_CHUNK_SIZE, \
+                   SHARD_LEASE_TTL, \
+                   BACKFILL_CONCURRENCY
+
+SHARD_QUEUE_KEY = 'backfill:queue'              # Sorted set of pending "start:end" ranges scored by start
+SHARD_LEASES_KEY = 'backfill:leases'            # Sorted set of leased ranges scored by lease expiry (ms)
+SHARD_OWNERS_KEY = 'backfill:owners'            # Hash of leased range -> worker id
+SHARD_CHECKPOINTS_KEY = 'backfill:checkpoints'  # Hash of leased range -> last height handled in order
+SHARD_KEYS = [SHARD_QUEUE_KEY, SHARD_LEASES_KEY, SHARD_OWNERS_KEY, SHARD_CHECKPOINTS_KEY]
+
+SHARD_RANGES_CLAIMED = Counter("indexer_shard_ranges_claimed_total", "Backfill ranges claimed by this worker.")
+SHARD_RANGES_REQUEUED = Counter("indexer_shard_ranges_requeued_total", "Expired backfill leases re-queued.")
+
+# Shared by the scripts below: the Redis server clock in milliseconds, so leases do not depend on worker clocks
+_LUA_NOW = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+"""
+
+# Queues ranges (ARGV = member1, score1, ...) only if no backfill is queued or leased. Returns ranges queued.
+PLAN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('ZCARD', KEYS[2]) > 0 then
+    return 0
+end
+for i = 1, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+return #ARGV / 2
+"""
+
+# Re-queues expired leases from their checkpoints, then claims the lowest queued range for ARGV[1] with a lease
+# of ARGV[2] ms. Returns {requeued} or {requeued, range, checkpoint}.
+CLAIM_SCRIPT = _LUA_NOW + """
+local requeued = 0
+for _, range in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    local separator = string.find(range, ':')
+    local first = tonumber(string.sub(range, 1, separator - 1))
+    local last = tonumber(string.sub(range, separator + 1))
+    local checkpoint = tonumber(redis.call('HGET', KEYS[4], range))
+    if checkpoint and checkpoint >= first then first = checkpoint + 1 end
+    if first <= last then
+        redis.call('ZADD', KEYS[1], first, first .. ':' .. last)
+        requeued = requeued + 1
+    end
+    redis.call('ZREM', KEYS[2], range)
+    redis.call('HDEL', KEYS[3], range)
+    redis.call('HDEL', KEYS[4], range)
+end
+local claimed = redis.call('ZPOPMIN', KEYS[1])
+if #claimed == 0 then
+    return {requeued}
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), claimed[1])
+redis.call('HSET', KEYS[3], claimed[1], ARGV[1])
+return {requeued, claimed[1]}
+"""
+
+# Renews the lease on ARGV[1] for worker ARGV[2] by ARGV[3] ms and records checkpoint ARGV[4] (if not empty).
+# Returns 0 if the worker no longer owns the range.
+HEARTBEAT_SCRIPT = _LUA_NOW + """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[3]), ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+end
+return 1
+"""
+
+# Releases the lease on ARGV[1] held by worker ARGV[2]; when ARGV[3] is not empty, heights from ARGV[3] to the end
+# of the range are put back on the queue. Returns 0 if the worker no longer owns the range.
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] ~= '' then
+    local last = tonumber(string.sub(ARGV[1], string.find(ARGV[1], ':') + 1))
+    local first = tonumber(ARGV[3])
+    if first <= last then
+        redis.call('ZADD', KEYS[1], first, first .. ':' .. last)
+    end
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return 1
+"""
+
+
+def split_ranges(ranges: list[tuple[int, int]], range_size: int = SHARD_RANGE_SIZE) -> list[tuple[int, int]]:
+    """
+    Split inclusive (start, end) ranges into shard ranges of at most `range_size` heights.
+
+    Splits fall on multiples of `range_size`, so the same gaps always produce the same shard ranges.
+    """
+    shards = []
+    for start, end in ranges:
+        while start <= end:
+            shard_end = min(end, (start // range_size + 1) * range_size - 1)
+            shards.append((start, shard_end))
+            start = shard_end + 1
+    return shards
+
+
+def plan_sharded_backfill(redis_conn: redis.Redis, missing_ranges: list[tuple[int, int]],
+                          range_size: int = SHARD_RANGE_SIZE) -> int:
+    """
+    Queue missing height ranges for the shared backfill.
+
+    Nothing is queued while another backfill is still queued or leased, so several nodes can plan
+    from the same gap check without queueing the same heights twice.
+
+    Returns:
+        int: The number of shard ranges queued (0 if a backfill was already in progress).
+    """
+    shards = split_ranges(missing_ranges, range_size)
+    if not shards:
+        return 0
+    script = redis_conn.register_script(PLAN_SCRIPT)
+    argv = [value for start, end in shards for value in (f"{start}:{end}", start)]
+    with REDIS_OPERATION_SECONDS.time(operation="shard_plan"):
+        queued = int(script(keys=SHARD_KEYS, args=argv))
+    if queued:
+        logging.info(f"Queued {queued} backfill ranges covering {len(missing_ranges)} missing block ranges.")
+    else:
+        logging.info("A shared backfill is already in progress; joining it.")
+    return queued
+
+
+def get_backfill_progress(redis_conn: redis.Redis) -> dict:
+    """Return the number of queued and leased ranges and the current lease owners."""
+    owners = redis_conn.hgetall(SHARD_OWNERS_KEY)
+    return {
+        "queued": redis_conn.zcard(SHARD_QUEUE_KEY),
+        "leased": redis_conn.zcard(SHARD_LEASES_KEY),
+        "owners": {key.decode('utf-8'): value.decode('utf-8') for key, value in owners.items()},
+    }
+
+
+class BackfillWorker:
+    """
+    Claim leased height ranges from the shared backfill queue and backfill them until the queue drains.
+
+    While a range is held, a heartbeat thread renews its lease every third of `lease_ttl` and
+    records the checkpoint reached so far. If a heartbeat finds the lease gone (it expired and the
+    range was re-queued) the worker abandons the range after the current chunk; the chunk's writes
+    are idempotent and already marked heights are skipped by whoever re-claims the range.
+
+    Args:
+        redis_conn (redis.Redis): Connection holding the queue, leases and processed-heights bitmap.
+        worker_id (str, optional): Unique worker name; defaults to host, pid and a random suffix.
+        lease_ttl (float): Seconds a lease lasts without a heartbeat.
+        chunk_size (int): Heights backfilled between checkpoints.
+        concurrency (int): In-flight requests used by each chunk's backfill.
+    """
+
+    def __init__(self, redis_conn: redis.Redis, worker_id: str = None, lease_ttl: float = SHARD_LEASE_TTL,
+                 chunk_size: int = SHARD_CHUNK_SIZE, concurrency: int = BACKFILL_CONCURRENCY):
+        self.redis_conn = redis_conn
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self._claim = redis_conn.register_script(CLAIM_SCRIPT)
+        self._heartbeat = redis_conn.register_script(HEARTBEAT_SCRIPT)
+        self._release = redis_conn.register_script(RELEASE_SCRIPT)
+        self._checkpoint = None
+        self._lease_lost = threading.Event()
+
+    def claim(self) -> tuple:
+        """Claim the next queued range; returns (start, end) or None if the queue is empty."""
+        with REDIS_OPERATION_SECONDS.time(operation="shard_claim"):
+            result = self._claim(keys=SHARD_KEYS, args=[self.worker_id, self.lease_ttl_ms])
+        if int(result[0]):
+            SHARD_RANGES_REQUEUED.inc(int(result[0]))
+            logging.info(f"Re-queued {result[0]} backfill ranges from expired leases.")
+        if len(result) < 2:
+            return None
+        SHARD_RANGES_CLAIMED.inc()
+        start, end = map(int, result[1].decode('utf-8').split(':'))
+        return start, end
+
+    def heartbeat(self, shard: tuple) -> bool:
+        """Renew the lease on `shard` and record the current checkpoint; False if the lease was lost."""
+        checkpoint = '' if self._checkpoint is None else self._checkpoint
+        with REDIS_OPERATION_SECONDS.time(operation="shard_heartbeat"):
+            renewed = self._heartbeat(keys=[SHARD_LEASES_KEY, SHARD_OWNERS_KEY, SHARD_CHECKPOINTS_KEY],
+                                      args=[f"{shard[0]}:{shard[1]}", self.worker_id, self.lease_ttl_ms, checkpoint])
+        return bool(renewed)
+
+    def release(self, shard: tuple, requeue_from: int = None) -> bool:
+        """Give up the lease on `shard`, putting heights from `requeue_from` onwards back on the queue."""
+        requeue = '' if requeue_from is None else requeue_from
+        return bool(self._release(keys=SHARD_KEYS, args=[f"{shard[0]}:{shard[1]}", self.worker_id, requeue]))
+
+    def _keep_alive(self, shard: tuple, stop: threading.Event) -> None:
+        while not stop.wait(self.lease_ttl_ms / 3000):
+            try:
+                if not self.heartbeat(shard):
+                    logging.error(f"Worker {self.worker_id} lost its lease on range {shard}.")
+                    self._lease_lost.set()
+                    return
+            except redis.RedisError as e:
+                logging.error(f"Heartbeat for range {shard} failed: {e}")
+
+    def process_range(self, shard: tuple) -> dict:
+        """
+        Backfill one leased range chunk by chunk, checkpointing after each chunk.
+
+        Returns:
+            dict: {"succeeded": list[int], "failed": list[int], "completed": bool}.
+        """
+        start, end = shard
+        results = {"succeeded": [], "failed": [], "completed": False}
+        self._checkpoint = None
+        self._lease_lost.clear()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._keep_alive, args=(shard, stop), name="backfill-heartbeat",
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            for chunk_start in range(start, end + 1, self.chunk_size):
+                if self._lease_lost.is_set():
+                    return results
+                chunk_end = min(end, chunk_start + self.chunk_size - 1)
+                heights = get_unprocessed_heights(self.redis_conn, chunk_start, chunk_end)
+                if heights:
+                    chunk = backfill_missing_blocks(heights, self.redis_conn, concurrency=self.concurrency)
+                    results["succeeded"].extend(chunk["succeeded"])
+                    results["failed"].extend(chunk["failed"])
+                # Failed heights stay unmarked in the bitmap, so the next gap check picks them up
+                self._checkpoint = chunk_end
+                if not self.heartbeat(shard):
+                    self._lease_lost.set()
+                    return results
+            results["completed"] = True
+            return results
+        finally:
+            stop.set()
+            heartbeat.join()
+            if results["completed"]:
+                self.release(shard)
+            elif not self._lease_lost.is_set():
+                # Interrupted: hand the rest of the range back instead of waiting for the lease to expire
+                self.release(shard, (self._checkpoint + 1) if self._checkpoint is not None else start)
+
+    def run(self, max_ranges: int = None) -> dict:
+        """
+        Claim and backfill ranges until the queue is empty and no other worker holds a lease.
+
+        While other workers hold leases this worker waits, so it can pick up their ranges if their
+        leases expire.
+
+        Args:
+            max_ranges (int, optional): Stop after this many ranges.
+
+        Returns:
+            dict: Totals for this worker, {"ranges": int, "succeeded": int, "failed": list[int]}.
+        """
+        totals = {"ranges": 0, "succeeded": 0, "failed": []}
+        start_time = time.monotonic()
+        logging.info(f"Backfill worker {self.worker_id} started.")
+        while max_ranges is None or totals["ranges"] < max_ranges:
+            shard = self.claim()
+            if shard is None:
+                if not self.redis_conn.zcard(SHARD_LEASES_KEY):
+                    break
+                time.sleep(self.lease_ttl_ms / 2000)
+                continue
+
+            logging.info(f"Worker {self.worker_id} claimed heights {shard[0]}-{shard[1]}.")
+            results = self.process_range(shard)
+            totals["ranges"] += 1
+            totals["succeeded"] += len(results["succeeded"])
+            totals["failed"].extend(results["failed"])
+
+        elapsed = time.monotonic() - start_time
+        logging.info(
+            f"Backfill worker {self.worker_id} finished {totals['ranges']} ranges: {totals['succeeded']} blocks "
+            f"in {elapsed:.2f}s ({totals['succeeded'] / elapsed if elapsed else 0:.1f} blocks/sec), "
+            f"{len(totals['failed'])} failed."
+        )
+        return totals
+
+
+def run_sharded_backfill(redis_conn: redis.Redis, missing_ranges: list[tuple[int, int]]) -> dict:
+    """Queue `missing_ranges` for the shared backfill (unless one is in progress) and work on it until drained."""
+    plan_sharded_backfill(redis_conn, missing_ranges)
+    return BackfillWorker(redis_conn).run()
@@ -0,0 +1,330 @@
+########################################################################################################################
+# stream_utils.py
+#
+# Changefeed of committed blocks on a Redis Stream, so downstream services get new blocks pushed to them instead of
+# polling PostgreSQL.
+#
+# Delivery is at-least-once. Writers record the heights they are about to commit in a pending set (`prepare`) and
+# `publish` clears them once their entries are appended. Heights left pending by a failed publish or a crash between
+# commit and publish are re-published from PostgreSQL by `republish_pending` (run at startup and on every follow
+# poll), so a committed block always reaches the stream, but possibly more than once and out of height order:
+# consumers should treat entries as idempotent upserts keyed by height.
+#
+# Features:
+#     - One compact entry per committed block: height, hash, time, tx count and the tx hashes.
+#     - Entries for a whole bulk-load flush are appended with one pipelined round-trip; the stream is capped with
+#       approximate MAXLEN trimming so it never grows without bound.
+#     - A height index (sorted set of entry ids scored by height) lets consumers start or replay from a height. A
+#       second sorted set scores the same ids by stream time, so ids of entries trimmed from the stream are dropped
+#       from the index by stream position, never by height.
+#     - Consumer-group helpers: create a group at a height, read new entries, acknowledge them.
+#     - `tail_changefeed` follows new entries without a group, for consumers in which every process needs every entry
+#       (e.g. query API cache invalidation).
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import logging
+import threading
+import time
+from .db_utils import perform_db_query
+from .metrics_utils import Counter, REDIS_OPERATION_SECONDS
+from .redis_utils import redis, RedisError
+from config import CHANGEFEED_ENABLED, \
+                   CHANGEFEED_STREAM, \
+                   CHANGEFEED_MAXLEN, \
+                   CHANGEFEED_INCLUDE_TXS, \
+                   CHANGEFEED_PENDING_GRACE
+
+CHANGEFEED_HEIGHTS_SUFFIX = ':heights'  # Sorted set of stream entry ids scored by block height
+CHANGEFEED_ORDER_SUFFIX = ':order'  # Sorted set of the same entry ids scored by their stream time (milliseconds)
+CHANGEFEED_PENDING_SUFFIX = ':pending'  # Sorted set of heights awaiting publication, scored by time recorded
+
+CHANGEFEED_ENTRIES = Counter("indexer_changefeed_entries_total", "Blocks published to the changefeed.", ("outcome",))
+
+
+def encode_entry(block_height: int, block_hash: str, timestamp, tx_hashes: list[str]) -> dict:
+    """Build the stream fields for one block."""
+    fields = {
+        "height": int(block_height),
+        "hash": block_hash,
+        "time": timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp),
+        "tx_count": len(tx_hashes),
+    }
+    if CHANGEFEED_INCLUDE_TXS:
+        fields["txs"] = ",".join(tx_hashes)
+    return fields
+
+
+def _entry_time(entry_id) -> int:
+    """Millisecond part of a stream entry id."""
+    return int((entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id).split("-")[0])
+
+
+def decode_entry(fields: dict) -> dict:
+    """Turn the raw fields of a stream entry back into a block record."""
+    fields = {key.decode('utf-8') if isinstance(key, bytes) else key:
+              value.decode('utf-8') if isinstance(value, bytes) else value for key, value in fields.items()}
+    txs = fields.get("txs")
+    return {
+        "height": int(fields["height"]),
+        "hash": fields["hash"],
+        "time": fields["time"],
+        "tx_count": int(fields["tx_count"]),
+        "txs": txs.split(",") if txs else [],
+    }
+
+
+class ChangefeedPublisher:
+    """
+    Append committed blocks to the changefeed stream.
+
+    Call `prepare` with the heights before committing them and `publish` afterwards. Neither raises: a
+    Redis failure is logged and counted, ingestion carries on, and `republish_pending` catches up later.
+
+    Args:
+        redis_conn (redis.Redis): Connection to write the stream on.
+        stream (str): Stream key.
+        maxlen (int): Approximate cap on the stream length.
+    """
+
+    def __init__(self, redis_conn: redis.Redis, stream: str = CHANGEFEED_STREAM, maxlen: int = CHANGEFEED_MAXLEN):
+        self.redis_conn = redis_conn
+        self.stream = stream
+        self.heights_key = stream + CHANGEFEED_HEIGHTS_SUFFIX
+        self.order_key = stream + CHANGEFEED_ORDER_SUFFIX
+        self.pending_key = stream + CHANGEFEED_PENDING_SUFFIX
+        self.maxlen = maxlen
+
+    def prepare(self, heights) -> bool:
+        """
+        Record `heights` as awaiting publication; call before committing them.
+
+        Returns:
+            bool: False if Redis could not be reached, in which case a crash before `publish` loses them.
+        """
+        if not heights:
+            return True
+        try:
+            with REDIS_OPERATION_SECONDS.time(operation="changefeed_prepare"):
+                now = time.time()
+                self.redis_conn.zadd(self.pending_key, {int(height): now for height in heights})
+        except RedisError as e:
+            logging.error(f"Failed to record {len(heights)} blocks as pending for the changefeed: {e}")
+            return False
+        return True
+
+    def publish(self, entries: list[dict]) -> int:
+        """
+        Append entries (from `encode_entry`) in one pipelined round-trip and clear their heights from the
+        pending set.
+
+        Returns:
+            int: The number of entries appended.
+        """
+        if not entries:
+            return 0
+        try:
+            with REDIS_OPERATION_SECONDS.time(operation="changefeed_publish"):
+                pipe = self.redis_conn.pipeline(transaction=False)
+                for fields in entries:
+                    pipe.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+                entry_ids = pipe.execute()
+
+                pipe = self.redis_conn.pipeline(transaction=False)
+                pipe.zadd(self.heights_key,
+                          {entry_id: fields["height"] for entry_id, fields in zip(entry_ids, entries)})
+                pipe.zadd(self.order_key, {entry_id: _entry_time(entry_id) for entry_id in entry_ids})
+                pipe.zrem(self.pending_key, *(fields["height"] for fields in entries))
+                pipe.zcard(self.order_key)
+                pipe.xlen(self.stream)
+                *_, indexed, length = pipe.execute()
+                if indexed > length:  # MAXLEN trimmed some entries since the last publish
+                    self._trim_index()
+        except RedisError as e:
+            logging.error(f"Failed to publish {len(entries)} blocks to the changefeed: {e}")
+            CHANGEFEED_ENTRIES.inc(len(entries), outcome="failed")
+            return 0
+        CHANGEFEED_ENTRIES.inc(len(entries), outcome="published")
+        return len(entries)
+
+    def _trim_index(self) -> None:
+        """Drop index entries for stream entries older than the first one still in the stream."""
+        first = self.redis_conn.xrange(self.stream, count=1)
+        if not first:
+            self.redis_conn.delete(self.heights_key, self.order_key)
+            return
+        # Ids sharing the first entry's millisecond are left for a later trim
+        stale = self.redis_conn.zrangebyscore(self.order_key, "-inf", _entry_time(first[0][0]) - 1)
+        if stale:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.zrem(self.heights_key, *stale)
+            pipe.zrem(self.order_key, *stale)
+            pipe.execute()
+
+    def publish_block(self, block_height: int, block_hash: str, timestamp, tx_hashes: list[str]) -> int:
+        """Append one block."""
+        return self.publish([encode_entry(block_height, block_hash, timestamp, tx_hashes)])
+
+
+def get_changefeed(redis_conn: redis.Redis) -> ChangefeedPublisher:
+    """Return a publisher on `redis_conn`, or None when CHANGEFEED_ENABLED is off."""
+    return ChangefeedPublisher(redis_conn) if CHANGEFEED_ENABLED else None
+
+
+def republish_pending(redis_conn: redis.Redis, grace: float = CHANGEFEED_PENDING_GRACE,
+                      batch_size: int = 1000) -> int:
+    """
+    Publish the blocks recorded as pending more than `grace` seconds ago, reading them from PostgreSQL.
+
+    This covers a publish that failed and a crash between a commit and its publish. The grace period
+    leaves commits that are still in flight in other processes alone. Pending heights that were never
+    committed are dropped.
+
+    Returns:
+        int: The number of blocks re-published, or -1 if Redis or the database failed.
+    """
+    publisher = get_changefeed(redis_conn)
+    if publisher is None:
+        return 0
+    republished = 0
+    try:
+        while True:
+            heights = [int(height) for height in redis_conn.zrangebyscore(
+                publisher.pending_key, "-inf", time.time() - grace, start=0, num=batch_size)]
+            if not heights:
+                break
+            blocks = perform_db_query("""
+                SELECT block_height, block_hash, timestamp FROM blocks
+                WHERE block_height = ANY(%s) ORDER BY block_height
+            """, (heights,))
+            txs = perform_db_query("""
+                SELECT block_id, tx_hash FROM transactions
+                WHERE block_id = ANY(%s) ORDER BY block_id, tx_hash
+            """, (heights,))
+            if blocks is None or txs is None:
+                return -1
+
+            tx_hashes = {}
+            for block_id, tx_hash in txs:
+                tx_hashes.setdefault(block_id, []).append(tx_hash)
+            entries = [encode_entry(height, block_hash, timestamp, tx_hashes.get(height, []))
+                       for height, block_hash, timestamp in blocks]
+            if entries and not publisher.publish(entries):
+                return -1
+            never_committed = set(heights) - {height for height, _, _ in blocks}
+            if never_committed:
+                redis_conn.zrem(publisher.pending_key, *never_committed)
+            republished += len(entries)
+    except RedisError as e:
+        logging.error(f"Failed to re-publish pending changefeed blocks: {e}")
+        return -1
+
+    if republished:
+        logging.info(f"Re-published {republished} blocks to the changefeed.")
+    return republished
+
+
+# ---- consumers ------------------------------------------------------------------------------------------------------
+
+def entry_id_for_height(redis_conn: redis.Redis, height: int, stream: str = CHANGEFEED_STREAM) -> str:
+    """
+    Return the id of the stream entry for the lowest published height at or above `height`, or None.
+
+    Backfilled heights are published when they are committed, so the stream is ordered by commit
+    rather than strictly by height; starting at this entry replays everything committed after it.
+    """
+    members = redis_conn.zrangebyscore(stream + CHANGEFEED_HEIGHTS_SUFFIX, int(height), "+inf", start=0, num=1)
+    if not members:
+        return None
+    return members[0].decode('utf-8') if isinstance(members[0], bytes) else members[0]
+
+
+def _start_id(redis_conn: redis.Redis, from_height: int, stream: str) -> str:
+    """Stream id just before the entry for `from_height`, for use as an exclusive start position."""
+    entry_id = entry_id_for_height(redis_conn, from_height, stream)
+    if entry_id is None:
+        return "$"  # Nothing published at or above that height yet: start with the next entry
+    milliseconds, sequence = map(int, entry_id.split("-"))
+    return f"{milliseconds}-{sequence - 1}" if sequence else f"{milliseconds - 1}-18446744073709551615"
+
+
+def create_consumer_group(redis_conn: redis.Redis, group: str, from_height: int = None,
+                          stream: str = CHANGEFEED_STREAM) -> None:
+    """
+    Create consumer group `group`, starting at `from_height` (or at new entries only).
+
+    If the group already exists and `from_height` is given, the group is moved to that height.
+    """
+    start_id = "$" if from_height is None else _start_id(redis_conn, from_height, stream)
+    try:
+        redis_conn.xgroup_create(stream, group, id=start_id, mkstream=True)
+        logging.info(f"Created changefeed consumer group '{group}' at {start_id}.")
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+        if from_height is not None:
+            redis_conn.xgroup_setid(stream, group, id=start_id)
+            logging.info(f"Moved changefeed consumer group '{group}' to {start_id}.")
+
+
+def read_changefeed(redis_conn: redis.Redis, group: str, consumer: str, count: int = 100,
+                    block_ms: int = 5000, stream: str = CHANGEFEED_STREAM) -> list[tuple[str, dict]]:
+    """
+    Read new entries for `consumer` in `group`, waiting up to `block_ms` for them.
+
+    Returns:
+        list[tuple[str, dict]]: (entry id, block record) pairs; acknowledge them with `ack_changefeed`.
+    """
+    response = redis_conn.xreadgroup(group, consumer, {stream: ">"}, count=count, block=block_ms)
+    return [(entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id, decode_entry(fields))
+            for _, entries in response or [] for entry_id, fields in entries]
+
+
+def ack_changefeed(redis_conn: redis.Redis, group: str, entry_ids: list[str], stream: str = CHANGEFEED_STREAM) -> int:
+    """Acknowledge processed entries; returns the number acknowledged."""
+    return redis_conn.xack(stream, group, *entry_ids) if entry_ids else 0
+
+
+def replay_changefeed(redis_conn: redis.Redis, from_height: int, batch_size: int = 1000,
+                      stream: str = CHANGEFEED_STREAM):
+    """Yield (entry id, block record) pairs from the entry for `from_height` to the end of the stream."""
+    start = entry_id_for_height(redis_conn, from_height, stream)
+    if start is None:
+        return
+    while True:
+        entries = redis_conn.xrange(stream, min=start, count=batch_size)
+        for entry_id, fields in entries:
+            yield (entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id), decode_entry(fields)
+        if len(entries) < batch_size:
+            return
+        last = entries[-1][0].decode('utf-8') if isinstance(entries[-1][0], bytes) else entries[-1][0]
+        start = "(" + last  # Exclusive range start (Redis 6.2+)
+
+
+def tail_changefeed(redis_conn: redis.Redis, callback, stop: threading.Event, count: int = 1000,
+                    block_ms: int = 5000, stream: str = CHANGEFEED_STREAM) -> None:
+    """
+    Pass every entry appended from now on to `callback` (as a list of block records per read) until `stop` is set.
+
+    Reads with plain XREAD rather than a consumer group, so every process tailing the stream sees every entry.
+    Redis errors are logged and retried; reading resumes after the last entry seen, so none are skipped. An
+    exception from `callback` is logged and tailing carries on with the next entries.
+    """
+    last_id = None
+    while not stop.is_set():
+        try:
+            if last_id is None:  # Pin "now" to a concrete id; re-reading from "$" would miss entries between reads
+                newest = redis_conn.xrevrange(stream, count=1)
+                last_id = newest[0][0] if newest else "0-0"
+            response = redis_conn.xread({stream: last_id}, count=count, block=block_ms)
+        except RedisError as e:
+            logging.warning(f"Reading the changefeed failed, retrying: {e}")
+            stop.wait(1.0)
+            continue
+        for _, entries in response or []:
+            last_id = entries[-1][0]
+            try:
+                callback([decode_entry(fields) for _, fields in entries])
+            except Exception as e:
+                logging.error(f"Changefeed callback failed on {len(entries)} entries: {e}")
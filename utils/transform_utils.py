@@ -0,0 +1,84 @@
+########################################################################################################################
+# transform_utils.py
+#
+# CPU-bound block transformation: decoding the block JSON and the base64 transactions in `data.txs`, computing
+# their SHA-256 transaction hashes (the hash Tendermint/Cosmos uses to identify a tx) and, for the message index,
+# decoding their Cosmos SDK messages (`cosmos_utils`). Functions here are pure and picklable so they can run in a
+# process pool.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import base64
+import hashlib
+from .decode_utils import BlockRecord, decode_block
+from .cosmos_utils import decode_tx_messages
+from config import MESSAGE_INDEX_ENABLED
+
+
+def decode_tx(tx: str) -> bytes:
+    """Decode a base64 transaction from a block's `data.txs` list."""
+    return base64.b64decode(tx)
+
+
+def compute_tx_hash(tx: str) -> str:
+    """Return the transaction hash (upper-case hex SHA-256 of the decoded tx bytes)."""
+    return hashlib.sha256(decode_tx(tx)).hexdigest().upper()
+
+
+def decode_messages(txs: list[str], tx_hashes: list[str]) -> list[tuple]:
+    """
+    Decode the messages of a block's transactions for the message index.
+
+    Returns:
+        list[tuple]: (tx_hash, msg_index, type_url, [(address, role), ...]) per message; empty when
+        MESSAGE_INDEX_ENABLED is off.
+    """
+    if not MESSAGE_INDEX_ENABLED:
+        return []
+    return [(tx_hash, msg_index, type_url, addresses)
+            for tx, tx_hash in zip(txs, tx_hashes)
+            for msg_index, (type_url, addresses) in enumerate(decode_tx_messages(decode_tx(tx)))]
+
+
+def message_rows(block_height: int, messages: list[tuple]) -> tuple[list[tuple], list[tuple]]:
+    """
+    Turn decoded messages (from `decode_messages`) into `messages` and `address_txs` rows.
+
+    Returns:
+        tuple: ([(block_id, tx_hash, msg_index, type_url, sender, recipient), ...],
+        [(address, block_id, tx_hash, msg_index, role), ...]).
+    """
+    rows, address_rows = [], []
+    for tx_hash, msg_index, type_url, addresses in messages:
+        sender = next((address for address, role in addresses if role == "sender"), None)
+        recipient = next((address for address, role in addresses if role == "recipient"), None)
+        rows.append((block_height, tx_hash, msg_index, type_url, sender, recipient))
+        address_rows.extend((address, block_height, tx_hash, msg_index, role) for address, role in addresses)
+    return rows, address_rows
+
+
+def transform_block(block) -> tuple:
+    """
+    Reduce a block to the row data the loader stores.
+
+    Args:
+        block (bytes | BlockRecord | dict): A raw block response, a decoded record or a decoded dict.
+
+    Returns:
+        tuple: (block_height, block_hash, timestamp, tx_hashes, last_block_hash, message_rows), or None
+        if the block cannot be decoded or is missing height, hash or timestamp. `message_rows` is the
+        `message_rows` output, built here so the work stays in the transform workers.
+    """
+    if isinstance(block, (bytes, bytearray)):
+        record = decode_block(block)
+    elif isinstance(block, BlockRecord):
+        record = block
+    else:
+        record = BlockRecord.from_dict(block)
+    if record is None:
+        return None
+
+    tx_hashes = [compute_tx_hash(tx) for tx in record.txs]
+    return (record.height, record.block_hash, record.timestamp, tx_hashes, record.last_block_hash,
+            message_rows(record.height, decode_messages(record.txs, tx_hashes)))
@@ -0,0 +1,218 @@
+########################################################################################################################
+# verify_utils.py
+#
+# Incremental chain-integrity verification. Every block header carries `last_block_id.hash`, the hash of the block
+# before it; a stored chain is consistent when each block's `last_block_hash` equals the stored `block_hash` of
+# height - 1.
+#
+# Features:
+#     - Verifies heights in fixed-size chunks on parallel connections, one `LAG()` range scan per chunk.
+#     - Keeps a watermark of verified heights in Redis, so each run only checks heights indexed since the last one.
+#       The watermark stops before the first missing height, so heights beyond a gap are checked again once the
+#       gap is filled.
+#     - Queues both blocks of every broken link for refetch; `refetch_queued_blocks` re-downloads them, overwrites
+#       the stored rows (and archived copies), re-publishes them to the changefeed and re-checks the links around
+#       them.
+#
+# Developed by: Don Fox
+# Date: 07/02/2024
+#######################################################################################################################
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .db_utils import perform_db_query
+from .metrics_utils import Counter, Gauge, REDIS_OPERATION_SECONDS
+from .redis_utils import redis
+from config import VERIFY_CHUNK_SIZE, VERIFY_WORKERS
+
+VERIFIED_HEIGHT_KEY = 'verified_height'  # Every stored height up to this one links to its predecessor
+REFETCH_QUEUE_KEY = 'refetch_heights'    # Sorted set of heights queued for refetch, scored by height
+
+VERIFIED_HEIGHT = Gauge("indexer_verified_height", "Chain-integrity watermark (last verified height).")
+CHAIN_MISMATCHES = Counter("indexer_chain_mismatches_total", "Broken last_block_id links found by the verifier.")
+BLOCKS_REFETCHED = Counter("indexer_blocks_refetched_total", "Blocks re-downloaded by the verifier.", ("outcome",))
+
+
+def get_verified_height(redis_conn: redis.Redis) -> int:
+    """Return the verification watermark, or None if the chain has never been verified."""
+    value = redis_conn.get(VERIFIED_HEIGHT_KEY)
+    return int(value) if value is not None else None
+
+
+def queue_refetch(redis_conn: redis.Redis, heights) -> None:
+    """Queue block heights to be re-downloaded and overwritten."""
+    heights = sorted(set(int(height) for height in heights))
+    if heights:
+        redis_conn.zadd(REFETCH_QUEUE_KEY, {str(height): height for height in heights})
+        logging.info(f"Queued {len(heights)} blocks for refetch: {heights[:20]}{'...' if len(heights) > 20 else ''}")
+
+
+def get_refetch_queue(redis_conn: redis.Redis) -> list[int]:
+    """Return the heights queued for refetch, in ascending order."""
+    return [int(member) for member in redis_conn.zrange(REFETCH_QUEUE_KEY, 0, -1)]
+
+
+def verify_range(low: int, high: int) -> dict:
+    """
+    Check the `last_block_id` links of the stored blocks from `low` to `high` (inclusive).
+
+    Returns:
+        dict: {"checked": int, "mismatches": list[int] (heights whose link is broken),
+        "first_missing": int or None, "unverifiable": int (blocks stored without last_block_hash)}.
+    """
+    rows = perform_db_query("""
+        SELECT block_height, last_block_hash,
+               LAG(block_height) OVER (ORDER BY block_height),
+               LAG(block_hash) OVER (ORDER BY block_height)
+        FROM blocks
+        WHERE block_height BETWEEN %s AND %s
+        ORDER BY block_height
+    """, (low - 1, high))
+    if rows is None:
+        raise RuntimeError(f"Verification query for heights {low}-{high} failed.")
+
+    result = {"checked": 0, "mismatches": [], "first_missing": None, "unverifiable": 0}
+    expected = low
+    for height, last_block_hash, previous_height, previous_hash in rows:
+        if height < low:
+            continue
+        if height != expected and result["first_missing"] is None:
+            result["first_missing"] = expected
+        expected = height + 1
+        if previous_height != height - 1:
+            continue  # Predecessor not stored yet; re-checked once the gap is filled
+        if last_block_hash is None:
+            result["unverifiable"] += 1
+            continue
+        result["checked"] += 1
+        if last_block_hash != previous_hash:
+            result["mismatches"].append(height)
+    if expected <= high and result["first_missing"] is None:
+        result["first_missing"] = expected
+    return result
+
+
+def verify_chain(redis_conn: redis.Redis, end: int = None, chunk_size: int = VERIFY_CHUNK_SIZE,
+                 workers: int = VERIFY_WORKERS) -> dict:
+    """
+    Verify every stored height above the watermark and advance it.
+
+    Args:
+        redis_conn (redis.Redis): Connection holding the watermark and the refetch queue.
+        end (int, optional): Last height to verify (defaults to the highest stored height).
+        chunk_size (int): Heights per verification query.
+        workers (int): Chunks verified in parallel.
+
+    Returns:
+        dict: {"verified_height": int, "checked": int, "mismatches": list[int], "unverifiable": int},
+        or None if there is nothing stored or the verification failed.
+    """
+    bounds = perform_db_query("SELECT MIN(block_height), MAX(block_height) FROM blocks")
+    if not bounds or bounds[0][0] is None:
+        logging.info("No stored blocks to verify.")
+        return None
+    lowest, highest = bounds[0]
+    end = highest if end is None else min(end, highest)
+
+    watermark = get_verified_height(redis_conn)
+    if watermark is None or watermark < lowest:
+        watermark = lowest  # The lowest stored block has no stored predecessor to check against
+    if watermark >= end:
+        return {"verified_height": watermark, "checked": 0, "mismatches": [], "unverifiable": 0}
+
+    start_time = time.monotonic()
+    chunks = [(low, min(end, low + chunk_size - 1)) for low in range(watermark + 1, end + 1, chunk_size)]
+    totals = {"verified_height": watermark, "checked": 0, "mismatches": [], "unverifiable": 0}
+    advancing = True
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="verify") as executor:
+            # map() yields in chunk order, so the watermark only moves over a contiguous verified prefix
+            for (low, high), result in zip(chunks, executor.map(lambda chunk: verify_range(*chunk), chunks)):
+                totals["checked"] += result["checked"]
+                totals["unverifiable"] += result["unverifiable"]
+                totals["mismatches"].extend(result["mismatches"])
+                if advancing:
+                    if result["first_missing"] is None:
+                        totals["verified_height"] = high
+                    else:
+                        totals["verified_height"] = result["first_missing"] - 1
+                        advancing = False
+    except Exception as e:
+        logging.error(f"Chain verification failed: {e}")
+        return None
+
+    if totals["mismatches"]:
+        CHAIN_MISMATCHES.inc(len(totals["mismatches"]))
+        queue_refetch(redis_conn, [h for height in totals["mismatches"] for h in (height - 1, height)])
+    if totals["verified_height"] > watermark:
+        redis_conn.set(VERIFIED_HEIGHT_KEY, totals["verified_height"])
+    VERIFIED_HEIGHT.set(totals["verified_height"])
+
+    elapsed = time.monotonic() - start_time
+    logging.info(
+        f"Verified heights {watermark + 1}-{end} in {elapsed:.2f}s: {totals['checked']} links checked, "
+        f"{len(totals['mismatches'])} broken, {totals['unverifiable']} without last_block_hash; "
+        f"watermark now {totals['verified_height']}."
+    )
+    return totals
+
+
+def repair_block(height: int, redis_conn: redis.Redis) -> bool:
+    """
+    Re-download the block at `height` from the API and overwrite the stored block, transactions and messages.
+
+    The archive is bypassed (its copy may be the bad one) and replaced with the new response. The
+    repaired block is re-published to the changefeed and marked as processed.
+
+    Returns:
+        bool: True if the block was re-stored.
+    """
+    # Imported here so verifying a healthy chain never loads the HTTP client stack
+    from .block_utils import fetch_block_at_height, process_block
+
+    record = fetch_block_at_height(height, refresh=True)
+    if record is None:
+        logging.error(f"Refetch of block {height} returned no usable block.")
+        return False
+    return process_block(record, redis_conn, replace=True)
+
+
+def refetch_queued_blocks(redis_conn: redis.Redis, batch_size: int = 100) -> dict:
+    """
+    Repair every block queued for refetch, then re-check the links into and out of each one.
+
+    Blocks that cannot be re-downloaded stay queued; links that are still broken after a refetch are
+    reported rather than re-queued, since the API itself is serving an inconsistent chain.
+
+    Returns:
+        dict: {"repaired": list[int], "failed": list[int], "still_broken": list[int]}.
+    """
+    results = {"repaired": [], "failed": [], "still_broken": []}
+    heights = get_refetch_queue(redis_conn)
+    for offset in range(0, len(heights), batch_size):
+        repaired = []
+        for height in heights[offset:offset + batch_size]:
+            if repair_block(height, redis_conn):
+                repaired.append(height)
+                BLOCKS_REFETCHED.inc(outcome="repaired")
+            else:
+                results["failed"].append(height)
+                BLOCKS_REFETCHED.inc(outcome="failed")
+        results["repaired"].extend(repaired)
+        if repaired:
+            with REDIS_OPERATION_SECONDS.time(operation="refetch_dequeue"):
+                redis_conn.zrem(REFETCH_QUEUE_KEY, *map(str, repaired))
+
+    for height in results["repaired"]:
+        try:
+            broken = verify_range(height, height + 1)["mismatches"]
+        except RuntimeError as e:
+            logging.error(f"Re-check after refetching block {height} failed: {e}")
+            continue
+        results["still_broken"].extend(h for h in broken if h not in results["still_broken"])
+
+    if results["repaired"] or results["failed"]:
+        logging.info(f"Refetched {len(results['repaired'])} blocks ({len(results['failed'])} failed).")
+    if results["still_broken"]:
+        logging.error(f"Chain links still broken after refetch at heights {results['still_broken']}.")
+    return results